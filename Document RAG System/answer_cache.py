@@ -0,0 +1,185 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "1") == "1"
+# Minimum cosine similarity between rewritten-query embeddings for a hit
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+# Set to a SQLite file path (e.g. "answer_cache.sqlite3") to keep the cache across restarts
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "")
+
+class SemanticAnswerCache:
+    """LRU/TTL cache of generated answers.
+
+    An entry is reused when a new query retrieves exactly the same chunk ids and its
+    embedding is within the cosine threshold of the cached query's embedding. With a
+    path, each entry is also written to (and dropped from) a SQLite table as it changes,
+    outside the cache lock.
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, max_entries=ANSWER_CACHE_SIZE,
+                 ttl=ANSWER_CACHE_TTL, path=ANSWER_CACHE_PATH):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._metrics = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0,
+                         "latency_saved_seconds": 0.0}
+        self._db_lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._load()
+
+    def lookup(self, embedding, chunk_ids):
+        """Returns the cached result for this query, or None."""
+        chunk_ids = frozenset(chunk_ids)
+        vector = _normalize(embedding)
+        now = time.time()
+        expired = []
+        try:
+            return self._lookup(chunk_ids, vector, now, expired)
+        finally:
+            self._persist(removed=expired)
+
+    def _lookup(self, chunk_ids, vector, now, expired):
+        with self._lock:
+            best_key, best_score = None, self.threshold
+            for key, entry in list(self._entries.items()):
+                if now - entry["created"] > self.ttl:
+                    del self._entries[key]
+                    expired.append(key)
+                    self._metrics["evictions"] += 1
+                    continue
+                if entry["chunk_ids"] != chunk_ids:
+                    continue
+                score = float(np.dot(entry["embedding"], vector))
+                if score >= best_score:
+                    best_key, best_score = key, score
+
+            if best_key is None:
+                self._metrics["misses"] += 1
+                return None
+
+            entry = self._entries[best_key]
+            self._entries.move_to_end(best_key)
+            self._metrics["hits"] += 1
+            self._metrics["latency_saved_seconds"] += entry["generate_seconds"]
+            return entry["result"]
+
+    def store(self, embedding, chunk_ids, sources, result, generate_seconds):
+        entry = {
+            "embedding": _normalize(embedding),
+            "chunk_ids": frozenset(chunk_ids),
+            "sources": set(sources),
+            "result": result,
+            "generate_seconds": generate_seconds,
+            "created": time.time(),
+        }
+        evicted = []
+        with self._lock:
+            key = self._next_key
+            self._entries[key] = entry
+            self._next_key += 1
+            self._metrics["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+                self._metrics["evictions"] += 1
+        self._persist(added=(key, entry), removed=evicted)
+
+    def invalidate_source(self, source):
+        """Drops every cached answer that cited the given source file."""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if source in entry["sources"]]
+            for key in stale:
+                del self._entries[key]
+            self._metrics["invalidations"] += len(stale)
+        self._persist(removed=stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.execute("DELETE FROM entries")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+            stats["entries"] = len(self._entries)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            return stats
+
+    def _load(self):
+        try:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS entries (key INTEGER PRIMARY KEY, entry BLOB NOT NULL)")
+            rows = self._conn.execute("SELECT key, entry FROM entries ORDER BY key").fetchall()
+        except Exception as e:
+            print(f"Error loading answer cache {self.path}: {e}")
+            self._conn = None
+            return
+        now = time.time()
+        dropped = []
+        for key, blob in rows:
+            entry = pickle.loads(blob)
+            if now - entry["created"] > self.ttl:
+                dropped.append(key)
+            else:
+                self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            dropped.append(self._entries.popitem(last=False)[0])
+        self._next_key = rows[-1][0] + 1 if rows else 0
+        self._persist(removed=dropped)
+
+    def _persist(self, added=None, removed=()):
+        if self._conn is None or (added is None and not removed):
+            return
+        try:
+            with self._db_lock:
+                if added is not None:
+                    key, entry = added
+                    self._conn.execute("INSERT OR REPLACE INTO entries (key, entry) VALUES (?, ?)",
+                                       (key, pickle.dumps(entry)))
+                    with self._lock:
+                        # Evicted or invalidated by another thread, whose delete may have run first
+                        if key not in self._entries:
+                            removed = [*removed, key]
+                if removed:
+                    self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in removed])
+        except Exception as e:
+            print(f"Error saving answer cache {self.path}: {e}")
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+def get_answer_cache():
+    """Returns the process-wide answer cache, or None if ANSWER_CACHE=0."""
+    global _CACHE
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = SemanticAnswerCache()
+        return _CACHE
+
+def invalidate_source(source):
+    cache = get_answer_cache()
+    if cache is not None:
+        cache.invalidate_source(source)
@@ -1,43 +1,132 @@
-from fastapi import FastAPI, UploadFile, File, Form
+import time
+# Taken before the imports below, so the startup log shows what importing the app costs
+_IMPORT_STARTED = time.perf_counter()
+from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
-import shutil
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, PlainTextResponse
 import os
-from ingest import ingest_file, get_collection_stats
-from rag import query_rag
+import asyncio
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from ingest import get_collection_stats
+from rag import query_rag, query_rag_stream, query_rag_batch
 from pydantic import BaseModel
+import resources
+import answer_cache
+import jobs
+import uploads
+import telemetry
 
 app = FastAPI()
+print(f"App modules imported in {time.perf_counter() - _IMPORT_STARTED:.2f}s")
+
+# Query execution pool: "thread" (default) or "process"
+QUERY_EXECUTOR = os.getenv("QUERY_EXECUTOR", "thread")
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", "4"))
+# Queries admitted at once (running + queued); beyond this /query answers 503 immediately
+QUERY_MAX_IN_FLIGHT = int(os.getenv("QUERY_MAX_IN_FLIGHT", str(QUERY_WORKERS * 2)))
+
+_query_pool = None
+_queries_in_flight = 0
+
+telemetry.Gauge("rag_http_queries_in_flight", "Queries admitted by /query, /query/stream and /query/batch",
+                function=lambda: _queries_in_flight)
+telemetry.Gauge("rag_jobs", "Ingestion jobs by state", ["state"],
+                function=lambda: {(state,): count for state, count in jobs.get_job_queue().counts().items()})
 
 os.makedirs("data", exist_ok=True)
+# Uploads land here until their job is queued; a directory, so /files never lists them
+UPLOAD_STAGING = os.path.join("data", ".staging")
+os.makedirs(UPLOAD_STAGING, exist_ok=True)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/files_static", StaticFiles(directory="data"), name="files_static")
 
+def _start_query_workers():
+    # Submitting one task per worker spawns them all now; each warms up in its initializer
+    for future in [_query_pool.submit(os.getpid) for _ in range(QUERY_WORKERS)]:
+        future.result()
+
+def _warm_up():
+    extra_steps = [("query_workers", _start_query_workers, True)] if QUERY_EXECUTOR == "process" else []
+    resources.warm_up(extra_steps)
+    print(f"Ready {time.perf_counter() - _IMPORT_STARTED:.2f}s after the app started importing")
+
+@app.on_event("startup")
+def warm_up_resources():
+    global _query_pool
+    if QUERY_EXECUTOR == "process":
+        # Each worker process holds its own registry, so warm it up there. Workers are spawned
+        # rather than forked: a fork could copy a lock held by one of this process's threads
+        # (the job queue, warm-up) and deadlock the worker
+        _query_pool = ProcessPoolExecutor(max_workers=QUERY_WORKERS, initializer=resources.warm_up,
+                                          mp_context=multiprocessing.get_context("spawn"))
+    else:
+        _query_pool = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query")
+    jobs.get_job_queue().start()
+    if resources.WARM_UP == "blocking":
+        _warm_up()
+    elif resources.WARM_UP != "off":
+        # The server binds right away; /ready reports when the hot path is loaded
+        threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+    print(f"Startup hooks done {time.perf_counter() - _IMPORT_STARTED:.2f}s after the app started importing "
+          f"(warm-up: {resources.WARM_UP})")
+
+@app.on_event("shutdown")
+def shutdown_query_pool():
+    if _query_pool is not None:
+        _query_pool.shutdown(wait=False, cancel_futures=True)
+    # An ingest cut short here is picked up again on the next start
+    jobs.get_job_queue().stop(wait=False)
+
+def _run_query(query, history, sources=None, where=None):
+    timings = {}
+    result = query_rag(query, history, timings=timings, sources=sources, where=where)
+    return result, timings
+
 class QueryRequest(BaseModel):
     query: str
     history: list[dict] = []
+    # Limit retrieval to these filenames and/or chunks matching this Chroma metadata filter
+    sources: list[str] | None = None
+    where: dict | None = None
+
+class BatchQueryRequest(BaseModel):
+    queries: list[str]
+    histories: list[list[dict]] | None = None
+    concurrency: int | None = None
+    sources: list[str] | None = None
+    where: dict | None = None
 
 @app.get("/")
 async def read_root():
     return FileResponse('templates/index.html')
 
-from fastapi import BackgroundTasks
-
-def background_ingest(file_location):
-    ingest_file(file_location)
-
 @app.post("/upload")
-async def upload_document(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def upload_document(request: Request):
+    """Takes a multipart/form-data "file" field and queues its ingestion; poll /jobs/{id} with
+    the returned job's id.
+
+    The body is streamed to disk in fixed-size pieces and hashed on the way, so memory per
+    upload stays bounded; uploads over MAX_UPLOAD_BYTES are refused with 413.
+    """
     try:
-        file_location = f"data/{file.filename}"
-        with open(file_location, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            
-        # Run ingestion in background
-        background_tasks.add_task(background_ingest, file_location)
-        
-        return JSONResponse(content={"message": f"Upload accepted. Processing {file.filename} in background."}, status_code=200)
+        try:
+            upload = await uploads.stage_multipart(request, UPLOAD_STAGING)
+        except uploads.UploadTooLarge as e:
+            return JSONResponse(content={"message": str(e)}, status_code=413)
+        except uploads.UploadError as e:
+            return JSONResponse(content={"message": str(e)}, status_code=400)
+
+        file_location = os.path.join("data", upload.filename)
+        job, duplicate = jobs.get_job_queue().enqueue(file_location, upload.content_hash, staged=upload.path)
+        if duplicate:
+            message = f"{upload.filename} has the same content as {job['filename']}, which is already {job['state']}."
+        else:
+            message = f"Upload accepted. Processing {upload.filename} in background."
+        return JSONResponse(content={"message": message, "job": job, "duplicate": duplicate}, status_code=200)
             
     except Exception as e:
         import traceback
@@ -45,6 +134,19 @@ async def upload_document(background_tasks: BackgroundTasks, file: UploadFile =
         print(f"ERROR: Upload failed: {e}")
         return JSONResponse(content={"message": str(e)}, status_code=500)
 
+@app.get("/jobs")
+async def list_jobs(limit: int = 50, active: bool = False):
+    """Most recent ingestion jobs first; active=true returns only queued and running ones."""
+    queue = jobs.get_job_queue()
+    return {"jobs": queue.list(limit, active), "counts": queue.counts()}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get_job_queue().get(job_id)
+    if job is None:
+        return JSONResponse(content={"message": "Job not found"}, status_code=404)
+    return job
+
 @app.get("/files")
 async def list_files():
     files = []
@@ -73,23 +175,181 @@ async def delete_file(filename: str):
     else:
          return JSONResponse(content={"message": "File deleted from disk but failed to remove from DB"}, status_code=500)
 
+def _busy_response():
+    return JSONResponse(
+        content={"message": "Server busy, please retry shortly."},
+        status_code=503,
+        headers={"Retry-After": "1"}
+    )
+
 @app.post("/query")
 async def query_endpoint(request: QueryRequest):
-    response_data = query_rag(request.query, request.history)
-    return response_data
+    global _queries_in_flight
+    if _queries_in_flight >= QUERY_MAX_IN_FLIGHT:
+        return _busy_response()
+
+    _queries_in_flight += 1
+    try:
+        submitted = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        response_data, timings = await loop.run_in_executor(_query_pool, _run_query, request.query, request.history,
+                                                            request.sources, request.where)
+    finally:
+        _queries_in_flight -= 1
+
+    total = time.perf_counter() - submitted
+    timings["queue"] = max(total - sum(timings.values()), 0.0)
+    server_timing = ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+    return JSONResponse(content=response_data, headers={"Server-Timing": server_timing})
 
+class _AdmittedStreamingResponse(StreamingResponse):
+    """A streamed query response that releases its in-flight slot however it ends,
+    including when the client is gone before the body starts."""
+
+    async def __call__(self, scope, receive, send):
+        global _queries_in_flight
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            _queries_in_flight -= 1
+
+async def _pump(events):
+    """Runs a blocking generator in the query pool."""
+    loop = asyncio.get_running_loop()
+    # Generators cannot cross process boundaries, so streams always use threads
+    executor = _query_pool if isinstance(_query_pool, ThreadPoolExecutor) else None
+    try:
+        while True:
+            event = await loop.run_in_executor(executor, next, events, None)
+            if event is None:
+                break
+            yield event
+    finally:
+        try:
+            events.close()
+        except ValueError:
+            # Still running in a worker thread after a client disconnect; it finishes on its own
+            pass
+
+async def _sse_events(events):
+    async for event in _pump(events):
+        yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+@app.post("/query/stream")
+async def query_stream_endpoint(request: QueryRequest):
+    """Server-sent events: a "sources" event, then "token" events, then "done" (or "error")."""
+    global _queries_in_flight
+    if _queries_in_flight >= QUERY_MAX_IN_FLIGHT:
+        return _busy_response()
+
+    _queries_in_flight += 1
+    events = query_rag_stream(request.query, request.history, sources=request.sources, where=request.where)
+    return _AdmittedStreamingResponse(
+        _sse_events(events),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _batch_lines(request):
+    stats = {}
+    for index, result in query_rag_batch(request.queries, request.histories, request.concurrency, stats=stats,
+                                         sources=request.sources, where=request.where):
+        yield {"index": index, "query": request.queries[index], **result}
+    yield {"summary": stats}
+
+async def _ndjson_lines(events):
+    async for event in _pump(events):
+        yield json.dumps(event) + "\n"
+
+@app.post("/query/batch")
+async def query_batch_endpoint(request: BatchQueryRequest):
+    """Newline-delimited JSON: one result per query in input order, then a {"summary": ...} line
+    with the question count, unique questions, seconds and questions per second."""
+    global _queries_in_flight
+    if request.histories is not None and len(request.histories) != len(request.queries):
+        return JSONResponse(content={"message": "histories must have one entry per query"}, status_code=400)
+    if _queries_in_flight >= QUERY_MAX_IN_FLIGHT:
+        return _busy_response()
+
+    _queries_in_flight += 1
+    return _AdmittedStreamingResponse(_ndjson_lines(_batch_lines(request)), media_type="application/x-ndjson")
+
+@app.get("/ready")
+async def get_ready():
+    """Readiness probe: 503 until warm-up has loaded the query hot path (or if it failed)."""
+    readiness = resources.get_readiness()
+    return JSONResponse(content=readiness, status_code=200 if readiness["ready"] else 503)
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text exposition. With QUERY_EXECUTOR=process the query stage histograms
+    are recorded in the worker processes and do not appear here."""
+    return PlainTextResponse(telemetry.render(), media_type="text/plain; version=0.0.4")
+
+# Handlers that may load a resource or page through the collection are plain functions,
+# so FastAPI runs them in its threadpool instead of blocking the event loop (and /ready)
 @app.get("/status")
-async def get_status():
-    count = get_collection_stats()
-    return {"status": "running", "chunk_count": count}
+def get_status():
+    stats = get_collection_stats()
+    return {"status": "running", "chunk_count": stats["chunk_count"], "document_count": stats["document_count"]}
+
+@app.get("/stats")
+def get_stats(refresh: bool = False):
+    return get_collection_stats(refresh=refresh)
+
+@app.get("/resources")
+def get_resources():
+    return resources.get_resource_stats()
+
+@app.get("/cache")
+def get_cache_stats():
+    cache = answer_cache.get_answer_cache()
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+@app.get("/rewrite")
+async def get_rewrite_stats():
+    import query_rewrite
+    return query_rewrite.get_rewrite_memo().stats()
+
+@app.get("/rerank")
+def get_rerank_stats():
+    import rerank
+    reranker = rerank.get_reranker()
+    if reranker is None:
+        return {"enabled": False}
+    return {"enabled": True, **reranker.stats()}
+
+@app.get("/embeddings")
+def get_embedding_stats():
+    import embedding_service
+    return embedding_service.get_stats()
+
+@app.get("/shards")
+def get_shard_stats():
+    import shards
+    return shards.get_stats()
+
+@app.get("/scope")
+async def get_scope_stats():
+    import scoped_search
+    return scoped_search.get_stats()
+
+@app.get("/context")
+async def get_context_stats():
+    import context_packing
+    return context_packing.get_stats()
 
+# History handlers query SQLite, so they also run in the threadpool rather than the event loop
 @app.get("/history")
-async def get_history():
+def get_history(limit: int | None = None, before_timestamp: int | None = None, before_id: str = ""):
     from history import get_all_chats
-    return get_all_chats()
+    before = (before_timestamp, before_id) if before_timestamp is not None else None
+    return get_all_chats(limit, before)
 
 @app.get("/history/{chat_id}")
-async def get_chat_history(chat_id: str):
+def get_chat_history(chat_id: str):
     from history import get_chat
     chat = get_chat(chat_id)
     if chat:
@@ -97,7 +357,7 @@ async def get_chat_history(chat_id: str):
     return JSONResponse(content={"message": "Chat not found"}, status_code=404)
 
 @app.delete("/history/{chat_id}")
-async def delete_chat_history(chat_id: str):
+def delete_chat_history(chat_id: str):
     from history import delete_chat
     success = delete_chat(chat_id)
     if success:
@@ -110,7 +370,7 @@ class SaveChatRequest(BaseModel):
     messages: list[dict]
 
 @app.post("/history")
-async def save_chat_history(request: SaveChatRequest):
+def save_chat_history(request: SaveChatRequest):
     from history import save_chat
     save_chat(request.id, request.title, request.messages)
     return {"message": "Chat saved"}
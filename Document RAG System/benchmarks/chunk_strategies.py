@@ -0,0 +1,97 @@
+"""Compares chunking strategies on a synthetic corpus with planted known-answer facts.
+
+Reports chunk counts, chunking throughput, embedded tokens (including overlap),
+embedding time and retrieval recall@k for each strategy:
+
+    python benchmarks/chunk_strategies.py --pages 400 --facts 200
+    python benchmarks/chunk_strategies.py --throughput-mb 100 --skip-embed
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import chunking
+import resources
+import synthetic
+
+def _corpus(pages, fact_count, seed=0):
+    planted = synthetic.facts(fact_count, seed)
+    source = synthetic.page_lines(seed, planted=[sentence for sentence, _, _ in planted])
+    text = "\n\n".join("\n".join(next(source)) for _ in range(pages))
+    # Only ask about facts that made it into the text
+    return text, [(q, a) for sentence, q, a in planted if sentence in text]
+
+def _recall(chunks, questions, k):
+    embed = resources.get_embedding_function()
+    vectors = np.asarray(embed(chunks), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    queries = np.asarray(embed([q for q, _ in questions]), dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True) + 1e-12
+    top = np.argsort(-(queries @ vectors.T), axis=1)[:, :k]
+    hits = sum(any(answer in chunks[i] for i in row) for row, (_, answer) in zip(top, questions))
+    return hits / len(questions) if questions else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=400)
+    parser.add_argument("--facts", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--strategies", nargs="+", default=list(chunking.STRATEGIES))
+    parser.add_argument("--throughput-mb", type=float, help="also time chunking this many MB of text")
+    parser.add_argument("--skip-embed", action="store_true", help="skip embedding time and recall")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    text, questions = _corpus(args.pages, args.facts)
+    tokenizer = resources.get_tokenizer()
+    results = []
+    for strategy in args.strategies:
+        chunker = chunking.get_chunker(strategy)
+        start = time.perf_counter()
+        chunks = chunker.split(text)
+        chunk_seconds = time.perf_counter() - start
+
+        token_counts = [len(ids) for ids in tokenizer(chunks)["input_ids"]]
+        row = {
+            "strategy": strategy,
+            "signature": chunker.signature,
+            "chunks": len(chunks),
+            "chunk_seconds": chunk_seconds,
+            "chunk_mb_per_second": len(text) / 2**20 / chunk_seconds,
+            "embedded_tokens": sum(token_counts),
+            "max_tokens": max(token_counts),
+            # Embedded characters per corpus character; 1.0 means no overlap
+            "overlap_factor": sum(map(len, chunks)) / len(text),
+        }
+
+        if not args.skip_embed:
+            start = time.perf_counter()
+            resources.get_embedding_function()(chunks)
+            row["embed_seconds"] = time.perf_counter() - start
+            row[f"recall@{args.k}"] = _recall(chunks, questions, args.k)
+
+        if args.throughput_mb:
+            repeats = max(int(args.throughput_mb * 2**20 / len(text)), 1)
+            segments = ((text, None) for _ in range(repeats))
+            start = time.perf_counter()
+            count = sum(1 for _ in chunker.chunk_stream(segments))
+            seconds = time.perf_counter() - start
+            row["throughput_mb"] = repeats * len(text) / 2**20
+            row["throughput_seconds"] = seconds
+            row["throughput_chunks"] = count
+
+        results.append(row)
+        print(json.dumps(row))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Query embedding throughput and latency: one model call per query versus micro-batching.
+
+Threads each embed single questions, as concurrent /query requests do. "direct" calls
+the model per question (the old SentenceTransformerEmbeddingFunction path), "batched"
+goes through embedding_service.MicroBatcher, and "sidecar" through a sidecar process
+on a Unix socket:
+
+    python benchmarks/embedding_batching.py --threads 1 8 32 --runtimes torch int8 onnx
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+def _run(embed, questions, threads):
+    latencies = []
+    lock = threading.Lock()
+    next_index = [0]
+
+    def worker():
+        while True:
+            with lock:
+                i = next_index[0]
+                next_index[0] += 1
+            if i >= len(questions):
+                return
+            start = time.perf_counter()
+            embed([questions[i]])
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "qps": len(questions) / seconds,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+    }
+
+def _start_sidecar(path, runtime, timeout=300):
+    env = dict(os.environ, EMBED_RUNTIME=runtime)
+    server = subprocess.Popen([sys.executable, str(Path(__file__).resolve().parent.parent / "embedding_service.py"),
+                               "--socket", path], env=env)
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if server.poll() is not None or time.monotonic() > deadline:
+            server.kill()
+            sys.exit("Error: the embedding sidecar did not start")
+        time.sleep(0.2)
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--runtimes", nargs="+", default=["torch"])
+    parser.add_argument("--modes", nargs="+", default=["direct", "batched", "sidecar"])
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    import embedding_service
+    import resources
+    import synthetic
+    questions = [question for _, question, _ in synthetic.facts(args.queries)]
+    results = []
+    for runtime in args.runtimes:
+        model = embedding_service.load_model(resources.MODEL_NAME, runtime)
+        batcher = embedding_service.MicroBatcher(model, runtime=runtime)
+        sidecar = None
+        for mode in args.modes:
+            if mode == "direct":
+                embed = lambda texts: model.encode(texts, convert_to_numpy=True)
+            elif mode == "batched":
+                embed = batcher.embed
+            else:
+                path = os.path.join(tempfile.mkdtemp(), "embed.sock")
+                sidecar = _start_sidecar(path, runtime)
+                embed = embedding_service.SidecarClient(path).embed
+            embed(questions[:8])
+            for threads in args.threads:
+                row = _run(embed, questions, threads)
+                row.update(runtime=runtime, mode=mode, threads=threads)
+                if mode == "batched":
+                    row["batch_size_histogram"] = batcher.stats()["batch_size_histogram"]
+                results.append(row)
+                print(f"{runtime:6} {mode:8} {threads:3} threads: {row['qps']:8.1f} QPS  "
+                      f"p50 {row['p50_ms']:6.1f} ms  p95 {row['p95_ms']:6.1f} ms")
+            if sidecar is not None:
+                sidecar.terminate()
+                sidecar.wait()
+                sidecar = None
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
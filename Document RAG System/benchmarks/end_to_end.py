@@ -0,0 +1,356 @@
+"""End-to-end benchmark: ingest a synthetic corpus, then load the FastAPI app with a stub LLM.
+
+Generates PDF, DOCX and TXT files with planted known-answer facts and ingests them in
+a child process (throughput and peak RSS). It then starts the app under uvicorn with
+LLM_BACKEND=stub and measures /query latency percentiles, QPS and the Server-Timing
+stage breakdown at each concurrency level, plus retrieval recall: the share of
+questions whose answer appears in a returned source. Everything runs in a temporary
+directory, so the real data/, chroma_db and history are untouched; with the embedding
+model cached, no network is needed.
+
+    python benchmarks/end_to_end.py --output run.json
+    python benchmarks/end_to_end.py --baseline run.json   # exits 1 on a regression
+
+--save-baseline writes the results to the given file after a run without regressions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+# (metric, True if higher is better) checked against a baseline; query metrics per concurrency level
+INGEST_METRICS = [("mb_per_second", True), ("chunks_per_second", True), ("peak_rss_mb", False)]
+QUERY_METRICS = [("qps", True), ("p50_ms", False), ("p95_ms", False), ("p99_ms", False)]
+RECALL_METRICS = [("recall", True), ("mrr", True)]
+
+def _peak_rss_mb():
+    # VmHWM rather than ru_maxrss, which carries over the parent's peak across exec
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _child_ingest(workdir, facts_path):
+    """Ingests workdir/data file by file; prints throughput and which facts made it into the text."""
+    os.chdir(workdir)
+    import ingest
+    with open(facts_path, encoding="utf-8") as f:
+        planted = json.load(f)
+    baseline = _peak_rss_mb()
+    files = sorted(os.listdir("data"))
+    by_format, found = {}, []
+    start = time.perf_counter()
+    for filename in files:
+        path = os.path.join("data", filename)
+        ext = os.path.splitext(filename)[1]
+        seen = [0]
+        t = time.perf_counter()
+        ingest.ingest_file(path, progress=lambda stage, chunks: seen.__setitem__(0, chunks))
+        row = by_format.setdefault(ext, {"files": 0, "mb": 0.0, "chunks": 0, "seconds": 0.0})
+        row["files"] += 1
+        row["mb"] += os.path.getsize(path) / 2**20
+        row["chunks"] += seen[0]
+        row["seconds"] += time.perf_counter() - t
+        # PDF lines wrap mid-sentence, so compare with whitespace collapsed
+        text = " ".join(ingest.load_file(path).split())
+        found += [fact for fact in planted.get(filename, []) if fact[0] in text]
+    seconds = time.perf_counter() - start
+    for row in by_format.values():
+        row["mb_per_second"] = row["mb"] / row["seconds"] if row["seconds"] else 0.0
+    mb = sum(row["mb"] for row in by_format.values())
+    chunks = sum(row["chunks"] for row in by_format.values())
+    print(json.dumps({
+        "ingest": {
+            "files": len(files),
+            "mb": mb,
+            "chunks": chunks,
+            "seconds": seconds,
+            "mb_per_second": mb / seconds if seconds else 0.0,
+            "chunks_per_second": chunks / seconds if seconds else 0.0,
+            "peak_rss_mb": _peak_rss_mb(),
+            "baseline_rss_mb": baseline,
+            "formats": by_format,
+        },
+        "facts": found,
+    }))
+
+def _write_corpus(data_dir, formats, files, pages, fact_count, seed):
+    """Writes files per format with the facts spread over them; returns {filename: facts}."""
+    import synthetic
+    names = [f"doc_{i:03d}{ext}" for ext in formats for i in range(files)]
+    planted = {name: [] for name in names}
+    for i, fact in enumerate(synthetic.facts(fact_count, seed)):
+        planted[names[i % len(names)]].append(list(fact))
+    for i, name in enumerate(names):
+        ext = os.path.splitext(name)[1]
+        synthetic.WRITERS[ext](os.path.join(data_dir, name), pages, seed=seed + i,
+                               planted=[sentence for sentence, _, _ in planted[name]])
+    return planted
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _start_server(workdir, port, env, timeout):
+    # The app serves static/ and templates/ relative to its working directory
+    for name in ("static", "templates"):
+        os.symlink(REPO / name, os.path.join(workdir, name))
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--app-dir", str(REPO),
+                               "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+                              cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    import httpx
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            break
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/ready", timeout=5).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    server.kill()
+    with open(os.path.join(workdir, "server.log"), encoding="utf-8", errors="replace") as f:
+        sys.exit(f"Error: the app did not come up within {timeout}s:\n{f.read()[-4000:]}")
+
+def _percentile(values, q):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(int(round(q / 100 * len(values))) - 1, 0))]
+
+_STAGE = re.compile(r"([\w-]+);dur=([\d.]+)")
+
+async def _drive(client, questions, concurrency, count, on_response=None):
+    """Sends count /query requests from `concurrency` workers; returns latencies, statuses, stage ms."""
+    latencies, statuses, stages = [], {}, {}
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < count:
+            i = next_index
+            next_index += 1
+            question = questions[i % len(questions)]
+            start = time.perf_counter()
+            try:
+                response = await client.post("/query", json={"query": question[1], "history": []})
+                status = response.status_code
+            except Exception as e:
+                response, status = None, type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status == 200:
+                for stage, ms in _STAGE.findall(response.headers.get("server-timing", "")):
+                    stages[stage] = stages.get(stage, 0.0) + float(ms)
+                if on_response is not None:
+                    on_response(question, response.json())
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses, stages
+
+async def _load(base_url, questions, levels, requests, warmup):
+    import httpx
+    results = []
+    limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        await _drive(client, questions, 1, warmup)
+        for concurrency in levels:
+            start = time.perf_counter()
+            latencies, statuses, stages = await _drive(client, questions, concurrency, requests)
+            seconds = time.perf_counter() - start
+            ok = statuses.get("200", 0)
+            latencies.sort()
+            results.append({
+                "concurrency": concurrency,
+                "requests": requests,
+                "statuses": statuses,
+                "qps": ok / seconds if seconds else 0.0,
+                "mean_ms": sum(latencies) / len(latencies) * 1000,
+                "p50_ms": _percentile(latencies, 50) * 1000,
+                "p95_ms": _percentile(latencies, 95) * 1000,
+                "p99_ms": _percentile(latencies, 99) * 1000,
+                "max_ms": latencies[-1] * 1000,
+                # Mean Server-Timing milliseconds per successful request, by stage
+                "stages_ms": {stage: total / ok for stage, total in stages.items()} if ok else {},
+            })
+
+        ranks = []
+        def check(question, body):
+            texts = [source.get("text") or "" for source in body.get("sources", [])]
+            ranks.append(next((rank for rank, text in enumerate(texts, 1) if question[2] in text), None))
+        await _drive(client, questions, min(4, max(levels)), len(questions), check)
+    found = [rank for rank in ranks if rank is not None]
+    recall = {
+        "questions": len(ranks),
+        "recall": len(found) / len(ranks) if ranks else 0.0,
+        "mrr": sum(1 / rank for rank in found) / len(ranks) if ranks else 0.0,
+    }
+    return results, recall
+
+def _metrics(results):
+    """Flat {name: (value, higher_is_better)} of the numbers compared against a baseline."""
+    metrics = {}
+    for name, higher in INGEST_METRICS:
+        metrics[f"ingest.{name}"] = (results["ingest"][name], higher)
+    for row in results["queries"]:
+        for name, higher in QUERY_METRICS:
+            metrics[f"query.c{row['concurrency']}.{name}"] = (row[name], higher)
+    for name, higher in RECALL_METRICS:
+        metrics[f"retrieval.{name}"] = (results["retrieval"][name], higher)
+    return metrics
+
+def compare(results, baseline, tolerance, recall_tolerance):
+    """Returns (report lines, regressions) for metrics present in both runs.
+
+    Throughput, latency and memory regress when worse by more than tolerance (a
+    fraction of the baseline); recall and MRR when lower by more than recall_tolerance.
+    """
+    current, previous = _metrics(results), _metrics(baseline)
+    lines, regressions = [], []
+    for name, (value, higher) in current.items():
+        if name not in previous:
+            continue
+        old = previous[name][0]
+        if name.startswith("retrieval."):
+            worse = old - value > recall_tolerance
+        elif old:
+            worse = (old - value) / old > tolerance if higher else (value - old) / old > tolerance
+        else:
+            worse = False
+        change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+        line = f"{name:28} {old:12.3f} -> {value:12.3f} ({change}){'  REGRESSION' if worse else ''}"
+        lines.append(line)
+        if worse:
+            regressions.append(name)
+    return lines, regressions
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "commit": commit, "timestamp": int(time.time())}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--formats", nargs="+", default=[".pdf", ".docx", ".txt"])
+    parser.add_argument("--files", type=int, default=2, help="files per format")
+    parser.add_argument("--pages", type=int, default=50, help="pages per file")
+    parser.add_argument("--facts", type=int, default=100, help="known-answer facts planted across the corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=200, help="queries per concurrency level")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds the stub LLM takes per answer")
+    parser.add_argument("--answer-cache", action="store_true", help="leave the semantic answer cache on")
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against results saved by an earlier run")
+    parser.add_argument("--save-baseline", help="write the results here if there is no regression")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="relative slowdown (or memory growth) counted as a regression")
+    parser.add_argument("--recall-tolerance", type=float, default=0.02,
+                        help="absolute drop in recall or MRR counted as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    parser.add_argument("--child-ingest", nargs=2, metavar=("WORKDIR", "FACTS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_ingest:
+        _child_ingest(*args.child_ingest)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    env = dict(os.environ)
+    env.update(LLM_BACKEND="stub", LLM_STUB_LATENCY=str(args.llm_latency), LLM_STUB_SEED=str(args.seed))
+    if not args.answer_cache:
+        env["ANSWER_CACHE"] = "0"
+    # Measure queueing rather than 503s at the highest level, unless set explicitly
+    env.setdefault("QUERY_MAX_IN_FLIGHT", str(max(args.concurrency)))
+    server = None
+    try:
+        data_dir = os.path.join(workdir, "data")
+        os.makedirs(data_dir)
+        print(f"Writing {args.files} x {' '.join(args.formats)} files of {args.pages} pages to {workdir}")
+        planted = _write_corpus(data_dir, args.formats, args.files, args.pages, args.facts, args.seed)
+        facts_path = os.path.join(workdir, "facts.json")
+        with open(facts_path, "w", encoding="utf-8") as f:
+            json.dump(planted, f)
+
+        out = subprocess.run([sys.executable, __file__, "--child-ingest", workdir, facts_path],
+                             capture_output=True, text=True, env=env)
+        if out.returncode != 0:
+            sys.exit(f"Error: ingestion failed:\n{out.stderr[-4000:]}")
+        ingested = json.loads(out.stdout.strip().splitlines()[-1])
+        ingest_stats, questions = ingested["ingest"], ingested["facts"]
+        print(f"Ingested {ingest_stats['mb']:.1f} MiB in {ingest_stats['seconds']:.1f}s: "
+              f"{ingest_stats['mb_per_second']:.2f} MiB/s, {ingest_stats['chunks_per_second']:.0f} chunks/s, "
+              f"peak RSS {ingest_stats['peak_rss_mb']:.0f} MiB; {len(questions)} facts planted")
+        if not questions:
+            sys.exit("Error: no planted fact survived parsing; use more --pages")
+
+        port = _free_port()
+        server = _start_server(workdir, port, env, args.startup_timeout)
+        queries, recall = asyncio.run(_load(f"http://127.0.0.1:{port}", questions, args.concurrency,
+                                            args.requests, args.warmup))
+        for row in queries:
+            print(f"concurrency {row['concurrency']:3}: {row['qps']:7.1f} QPS  p50 {row['p50_ms']:7.1f} ms  "
+                  f"p95 {row['p95_ms']:7.1f} ms  p99 {row['p99_ms']:7.1f} ms  statuses {row['statuses']}")
+        print(f"recall@sources {recall['recall']:.3f}  MRR {recall['mrr']:.3f} over {recall['questions']} questions")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        if not args.keep:
+            import shutil
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "environment": _environment(),
+        "config": {k: v for k, v in vars(args).items()
+                   if k not in ("output", "baseline", "save_baseline", "keep", "child_ingest")},
+        "ingest": ingest_stats,
+        "queries": queries,
+        "retrieval": recall,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("Warning: the baseline was recorded with different settings")
+        lines, regressions = compare(results, baseline, args.tolerance, args.recall_tolerance)
+        print(f"Against {args.baseline} (commit {baseline.get('environment', {}).get('commit')}):")
+        print("\n".join(lines))
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+    if args.save_baseline and not regressions:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Save latency of the SQLite chat store as history grows, next to the old history.json rewrite.
+
+    python benchmarks/history_store.py --chats 100000 --json-limit 5000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+MESSAGES = [
+    {"role": "user", "content": "What is the reference code for the pump unit?"},
+    {"role": "assistant", "content": "The reference code for the pump unit is XJ-9921. " * 8},
+] * 3
+
+def _json_save(path, chat_id, title, messages):
+    """The pre-SQLite save_chat: load, update and rewrite the whole file."""
+    data = []
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    data.append({"id": chat_id, "title": title, "messages": messages, "timestamp": int(time.time() * 1000)})
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+
+def _measure_json(path, chats, samples):
+    """Writes chats - samples chats in one go, then times the remaining saves; returns their median in ms."""
+    base = max(chats - samples, 0)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([{"id": f"chat-{i}", "title": f"Chat {i}", "messages": MESSAGES, "timestamp": i}
+                   for i in range(base)], f, indent=4)
+    return _measure(lambda *a: _json_save(path, *a), base, chats, samples)
+
+def _measure(save, start, stop, samples):
+    """Fills chats start..stop, timing the last `samples` saves; returns their median in ms."""
+    latencies = []
+    for i in range(start, stop):
+        t = time.perf_counter()
+        save(f"chat-{i}", f"Chat {i}", MESSAGES)
+        if i >= stop - samples:
+            latencies.append(time.perf_counter() - t)
+    latencies.sort()
+    return latencies[len(latencies) // 2] * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=100000)
+    parser.add_argument("--json-limit", type=int, default=5000, help="stop timing history.json beyond this many chats")
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    import history
+    checkpoints = [c for c in (100, 1000, 5000, 10000, 50000, 100000, args.chats) if c <= args.chats]
+    checkpoints = sorted(set(checkpoints))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        store = history.HistoryStore(os.path.join(tmp, "history.sqlite3"), legacy_file=None)
+        json_path = os.path.join(tmp, "history.json")
+        done = 0
+        for checkpoint in checkpoints:
+            row = {"chats": checkpoint}
+            row["sqlite_save_ms"] = _measure(store.save, done, checkpoint, args.samples)
+            t = time.perf_counter()
+            middle = store.get(f"chat-{checkpoint // 2}")
+            row["sqlite_get_ms"] = (time.perf_counter() - t) * 1000
+            t = time.perf_counter()
+            store.list(limit=50, before=(middle["timestamp"], middle["id"]))
+            row["sqlite_page_ms"] = (time.perf_counter() - t) * 1000
+            if checkpoint <= args.json_limit:
+                row["json_save_ms"] = _measure_json(json_path, checkpoint, args.samples)
+            done = checkpoint
+            results.append(row)
+            print("  ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                            for key, value in row.items()))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
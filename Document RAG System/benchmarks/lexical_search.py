@@ -0,0 +1,77 @@
+"""Build time, size and query latency of the BM25 lexical index on a synthetic corpus.
+
+    python benchmarks/lexical_search.py --chunks 1000000 --queries 200
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=1000000)
+    parser.add_argument("--sentences-per-chunk", type=int, default=12)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    import numpy as np
+    import lexical_index
+    import synthetic
+
+    facts = synthetic.facts(args.queries)
+    rng = random.Random(0)
+    planted = {rng.randrange(args.chunks): fact for fact in facts}
+    # Sampling from a fixed pool keeps corpus generation from dominating the build time
+    pool = list(itertools.islice(synthetic.sentences(), 100000))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = lexical_index.LexicalIndex(os.path.join(tmp, "lexical"))
+        start = time.perf_counter()
+        batch = 10000
+        for base in range(0, args.chunks, batch):
+            ids, texts = [], []
+            for i in range(base, min(base + batch, args.chunks)):
+                text = " ".join(rng.choices(pool, k=args.sentences_per_chunk))
+                if i in planted:
+                    text += " " + planted[i][0]
+                ids.append(f"chunk_{i}")
+                texts.append(text)
+            index.add(ids, [f"doc_{i // 1000}" for i in range(base, base + len(ids))], texts)
+        index.commit()
+        index.optimize()
+        build_seconds = time.perf_counter() - start
+        size = sum(f.stat().st_size for f in Path(tmp).rglob("*") if f.is_file())
+
+        expected = {fact[1]: f"chunk_{i}" for i, fact in planted.items()}
+        latencies, hits = [], 0
+        for _, question, answer in planted.values():
+            start = time.perf_counter()
+            results = index.search(f"{question} {answer}", k=10)
+            latencies.append(time.perf_counter() - start)
+            hits += expected[question] in [chunk_id for chunk_id, _ in results]
+
+    latencies = np.array(latencies) * 1000
+    row = {
+        "chunks": args.chunks,
+        "build_seconds": build_seconds,
+        "index_mb": size / 2**20,
+        "query_p50_ms": float(np.percentile(latencies, 50)),
+        "query_p95_ms": float(np.percentile(latencies, 95)),
+        "recall_at_10": hits / len(planted),
+    }
+    print(json.dumps(row, indent=4))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(row, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Peak memory of eager (load_file + split_text) versus streaming (iter_chunks) parsing.
+
+Each measurement runs in a fresh process so ru_maxrss reflects only that run:
+
+    python benchmarks/parse_memory.py --pages 100 500 2000 --formats .pdf .txt
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _child(mode, path):
+    import ingest
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "eager":
+        count = len(ingest.split_text(ingest.load_file(path)))
+    else:
+        count = sum(1 for _ in ingest.iter_chunks(path))
+    print(json.dumps({
+        "chunks": count,
+        "seconds": time.perf_counter() - start,
+        "peak_rss_mb": _peak_rss_mb(),
+        "baseline_rss_mb": baseline,
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("--formats", nargs="+", default=[".pdf", ".txt"])
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(*args.child)
+        return
+
+    import synthetic
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for ext in args.formats:
+            for pages in args.pages:
+                path = os.path.join(tmp, f"doc_{pages}{ext}")
+                synthetic.WRITERS[ext](path, pages)
+                for mode in ("eager", "stream"):
+                    out = subprocess.run([sys.executable, __file__, "--child", mode, path],
+                                         capture_output=True, text=True, check=True).stdout
+                    row = json.loads(out.strip().splitlines()[-1])
+                    row.update(format=ext, pages=pages, mode=mode, file_mb=os.path.getsize(path) / 2**20)
+                    results.append(row)
+                    print(f"{ext:5} {pages:6} pages {mode:6}: {row['chunks']:7} chunks "
+                          f"{row['seconds']:7.2f}s peak +{row['peak_rss_mb'] - row['baseline_rss_mb']:.1f} MiB")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
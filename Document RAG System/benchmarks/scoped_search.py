@@ -0,0 +1,129 @@
+"""Latency and recall of questions limited to one file, for each way of searching it.
+
+A synthetic collection of random unit vectors (no embedding model is loaded) is spread
+over --files sources, and each query is a near neighbour of a chunk in one target file:
+
+- "global" is the unscoped index search with out-of-file hits dropped afterwards, as
+  happens when the scope is applied to the results instead of the search.
+- "filtered" is Chroma's index search with a where filter on the source.
+- "exact" is scoped_search's NumPy search over the file's cached embeddings, and
+  "exact-cold" the same with the embeddings loaded from Chroma for every query.
+
+recall is the share of the file's exact top-k each method returns:
+
+    python benchmarks/scoped_search.py --chunks 100000 --files 50 200 1000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+def _corpus(chunks, dim, files, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((chunks, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    sources = np.array([f"file{i % files}.txt" for i in range(chunks)])
+    return {
+        "ids": [f"{source}_{i:016x}" for i, source in enumerate(sources)],
+        "embeddings": vectors,
+        "sources": sources,
+        "documents": [f"chunk {i} of {source}" for i, source in enumerate(sources)],
+        "metadatas": [{"source": str(source), "chunk_id": i} for i, source in enumerate(sources)],
+    }
+
+def _queries(corpus, files, count, seed=1):
+    # Near neighbours of chunks in one file each, like a question about that document
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(count):
+        source = f"file{rng.integers(0, files)}.txt"
+        rows = np.flatnonzero(corpus["sources"] == source)
+        vector = corpus["embeddings"][rng.choice(rows)] + rng.standard_normal(corpus["embeddings"].shape[1]) * 0.3
+        queries.append((source, rows, (vector / np.linalg.norm(vector)).astype(np.float32)))
+    return queries
+
+def _load(collection, corpus, batch_size=5000):
+    for i in range(0, len(corpus["ids"]), batch_size):
+        end = i + batch_size
+        collection.upsert(ids=corpus["ids"][i:end], embeddings=corpus["embeddings"][i:end],
+                          metadatas=corpus["metadatas"][i:end], documents=corpus["documents"][i:end])
+
+def _measure(search, corpus, queries, k):
+    latencies = []
+    found = 0
+    for source, rows, query in queries:
+        start = time.perf_counter()
+        ids = set(search(source, query))
+        latencies.append(time.perf_counter() - start)
+        exact = rows[np.argsort(-(corpus["embeddings"][rows] @ query))[:k]]
+        found += sum(corpus["ids"][row] in ids for row in exact)
+    latencies.sort()
+    return {
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "recall": found / (len(queries) * k),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--files", type=int, nargs="+", default=[50, 500],
+                        help="distinct sources the chunks are spread over (one run each)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        # Blocks are versioned by the manifest; keep this run's out of the real one
+        os.environ["INGEST_MANIFEST_PATH"] = os.path.join(directory, "manifest.sqlite3")
+        import chromadb
+        import resources
+        import scoped_search
+        client = chromadb.PersistentClient(path=os.path.join(directory, "chroma"))
+        print(f"{args.chunks} chunks of {args.dim} dimensions, top-{args.top_k}")
+        for files in args.files:
+            corpus = _corpus(args.chunks, args.dim, files)
+            collection = client.create_collection(name=f"{resources.COLLECTION_NAME}_{files}", embedding_function=None)
+            _load(collection, corpus)
+            queries = _queries(corpus, files, args.queries)
+            k = args.top_k
+            blocks = scoped_search.SourceBlocks()
+
+            def global_search(source, query):
+                hits = collection.query(query_embeddings=[query], n_results=k)["ids"][0]
+                return [chunk_id for chunk_id in hits if chunk_id.startswith(source + "_")]
+
+            methods = {
+                "global": global_search,
+                "filtered": lambda source, query: collection.query(
+                    query_embeddings=[query], n_results=k, where={"source": source})["ids"][0],
+                "exact": lambda source, query: scoped_search.rank([blocks.get(collection, source)], [query], k)[0],
+                "exact-cold": lambda source, query: scoped_search.rank(
+                    [scoped_search.SourceBlocks().get(collection, source)], [query], k)[0],
+            }
+            for name, search in methods.items():
+                # Warm up (for "exact", fill the cache for every target file) before timing
+                for source, _, query in queries:
+                    search(source, query)
+                row = _measure(search, corpus, queries, k)
+                row.update(method=name, files=files, chunks_per_file=args.chunks // files)
+                results.append(row)
+                print(f"{files:5} files ({args.chunks // files:6} chunks each) {name:10}: p50 {row['p50_ms']:7.2f} ms  "
+                      f"p95 {row['p95_ms']:7.2f} ms  recall@{k} {row['recall']:.3f}")
+            client.delete_collection(collection.name)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Query latency and throughput as the collection is split over more shard workers.
+
+Each configuration gets the same synthetic collection of random unit vectors (no
+embedding model is loaded) and answers single-vector queries from several threads, as
+concurrent /query requests do. "inline" is the unsharded collection searched in this
+process; "sharded" rows are shards.ShardedCollection over that many worker processes.
+recall is the share of the exact top-k (NumPy brute force) each configuration returns:
+
+    python benchmarks/sharding.py --chunks 100000 --shards 1 2 4 8 --threads 1 8 32
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+def _corpus(chunks, dim, files, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((chunks, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    sources = [f"file{i % files}.txt" for i in range(chunks)]
+    return {
+        "ids": [f"{source}_{i:016x}" for i, source in enumerate(sources)],
+        "embeddings": vectors,
+        "documents": [f"chunk {i} of {source}" for i, source in enumerate(sources)],
+        "metadatas": [{"source": source, "chunk_id": i} for i, source in enumerate(sources)],
+    }
+
+def _queries(corpus, count, seed=1):
+    # Near neighbours of stored chunks, like questions about something that was indexed
+    rng = np.random.default_rng(seed)
+    vectors = corpus["embeddings"][rng.integers(0, len(corpus["ids"]), count)]
+    vectors = vectors + rng.standard_normal(vectors.shape, dtype=np.float32) * 0.05
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def _load(collection, corpus, batch_size):
+    start = time.perf_counter()
+    for i in range(0, len(corpus["ids"]), batch_size):
+        end = i + batch_size
+        collection.upsert(ids=corpus["ids"][i:end], embeddings=corpus["embeddings"][i:end],
+                          metadatas=corpus["metadatas"][i:end], documents=corpus["documents"][i:end])
+    return time.perf_counter() - start
+
+def _recall(search, corpus, queries, k):
+    exact = np.argsort(-(queries @ corpus["embeddings"].T), axis=1)[:, :k]
+    found = 0
+    for query, rows in zip(queries, exact):
+        ids = set(search(query))
+        found += sum(corpus["ids"][row] in ids for row in rows)
+    return found / exact.size
+
+def _run(search, queries, threads):
+    latencies = []
+    lock = threading.Lock()
+    next_index = [0]
+
+    def worker():
+        while True:
+            with lock:
+                i = next_index[0]
+                next_index[0] += 1
+            if i >= len(queries):
+                return
+            start = time.perf_counter()
+            search(queries[i])
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "qps": len(queries) / seconds,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--files", type=int, default=500, help="distinct sources the chunks are spread over")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--no-inline", action="store_true", help="skip the unsharded in-process baseline")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    import chromadb
+    import resources
+    import shards
+    corpus = _corpus(args.chunks, args.dim, args.files)
+    queries = _queries(corpus, args.queries)
+    print(f"{args.chunks} chunks of {args.dim} dimensions, {os.cpu_count()} CPUs")
+
+    configurations = [] if args.no_inline else [("inline", 0)]
+    configurations += [("sharded", count) for count in args.shards]
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for mode, count in configurations:
+            if mode == "inline":
+                collection = chromadb.PersistentClient(path=os.path.join(directory, "inline")).get_or_create_collection(
+                    name=resources.COLLECTION_NAME, embedding_function=None)
+            else:
+                collection = shards.ShardedCollection(count, path=os.path.join(directory, f"shards-{count}"), routes=[])
+                collection.start()
+            load_seconds = _load(collection, corpus, 2000)
+            search = lambda query: collection.query(query_embeddings=[query], n_results=args.top_k)["ids"][0]
+            search(queries[0])
+            recall = _recall(search, corpus, queries[:200], args.top_k)
+            for threads in args.threads:
+                row = _run(search, queries, threads)
+                row.update(mode=mode, shards=count or 1, threads=threads, recall=recall,
+                           load_chunks_per_second=args.chunks / load_seconds)
+                results.append(row)
+                print(f"{mode:7} {count or 1:2} shards {threads:3} threads: {row['qps']:8.1f} QPS  "
+                      f"p50 {row['p50_ms']:6.2f} ms  p95 {row['p95_ms']:6.2f} ms  recall@{args.top_k} {recall:.3f}")
+            if mode == "sharded":
+                collection.close()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
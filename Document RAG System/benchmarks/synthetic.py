@@ -0,0 +1,101 @@
+import random
+
+WORDS = (
+    "system data model index query vector document retrieval answer context chunk token "
+    "embedding search latency memory throughput cache server request response source page "
+    "network storage process thread batch stream parser format table record value field "
+    "error code signal sensor engine module version release policy report user account"
+).split()
+
+def sentences(seed=0):
+    """Endless deterministic stream of filler sentences."""
+    rng = random.Random(seed)
+    while True:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+        yield " ".join(words).capitalize() + "."
+
+def facts(count, seed=0):
+    """Returns (sentence, question, answer) triples with unique, exactly checkable answers."""
+    rng = random.Random(seed + 7919)
+    result = []
+    for i in range(count):
+        subject = f"{rng.choice(WORDS)} {rng.choice(WORDS)} unit {i}"
+        answer = f"{rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ')}{rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ')}-{rng.randint(1000, 9999)}"
+        result.append((
+            f"The reference code for the {subject} is {answer}.",
+            f"What is the reference code for the {subject}?",
+            answer,
+        ))
+    return result
+
+def page_lines(seed, lines_per_page=45, line_width=90, planted=None):
+    """Yields pages as lists of lines of filler text."""
+    stream = sentences(seed)
+    planted = list(planted or [])
+    rng = random.Random(seed + 1)
+    while True:
+        lines = []
+        line = ""
+        while len(lines) < lines_per_page:
+            sentence = next(stream)
+            if planted and rng.random() < 0.05:
+                sentence = planted.pop()
+            if len(line) + len(sentence) + 1 > line_width:
+                lines.append(line)
+                line = sentence
+            else:
+                line = f"{line} {sentence}".strip()
+        yield lines
+
+def write_txt(path, pages, seed=0, planted=None):
+    with open(path, "w", encoding="utf-8") as f:
+        source = page_lines(seed, planted=planted)
+        for _ in range(pages):
+            f.write("\n".join(next(source)) + "\n\n")
+
+def write_docx(path, pages, seed=0, planted=None):
+    import docx
+    document = docx.Document()
+    source = page_lines(seed, planted=planted)
+    for _ in range(pages):
+        for line in next(source):
+            document.add_paragraph(line)
+    document.save(path)
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_pdf(path, pages, seed=0, planted=None):
+    """Writes a minimal text PDF page by page, so even huge documents are cheap to generate.
+
+    planted sentences (e.g. from facts()) are mixed into the filler text.
+    """
+    offsets = {}
+    source = page_lines(seed, planted=planted)
+    with open(path, "wb") as f:
+        def obj(number, body):
+            offsets[number] = f.tell()
+            f.write(f"{number} 0 obj\n".encode("latin-1") + body + b"\nendobj\n")
+
+        f.write(b"%PDF-1.4\n")
+        obj(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        kids = []
+        for i in range(pages):
+            page_obj, content_obj = 4 + 2 * i, 5 + 2 * i
+            kids.append(f"{page_obj} 0 R")
+            text = " T* ".join(f"({_pdf_escape(line)}) Tj" for line in next(source))
+            stream = f"BT /F1 9 Tf 11 TL 36 800 Td {text} ET".encode("latin-1")
+            obj(page_obj, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                          f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_obj} 0 R >>".encode("latin-1"))
+            obj(content_obj, f"<< /Length {len(stream)} >>\nstream\n".encode("latin-1") + stream + b"\nendstream")
+        obj(2, f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode("latin-1"))
+        obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref_at = f.tell()
+        count = max(offsets) + 1
+        f.write(f"xref\n0 {count}\n0000000000 65535 f \n".encode("latin-1"))
+        for number in range(1, count):
+            f.write(f"{offsets[number]:010d} 00000 n \n".encode("latin-1"))
+        f.write(f"trailer\n<< /Size {count} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n".encode("latin-1"))
+
+WRITERS = {".txt": write_txt, ".docx": write_docx, ".pdf": write_pdf}
@@ -0,0 +1,111 @@
+"""Peak Python memory, disk traffic and time of staging one upload, streamed versus the old handler.
+
+"form" is the previous /upload: Starlette parses the form into a spooled temp file,
+shutil.copyfileobj copies it into place, and manifest.hash_file reads it back.
+"stream" is uploads.stage_multipart: one pass that writes and hashes as the body
+arrives. The body is fed in 64 KiB network-sized pieces:
+
+    python benchmarks/upload_memory.py --sizes 10 100 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BOUNDARY = b"benchmarkboundary"
+PIECE = 64 << 10
+
+def _io_counters():
+    """Bytes this process passed to read and write calls (rchar, wchar)."""
+    with open("/proc/self/io") as f:
+        fields = dict(line.split(": ") for line in f.read().splitlines())
+    return int(fields["rchar"]), int(fields["wchar"])
+
+def _request(size_mb):
+    from starlette.requests import Request
+    head = (b"--" + BOUNDARY + b'\r\nContent-Disposition: form-data; name="file"; filename="upload.txt"\r\n'
+            b"Content-Type: text/plain\r\n\r\n")
+    tail = b"\r\n--" + BOUNDARY + b"--\r\n"
+    piece = b"x" * PIECE
+    remaining = size_mb << 20
+    total = len(head) + remaining + len(tail)
+
+    async def receive():
+        nonlocal head, remaining
+        if head:
+            body, head = head, b""
+        elif remaining:
+            body = piece[:min(PIECE, remaining)]
+            remaining -= len(body)
+        else:
+            return {"type": "http.request", "body": tail, "more_body": False}
+        return {"type": "http.request", "body": body, "more_body": True}
+
+    headers = [(b"content-type", b"multipart/form-data; boundary=" + BOUNDARY),
+               (b"content-length", str(total).encode())]
+    return Request({"type": "http", "method": "POST", "path": "/upload", "headers": headers}, receive)
+
+async def _form(request, directory):
+    import manifest
+    form = await request.form(max_part_size=1 << 30)
+    upload = form["file"]
+    path = os.path.join(directory, upload.filename)
+    with open(path, "wb") as buffer:
+        shutil.copyfileobj(upload.file, buffer)
+    await form.close()
+    return manifest.hash_file(path)
+
+async def _stream(request, directory):
+    import uploads
+    return (await uploads.stage_multipart(request, directory, max_bytes=1 << 40)).content_hash
+
+def _measure(mode, size_mb):
+    with tempfile.TemporaryDirectory() as directory:
+        request = _request(size_mb)
+        read_before, written_before = _io_counters()
+        tracemalloc.start()
+        start = time.perf_counter()
+        content_hash = asyncio.run((_form if mode == "form" else _stream)(request, directory))
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        read_after, written_after = _io_counters()
+    return {
+        "mode": mode,
+        "size_mb": size_mb,
+        "seconds": seconds,
+        "peak_python_mb": peak / 2**20,
+        "read_mb": (read_after - read_before) / 2**20,
+        "written_mb": (written_after - written_before) / 2**20,
+        "content_hash": content_hash,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500], help="upload sizes in MiB")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size_mb in args.sizes:
+        for mode in ("form", "stream"):
+            row = _measure(mode, size_mb)
+            results.append(row)
+            print(f"{size_mb:5} MiB {mode:6}: {row['seconds']:6.2f}s  peak {row['peak_python_mb']:6.2f} MiB  "
+                  f"read {row['read_mb']:7.1f} MiB  written {row['written_mb']:7.1f} MiB")
+        assert results[-1]["content_hash"] == results[-2]["content_hash"]
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Memory, QPS and recall@k of Chroma's HNSW search versus the int8 vector index (flat and IVF).
+
+Vectors are a synthetic clustered stand-in for MiniLM embeddings. Exact nearest
+neighbours come from a float32 brute-force scan. Each search mode runs in a fresh
+process, so its peak RSS only covers loading that index and answering the queries:
+
+    python benchmarks/vector_search.py --vectors 200000 --queries 500 --nlist 1024
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+def _peak_rss_mb():
+    # VmHWM rather than ru_maxrss, which carries over the parent's peak across exec
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _vectors(n, dim, seed, centers=1000):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    means = rng.normal(size=(centers, dim)).astype(np.float32)
+    vectors = means[rng.integers(0, centers, n)] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def _child(mode, workdir, k):
+    import numpy as np
+    queries = np.load(os.path.join(workdir, "queries.npy"))
+    truth = np.load(os.path.join(workdir, "truth.npy"))
+    baseline = _peak_rss_mb()
+
+    if mode == "chroma":
+        import chromadb
+        collection = chromadb.PersistentClient(path=os.path.join(workdir, "chroma")).get_collection("bench")
+        search = lambda q: collection.query(query_embeddings=[q.tolist()], n_results=k, include=[])["ids"][0]
+    else:
+        import vector_index
+        index = vector_index.VectorIndex(os.path.join(workdir, mode))
+        search = lambda q: [chunk_id for chunk_id, _ in index.search(q, k)]
+
+    search(queries[0])
+    start = time.perf_counter()
+    hits = 0
+    for query, expected in zip(queries, truth):
+        found = {int(chunk_id) for chunk_id in search(query)}
+        hits += len(found & set(expected.tolist()))
+    seconds = time.perf_counter() - start
+    print(json.dumps({
+        "qps": len(queries) / seconds,
+        "recall_at_k": hits / (len(queries) * k),
+        "peak_rss_mb": _peak_rss_mb(),
+        "baseline_rss_mb": baseline,
+    }))
+
+def _dir_mb(path, names=None):
+    return sum(f.stat().st_size for f in Path(path).rglob("*")
+               if f.is_file() and (names is None or f.stem in names)) / 2**20
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=512)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--child", nargs=3, metavar=("MODE", "WORKDIR", "K"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child[0], args.child[1], int(args.child[2]))
+        return
+
+    import numpy as np
+    import chromadb
+    import vector_index
+
+    with tempfile.TemporaryDirectory() as workdir:
+        vectors = _vectors(args.vectors, args.dim, seed=0)
+        queries = vectors[np.random.default_rng(1).choice(args.vectors, args.queries, replace=False)]
+        queries = queries + 0.05 * np.random.default_rng(2).normal(size=queries.shape).astype(np.float32)
+        truth = np.stack([np.argsort(((vectors - q) ** 2).sum(axis=1))[:args.k] for q in queries])
+        np.save(os.path.join(workdir, "queries.npy"), queries)
+        np.save(os.path.join(workdir, "truth.npy"), truth)
+        ids = [str(i) for i in range(args.vectors)]
+
+        start = time.perf_counter()
+        client = chromadb.PersistentClient(path=os.path.join(workdir, "chroma"))
+        collection = client.create_collection("bench", embedding_function=None)
+        batch = client.get_max_batch_size()
+        for i in range(0, args.vectors, batch):
+            collection.add(ids=ids[i:i + batch], embeddings=vectors[i:i + batch])
+        build = {"chroma": time.perf_counter() - start}
+        del collection, client
+
+        start = time.perf_counter()
+        flat = vector_index.VectorIndex(os.path.join(workdir, "int8_flat"))
+        for i in range(0, args.vectors, 10000):
+            flat.add(ids[i:i + 10000], ["bench"] * len(ids[i:i + 10000]), vectors[i:i + 10000])
+        build["int8_flat"] = time.perf_counter() - start
+        shutil.copytree(flat.path, os.path.join(workdir, "int8_ivf"))
+        start = time.perf_counter()
+        vector_index.VectorIndex(os.path.join(workdir, "int8_ivf")).train(args.nlist)
+        build["int8_ivf"] = build["int8_flat"] + time.perf_counter() - start
+
+        scanned = {"codes", "scales", "sq_norms", "deleted", "clusters"}
+        results = []
+        for mode in ("chroma", "int8_flat", "int8_ivf"):
+            out = subprocess.run([sys.executable, __file__, "--child", mode, workdir, str(args.k)],
+                                 capture_output=True, text=True, check=True).stdout
+            row = json.loads(out.strip().splitlines()[-1])
+            row.update(mode=mode, vectors=args.vectors, build_seconds=build[mode],
+                       index_mb=_dir_mb(os.path.join(workdir, mode)))
+            if mode != "chroma":
+                # What a query has to keep hot; the float32 vectors are only read for re-ranking
+                row["scanned_mb"] = _dir_mb(os.path.join(workdir, mode), scanned)
+            results.append(row)
+            print(f"{mode:10} qps {row['qps']:8.1f}  recall@{args.k} {row['recall_at_k']:.3f}  "
+                  f"peak rss +{row['peak_rss_mb'] - row['baseline_rss_mb']:.0f} MiB  index {row['index_mb']:.0f} MiB")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
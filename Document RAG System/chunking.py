@@ -0,0 +1,248 @@
+import os
+import re
+import numpy as np
+import resources
+
+# "character" (fixed windows, the original behaviour), "token" or "sentence"
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "character")
+# Units are characters for the character strategy and embedder tokens for the others
+CHUNK_SIZE = os.getenv("CHUNK_SIZE")
+CHUNK_OVERLAP = os.getenv("CHUNK_OVERLAP")
+# Split chunks longer than the embedder's max sequence length, for every strategy ("0" turns it
+# off; character chunks are then never tokenized, and the embedder truncates the long ones)
+CHUNK_ENFORCE_MAX_TOKENS = os.getenv("CHUNK_ENFORCE_MAX_TOKENS", "1") != "0"
+
+DEFAULTS = {
+    "character": (1000, 200),
+    "token": (200, 20),
+    "sentence": (200, 30),
+}
+
+# Text is cut into chunks once this many characters are buffered, and at end of stream
+BLOCK_SIZE = 1 << 16
+
+# A sentence ends at ., ! or ? followed by whitespace, at a blank line, or at the end of the text
+_SENTENCE = re.compile(r".+?(?:[.!?](?=\s)|\n\s*\n|$)\s*", re.S)
+
+# Set once a missing tokenizer has been reported, so each block doesn't repeat it
+_TOKENIZER_WARNED = False
+
+class Chunker:
+    """Turns a stream of (text, page) segments into (chunk, pages) pairs.
+
+    Subclasses implement _cut(), which picks chunk spans in the buffered text and says
+    how much of the buffer can be dropped. When max_tokens is set, any chunk longer
+    than that (special tokens included) is split on token boundaries, so no chunk is
+    ever truncated by the embedder.
+    """
+
+    name = None
+    # True when _cut already keeps every chunk within max_tokens
+    counts_tokens = False
+
+    def __init__(self, chunk_size, overlap, max_tokens=None):
+        if overlap >= chunk_size:
+            raise ValueError(f"overlap ({overlap}) must be smaller than chunk_size ({chunk_size})")
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.max_tokens = max_tokens
+
+    @property
+    def signature(self):
+        """Identifies the chunking settings; chunk ids are only stable for equal signatures."""
+        return f"{self.name}:{self.chunk_size}:{self.overlap}:{self.max_tokens}"
+
+    def split(self, text):
+        return [chunk for chunk, _ in self.chunk_stream([(text, None)])]
+
+    def chunk_stream(self, segments):
+        buffer = ""
+        buffer_start = 0  # absolute offset of buffer[0]
+        spans = []        # (start, end, page) of segments still inside the buffer
+
+        def drain(final):
+            nonlocal buffer, buffer_start, spans
+            cuts, keep_from = self._cut(buffer, final)
+            if not self.counts_tokens:
+                cuts = self._limit_tokens(buffer, cuts)
+            for start, end in cuts:
+                abs_start, abs_end = buffer_start + start, buffer_start + end
+                pages = [page for s, e, page in spans if page is not None and s < abs_end and e > abs_start]
+                yield buffer[start:end], (min(pages), max(pages)) if pages else None
+            if keep_from:
+                buffer = buffer[keep_from:]
+                buffer_start += keep_from
+                spans = [span for span in spans if span[1] > buffer_start]
+
+        for text, page in segments:
+            if not text:
+                continue
+            buffer_end = buffer_start + len(buffer)
+            spans.append((buffer_end, buffer_end + len(text), page))
+            buffer += text
+            if len(buffer) >= BLOCK_SIZE:
+                yield from drain(final=False)
+        if buffer:
+            yield from drain(final=True)
+
+    def _cut(self, text, final):
+        """Returns ([(start, end), ...], keep_from) for the chunks that are complete in text."""
+        raise NotImplementedError
+
+    def _limit_tokens(self, text, cuts):
+        global _TOKENIZER_WARNED
+        if not self.max_tokens or not cuts:
+            return cuts
+        limit = self.max_tokens - 2  # [CLS] and [SEP]
+        # WordPiece never yields more tokens than characters, so short chunks need no tokenizing
+        long_cuts = [(s, e) for s, e in cuts if e - s > limit]
+        if not long_cuts:
+            return cuts
+        try:
+            tokenizer = resources.get_tokenizer()
+        except Exception as e:
+            # Only the character strategy gets here without a tokenizer; its chunks stay
+            # as they are and the embedder truncates the long ones
+            if not _TOKENIZER_WARNED:
+                _TOKENIZER_WARNED = True
+                print(f"Error loading tokenizer: {e}. Not splitting chunks over {self.max_tokens} tokens.")
+            return cuts
+        encoded = tokenizer([text[s:e] for s, e in long_cuts], add_special_tokens=False,
+                            return_offsets_mapping=True)
+        offsets_by_cut = dict(zip(long_cuts, encoded["offset_mapping"]))
+
+        limited = []
+        for start, end in cuts:
+            offsets = offsets_by_cut.get((start, end))
+            if offsets is None or len(offsets) <= limit:
+                limited.append((start, end))
+                continue
+            offsets = np.asarray(offsets).reshape(-1, 2)
+            window_starts = np.arange(0, len(offsets), limit)
+            window_ends = np.minimum(window_starts + limit, len(offsets)) - 1
+            piece_starts = start + offsets[window_starts, 0]
+            piece_ends = start + offsets[window_ends, 1]
+            # Keep the whitespace between pieces attached to the earlier piece
+            piece_ends[:-1] = piece_starts[1:]
+            piece_ends[-1] = end
+            piece_starts[0] = start
+            limited.extend(zip(piece_starts.tolist(), piece_ends.tolist()))
+        return limited
+
+class CharacterChunker(Chunker):
+    """Fixed character windows; identical to ingest.split_text on the concatenated text
+    apart from windows over max_tokens, which are split further (CHUNK_ENFORCE_MAX_TOKENS=0
+    keeps them whole)."""
+
+    name = "character"
+
+    def _cut(self, text, final):
+        step = self.chunk_size - self.overlap
+        if final:
+            starts = np.arange(0, len(text), step)
+        else:
+            starts = np.arange(0, max(len(text) - self.chunk_size + 1, 0), step)
+        if not len(starts):
+            return [], 0
+        ends = np.minimum(starts + self.chunk_size, len(text))
+        keep_from = 0 if final else int(starts[-1]) + step
+        return list(zip(starts.tolist(), ends.tolist())), keep_from
+
+class TokenChunker(Chunker):
+    """Windows of chunk_size embedder tokens with overlap tokens shared between neighbours."""
+
+    name = "token"
+    counts_tokens = True
+
+    def _cut(self, text, final):
+        tokenizer = resources.get_tokenizer()
+        offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+        offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+        n = len(offsets)
+        size = self.chunk_size
+        if self.max_tokens:
+            size = min(size, self.max_tokens - 2)
+        step = max(size - self.overlap, 1)
+
+        if final:
+            # Stop once a window would only repeat the previous window's overlap
+            starts = np.arange(0, max(n - self.overlap, 1), step) if n else np.arange(0)
+        else:
+            # The last token may be half a word cut at the block boundary, so never end on it
+            starts = np.arange(0, max(n - 1 - size + 1, 0), step)
+        if not len(starts):
+            return [], 0
+
+        ends = np.minimum(starts + size, n) - 1
+        cuts = list(zip(offsets[starts, 0].tolist(), offsets[ends, 1].tolist()))
+        if final:
+            return cuts, 0
+        next_start = int(starts[-1]) + step
+        return cuts, int(offsets[next_start, 0]) if next_start < n else len(text)
+
+class SentenceChunker(Chunker):
+    """Packs whole sentences up to chunk_size tokens; neighbours share up to overlap tokens of sentences."""
+
+    name = "sentence"
+    counts_tokens = True
+
+    def _cut(self, text, final):
+        # Without sentence breaks the buffer would grow forever, so past a limit cut anyway
+        flush = final or len(text) >= 4 * BLOCK_SIZE
+        bounds = np.array([m.span() for m in _SENTENCE.finditer(text)], dtype=np.int64).reshape(-1, 2)
+        if not flush:
+            # The last sentence may continue in the next block
+            bounds = bounds[:-1]
+        m = len(bounds)
+        if not m:
+            return [], 0
+
+        tokenizer = resources.get_tokenizer()
+        encoded = tokenizer([text[s:e] for s, e in bounds.tolist()], add_special_tokens=False)["input_ids"]
+        counts = np.fromiter((len(ids) for ids in encoded), dtype=np.int64, count=m)
+        cumulative = np.concatenate(([0], np.cumsum(counts)))
+        size = self.chunk_size
+        if self.max_tokens:
+            size = min(size, self.max_tokens - 2)
+
+        cuts = []
+        i = 0
+        while i < m:
+            # Furthest j with sum(counts[i:j]) <= size, at least one sentence
+            j = int(np.searchsorted(cumulative, cumulative[i] + size, side="right")) - 1
+            j = max(j, i + 1)
+            if j >= m and not flush:
+                # This chunk could still grow with the next block's sentences
+                return cuts, int(bounds[i, 0])
+            cut = (int(bounds[i, 0]), int(bounds[j - 1, 1]))
+            if j == i + 1 and counts[i] > size:
+                # A single sentence longer than the budget is split on token boundaries
+                cuts.extend(self._limit_tokens(text, [cut]))
+            else:
+                cuts.append(cut)
+            if j >= m:
+                break
+            # Step back over trailing sentences that fit in the overlap budget
+            k = int(np.searchsorted(cumulative, cumulative[j] - self.overlap, side="left"))
+            i = max(k, i + 1)
+        return cuts, len(text)
+
+STRATEGIES = {
+    "character": CharacterChunker,
+    "token": TokenChunker,
+    "sentence": SentenceChunker,
+}
+
+def get_chunker(strategy=None, chunk_size=None, overlap=None, max_tokens=None):
+    """Builds a chunker from arguments, falling back to the CHUNK_* environment settings."""
+    strategy = strategy or CHUNK_STRATEGY
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown chunking strategy {strategy!r}; choose from {', '.join(STRATEGIES)}")
+    default_size, default_overlap = DEFAULTS[strategy]
+    if chunk_size is None:
+        chunk_size = int(CHUNK_SIZE) if CHUNK_SIZE else default_size
+    if overlap is None:
+        overlap = int(CHUNK_OVERLAP) if CHUNK_OVERLAP else default_overlap
+    if max_tokens is None and CHUNK_ENFORCE_MAX_TOKENS:
+        max_tokens = resources.MAX_SEQ_LENGTH
+    return STRATEGIES[strategy](chunk_size, overlap, max_tokens=max_tokens)
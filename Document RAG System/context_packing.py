@@ -0,0 +1,199 @@
+import os
+import re
+import threading
+import resources
+
+# Merge adjacent chunks of a source and drop near-duplicate passages before prompting
+CONTEXT_PACKING = os.getenv("CONTEXT_PACKING", "1") == "1"
+# Most embedder tokens of retrieved text (passage headers included) per prompt; 0 for no limit
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+# Share of a passage's word shingles already in a better-ranked passage that makes it a duplicate
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+
+# Shortest suffix/prefix match (characters) taken as the overlap between adjacent chunks
+MIN_OVERLAP = 20
+# Words per shingle for near-duplicate detection
+SHINGLE_WORDS = 3
+# A passage that does not fit the budget is cut down only if this many tokens are left for it
+MIN_TRIM_TOKENS = 32
+
+_WORD = re.compile(r"\w+")
+
+class Passage:
+    """One block of prompt context: a run of adjacent chunks of one source, overlaps removed."""
+
+    def __init__(self, index, document, metadata):
+        self.source = metadata.get("source", "Unknown")
+        self.chunk_ids = [metadata.get("chunk_id", "Unknown")]
+        self.pages = [p for p in (metadata.get("page_start"), metadata.get("page_end")) if p]
+        self.text = document
+        # Positions (in retrieval order) of the chunks this passage stands for, duplicates included
+        self.members = [index]
+
+    def follows(self, other):
+        last = other.chunk_ids[-1]
+        return (self.source == other.source and isinstance(last, int)
+                and self.chunk_ids[0] == last + 1)
+
+    def absorb(self, other):
+        """Appends the next chunk of the same source, dropping the text both share."""
+        self.text = _join(self.text, other.text)
+        self.chunk_ids += other.chunk_ids
+        self.pages += other.pages
+        self.members += other.members
+
+    def header(self, number):
+        chunks = self.chunk_ids
+        if len(chunks) == 1:
+            location = f"Chunk {chunks[0]}"
+        else:
+            location = f"Chunks {chunks[0]}-{chunks[-1]}"
+        if self.pages:
+            first, last = min(self.pages), max(self.pages)
+            location = (f"Page {first}" if first == last else f"Pages {first}-{last}") + f", {location}"
+        return f"[{number}] Source: {self.source} ({location})"
+
+def _join(left, right):
+    """Two consecutive slices of one text, joined without the text they share.
+
+    Usually the start of right repeats the end of left (the chunk overlap), but a chunk
+    split to fit the embedder can also lie wholly inside the next chunk. Both are found
+    by locating left's last MIN_OVERLAP characters in right; without a match the slices
+    simply abut.
+    """
+    probe = left[-MIN_OVERLAP:]
+    if len(probe) < MIN_OVERLAP:
+        return left + right
+    joined = None
+    position = right.find(probe)
+    while position != -1:
+        end = position + MIN_OVERLAP  # where left ends, measured in right
+        if end <= len(left) and left.endswith(right[:end]):
+            joined = left + right[end:]
+        elif end > len(left) and right[end - len(left):end] == left:
+            joined = right
+        position = right.find(probe, position + 1)
+    # The last consistent match is the longest shared stretch
+    return joined if joined is not None else left + right
+
+def _shingles(text):
+    words = _WORD.findall(text.lower())
+    if len(words) < SHINGLE_WORDS:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+def _legacy_block(document, metadata):
+    """A chunk as the prompt used to carry it, one block per chunk; the baseline for tokens saved."""
+    page = metadata.get("page_start")
+    chunk_id = metadata.get("chunk_id", "Unknown")
+    location = f"Page {page}, Chunk {chunk_id}" if page else f"Chunk {chunk_id}"
+    return f"---\nSource: {metadata.get('source', 'Unknown')} ({location})\nContent: {document}\n"
+
+class PackedContext:
+    """Context text for the prompt, plus which numbered passage each retrieved chunk ended up in.
+
+    citations[i] is the [n] of the passage that carries retrieved chunk i (merged into it,
+    or dropped as its near-duplicate), or None when the token budget left the chunk out.
+    """
+
+    def __init__(self, text, citations, stats):
+        self.text = text
+        self.citations = citations
+        self.stats = stats
+
+def _merge(documents, metadatas):
+    """Passages in retrieval order of their best chunk, adjacent chunks of a source merged."""
+    passages = [Passage(i, d, m or {}) for i, (d, m) in enumerate(zip(documents, metadatas))]
+    if not CONTEXT_PACKING:
+        return passages
+    position = lambda p: (p.source, p.chunk_ids[0] if isinstance(p.chunk_ids[0], int) else -1)
+    merged = []
+    for passage in sorted(passages, key=position):
+        if merged and passage.follows(merged[-1]):
+            merged[-1].absorb(passage)
+        else:
+            merged.append(passage)
+    return sorted(merged, key=lambda p: min(p.members))
+
+def _dedupe(passages):
+    """Drops passages mostly contained in a better-ranked one; their chunks cite that one."""
+    if not CONTEXT_PACKING:
+        return passages, 0
+    kept, seen, dropped = [], [], 0
+    for passage in passages:
+        shingles = _shingles(passage.text)
+        for other, other_shingles in zip(kept, seen):
+            if len(shingles & other_shingles) >= NEAR_DUPLICATE_THRESHOLD * len(shingles):
+                other.members += passage.members
+                dropped += 1
+                break
+        else:
+            kept.append(passage)
+            seen.append(shingles)
+    return kept, dropped
+
+def _trim(text, tokens):
+    """text cut after its first `tokens` embedder tokens, at the last whitespace before the cut."""
+    try:
+        offsets = resources.get_tokenizer()(text, add_special_tokens=False,
+                                            return_offsets_mapping=True)["offset_mapping"]
+        end = offsets[tokens - 1][1] if len(offsets) > tokens else len(text)
+    except Exception:
+        end = tokens * 4
+    space = text.rfind(" ", 0, end)
+    return text[:space if space > end // 2 else end].rstrip() + " ..."
+
+def pack(documents, metadatas, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Builds the prompt context for retrieved chunks (in rank order)."""
+    passages, duplicates = _dedupe(_merge(documents, metadatas))
+    blocks = [f"{p.header(n)}\n{p.text}" for n, p in enumerate(passages, 1)]
+    legacy = "".join(_legacy_block(d, m or {}) for d, m in zip(documents, metadatas))
+    counts = resources.count_tokens([legacy] + blocks)
+    unpacked_tokens, block_tokens = counts[0], counts[1:]
+
+    citations = [None] * len(documents)
+    included, used, trimmed = [], 0, 0
+    for number, (passage, block, tokens) in enumerate(zip(passages, blocks, block_tokens), 1):
+        remaining = token_budget - used if token_budget > 0 else tokens
+        if tokens > remaining:
+            if remaining < MIN_TRIM_TOKENS and included:
+                break
+            block = _trim(block, max(remaining, MIN_TRIM_TOKENS))
+            tokens = min(tokens, max(remaining, MIN_TRIM_TOKENS))
+            trimmed += 1
+        included.append(block)
+        used += tokens
+        for member in passage.members:
+            citations[member] = number
+
+    stats = {
+        "chunks": len(documents),
+        "passages": len(included),
+        "merged": len(documents) - len(passages) - duplicates,
+        "duplicates": duplicates,
+        "dropped": len(passages) - len(included),
+        "trimmed": trimmed,
+        "unpacked_tokens": unpacked_tokens,
+        "context_tokens": used,
+        "tokens_saved": max(unpacked_tokens - used, 0),
+    }
+    _record(stats)
+    return PackedContext("\n\n".join(included), citations, stats)
+
+_STATS = {"requests": 0, "chunks": 0, "passages": 0, "merged": 0, "duplicates": 0, "dropped": 0,
+          "trimmed": 0, "unpacked_tokens": 0, "context_tokens": 0, "tokens_saved": 0}
+_STATS_LOCK = threading.Lock()
+
+def _record(stats):
+    with _STATS_LOCK:
+        _STATS["requests"] += 1
+        for key, value in stats.items():
+            _STATS[key] += value
+
+def get_stats():
+    """Totals over all packed prompts, with the share of context tokens saved."""
+    with _STATS_LOCK:
+        stats = dict(_STATS)
+    stats["saved_fraction"] = stats["tokens_saved"] / stats["unpacked_tokens"] if stats["unpacked_tokens"] else 0.0
+    stats["average_tokens_saved"] = stats["tokens_saved"] / stats["requests"] if stats["requests"] else 0.0
+    return stats
@@ -0,0 +1,364 @@
+import heapq
+import itertools
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+import numpy as np
+from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+
+# Gather concurrent embed calls (queries and ingestion) into shared model batches
+EMBED_BATCHING = os.getenv("EMBED_BATCHING", "1") == "1"
+# How long (ms) the first request of a batch waits for others to join it
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "2"))
+# Most texts encoded in one model call; bigger requests are split
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "64"))
+# Model runtime: "torch", "int8" (torch dynamic quantization) or "onnx" (ONNX Runtime)
+EMBED_RUNTIME = os.getenv("EMBED_RUNTIME", "torch")
+# ONNX file in the model repo, e.g. onnx/model_qint8_avx2.onnx for int8 weights; empty for the default
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "")
+# Unix socket of a shared embedding sidecar (python embedding_service.py); empty embeds in-process
+EMBED_SOCKET = os.getenv("EMBED_SOCKET", "")
+
+# Requests of at most this many texts (queries) are batched ahead of bulk ingestion pieces
+SMALL_REQUEST_TEXTS = 8
+
+def load_model(model_name, runtime=EMBED_RUNTIME):
+    """Loads the SentenceTransformer for CPU inference with the given runtime."""
+    from sentence_transformers import SentenceTransformer
+    if runtime == "onnx":
+        # Needs sentence-transformers >= 3.2 with optimum and onnxruntime installed
+        model_kwargs = {"file_name": EMBED_ONNX_FILE} if EMBED_ONNX_FILE else None
+        return SentenceTransformer(model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+    model = SentenceTransformer(model_name, device="cpu")
+    if runtime == "int8":
+        import torch
+        torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif runtime != "torch":
+        raise ValueError(f"Unknown EMBED_RUNTIME {runtime!r}; expected torch, int8 or onnx")
+    return model
+
+class _Request:
+    __slots__ = ("texts", "vectors", "error", "done", "submitted")
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.vectors = None
+        self.error = None
+        self.done = threading.Event()
+        self.submitted = time.perf_counter()
+
+def _bucket(size):
+    """Histogram bucket of a batch size: 1, 2, 3-4, 5-8, ..."""
+    if size <= 2:
+        return str(size)
+    upper = 1 << (size - 1).bit_length()
+    return f"{upper // 2 + 1}-{upper}"
+
+class MicroBatcher:
+    """Encodes texts from many threads in shared batches on one model.
+
+    A batch opens when a request arrives and closes after window_ms or once it holds
+    max_batch texts, whichever comes first; one background thread runs the model on
+    each closed batch. The window is only waited out while requests arrive faster than
+    one per window (smoothed), so a lone query is not delayed for company that will
+    not come; requests arriving during a model call still share the next one. Small
+    requests (queries) are taken before pieces of bulk ingestion, so a large upload
+    does not hold up interactive queries by more than one batch.
+    """
+
+    def __init__(self, model, window_ms=EMBED_BATCH_WINDOW_MS, max_batch=EMBED_MAX_BATCH, runtime=EMBED_RUNTIME):
+        self.model = model
+        self.window = window_ms / 1000
+        self.max_batch = max(max_batch, 1)
+        self.runtime = runtime
+        self._pending = []
+        self._pending_texts = 0
+        self._sequence = itertools.count()
+        self._last_arrival = None
+        self._arrival_gap = float("inf")
+        self._cond = threading.Condition()
+        self._stats = {"requests": 0, "texts": 0, "batches": 0, "encode_seconds": 0.0, "wait_seconds": 0.0}
+        self._histogram = {}
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._thread.start()
+
+    def embed(self, texts):
+        """Returns one float32 vector per text, in order."""
+        texts = list(texts)
+        if not texts:
+            return []
+        pieces = [_Request(texts[i:i + self.max_batch]) for i in range(0, len(texts), self.max_batch)]
+        priority = 0 if len(texts) <= SMALL_REQUEST_TEXTS else 1
+        with self._cond:
+            for piece in pieces:
+                heapq.heappush(self._pending, (priority, next(self._sequence), piece))
+                self._pending_texts += len(piece.texts)
+            self._stats["requests"] += 1
+            now = time.perf_counter()
+            if self._last_arrival is not None:
+                gap = now - self._last_arrival
+                self._arrival_gap = gap if self._arrival_gap == float("inf") else 0.8 * self._arrival_gap + 0.2 * gap
+            self._last_arrival = now
+            self._cond.notify()
+        vectors = []
+        for piece in pieces:
+            piece.done.wait()
+            if piece.error is not None:
+                raise piece.error
+            vectors += piece.vectors
+        return vectors
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = time.perf_counter() + self.window
+            while self._pending_texts < self.max_batch and self._arrival_gap < self.window:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, size = [], 0
+            while self._pending and (not batch or size + len(self._pending[0][2].texts) <= self.max_batch):
+                request = heapq.heappop(self._pending)[2]
+                batch.append(request)
+                size += len(request.texts)
+            self._pending_texts -= size
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            texts = [text for request in batch for text in request.texts]
+            start = time.perf_counter()
+            try:
+                vectors = np.asarray(self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True,
+                                                       normalize_embeddings=False), dtype=np.float32)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+            seconds = time.perf_counter() - start
+            offset = 0
+            for request in batch:
+                request.vectors = list(vectors[offset:offset + len(request.texts)])
+                offset += len(request.texts)
+                request.done.set()
+            with self._cond:
+                self._stats["texts"] += len(texts)
+                self._stats["batches"] += 1
+                self._stats["encode_seconds"] += seconds
+                self._stats["wait_seconds"] += sum(start - request.submitted for request in batch)
+                bucket = _bucket(len(texts))
+                self._histogram[bucket] = self._histogram.get(bucket, 0) + 1
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            histogram = dict(self._histogram)
+            stats["pending_texts"] = self._pending_texts
+        batches, texts = stats["batches"], stats["texts"]
+        stats["runtime"] = self.runtime
+        stats["window_ms"] = self.window * 1000
+        stats["max_batch"] = self.max_batch
+        stats["average_batch"] = texts / batches if batches else 0.0
+        # While encoding, and over the batcher's lifetime
+        stats["embeddings_per_second"] = texts / stats["encode_seconds"] if stats["encode_seconds"] else 0.0
+        stats["embeddings_per_second_overall"] = texts / (time.perf_counter() - self._started)
+        wait_seconds = stats.pop("wait_seconds")
+        stats["average_wait_ms"] = wait_seconds / batches * 1000 if batches else 0.0
+        stats["batch_size_histogram"] = dict(sorted(histogram.items(), key=lambda item: int(item[0].split("-")[0])))
+        return stats
+
+def _send(stream, payload):
+    stream.write(struct.pack(">I", len(payload)) + payload)
+
+def _receive(stream):
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    (length,) = struct.unpack(">I", header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        raise ConnectionError("Embedding service connection closed mid-message")
+    return payload
+
+class _Handler(socketserver.StreamRequestHandler):
+    """One client connection: length-prefixed JSON requests, float32 matrices back."""
+
+    def handle(self):
+        while True:
+            try:
+                message = _receive(self.rfile)
+            except ConnectionError:
+                return
+            if message is None:
+                return
+            request = json.loads(message)
+            if request.get("op") == "stats":
+                _send(self.wfile, json.dumps(self.server.batcher.stats()).encode("utf-8"))
+            else:
+                try:
+                    vectors = np.asarray(self.server.batcher.embed(request["texts"]), dtype=np.float32)
+                except Exception as e:
+                    print(f"Error embedding for a client: {e}")
+                    _send(self.wfile, json.dumps({"error": str(e)}).encode("utf-8"))
+                else:
+                    rows, dim = vectors.shape if vectors.size else (0, 0)
+                    _send(self.wfile, json.dumps({"rows": rows, "dim": dim}).encode("utf-8"))
+                    _send(self.wfile, vectors.tobytes())
+            self.wfile.flush()
+
+class EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    """Shares one model and batcher between processes over a Unix socket."""
+
+    daemon_threads = True
+
+    def __init__(self, path, batcher):
+        if os.path.exists(path):
+            os.remove(path)
+        self.batcher = batcher
+        super().__init__(path, _Handler)
+
+class SidecarClient:
+    """Embeds through the sidecar; one persistent connection per calling thread."""
+
+    def __init__(self, path=EMBED_SOCKET):
+        self.path = path
+        self._local = threading.local()
+
+    def _stream(self):
+        stream = getattr(self._local, "stream", None)
+        if stream is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            stream = self._local.stream = sock.makefile("rwb")
+        return stream
+
+    def _reset(self):
+        stream = getattr(self._local, "stream", None)
+        self._local.stream = None
+        if stream is not None:
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    def _call(self, request):
+        payload = json.dumps(request).encode("utf-8")
+        # A connection kept from before a sidecar restart fails on first use; retry once on a new one
+        for attempt in (0, 1):
+            try:
+                stream = self._stream()
+                _send(stream, payload)
+                stream.flush()
+                reply = _receive(stream)
+                if reply is None:
+                    raise ConnectionError("Embedding service closed the connection")
+                reply = json.loads(reply)
+                data = _receive(stream) if "rows" in reply else None
+                return reply, data
+            except (OSError, ConnectionError):
+                self._reset()
+                if attempt:
+                    raise
+
+    def embed(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        reply, data = self._call({"op": "embed", "texts": texts})
+        if "error" in reply:
+            raise RuntimeError(f"Embedding service error: {reply['error']}")
+        return list(np.frombuffer(data, dtype=np.float32).reshape(reply["rows"], reply["dim"]))
+
+    def stats(self):
+        return self._call({"op": "stats"})[0]
+
+class BatchedEmbeddingFunction(SentenceTransformerEmbeddingFunction):
+    """Chroma embedding function backed by the shared batcher or the sidecar.
+
+    It keeps the sentence_transformer name and config of Chroma's own function, so
+    existing collections open with it unchanged. Without EMBED_SOCKET (or when the
+    sidecar cannot be reached) texts are embedded by this process's MicroBatcher.
+    """
+
+    def __init__(self, model_name, socket_path=EMBED_SOCKET):
+        # No super().__init__(): that would load a model even when the sidecar holds it
+        self.model_name = model_name
+        self.device = "cpu"
+        self.normalize_embeddings = False
+        self.kwargs = {}
+        self._client = SidecarClient(socket_path) if socket_path else None
+        self._model = None if self._client else get_batcher(model_name).model
+
+    def __call__(self, input):
+        if self._client is not None:
+            try:
+                return self._client.embed(input)
+            except (OSError, ConnectionError) as e:
+                print(f"Error reaching the embedding service at {self._client.path}: {e}. Embedding in-process.")
+        return get_batcher(self.model_name).embed(input)
+
+_MODELS = {}
+_BATCHERS = {}
+_BATCHERS_LOCK = threading.Lock()
+
+def _after_fork():
+    # A forked child (e.g. a query worker process) inherits the batchers but not their
+    # threads; it starts its own on first use, around the model it already has
+    global _BATCHERS_LOCK
+    _BATCHERS.clear()
+    _BATCHERS_LOCK = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def get_batcher(model_name):
+    """Returns the process-wide MicroBatcher for model_name, loading the model on first use."""
+    with _BATCHERS_LOCK:
+        if model_name not in _BATCHERS:
+            if model_name not in _MODELS:
+                _MODELS[model_name] = load_model(model_name)
+            _BATCHERS[model_name] = MicroBatcher(_MODELS[model_name])
+        return _BATCHERS[model_name]
+
+def get_stats(sidecar=True):
+    """Batching stats of this process and, with EMBED_SOCKET (and sidecar True), of the sidecar."""
+    with _BATCHERS_LOCK:
+        batchers = dict(_BATCHERS)
+    stats = {"batching": EMBED_BATCHING, "socket": EMBED_SOCKET or None,
+             "local": {name: batcher.stats() for name, batcher in batchers.items()}}
+    if sidecar and EMBED_BATCHING and EMBED_SOCKET:
+        try:
+            stats["sidecar"] = SidecarClient(EMBED_SOCKET).stats()
+        except (OSError, ConnectionError) as e:
+            stats["sidecar"] = {"error": str(e)}
+    return stats
+
+def main():
+    import argparse
+    import resources
+    parser = argparse.ArgumentParser(description="Embedding sidecar shared by the app's worker processes.")
+    parser.add_argument("--socket", default=EMBED_SOCKET or "embed.sock", help="Unix socket path to listen on")
+    parser.add_argument("--model", default=resources.MODEL_NAME)
+    args = parser.parse_args()
+
+    batcher = get_batcher(args.model)
+    server = EmbeddingServer(args.socket, batcher)
+    print(f"Embedding {args.model} ({batcher.runtime}) on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,114 @@
 import json
 import os
+import sqlite3
+import threading
 import time
 
+# Chats are stored in SQLite; the old history.json is imported once (and left in place)
+HISTORY_DB = os.getenv("HISTORY_DB", "history.sqlite3")
 HISTORY_FILE = "history.json"
 
-def _load_data():
-    if not os.path.exists(HISTORY_FILE):
-        return []
-    try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return []
-
-def _save_data(data):
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4)
-
-def get_all_chats():
-    """Returns a list of chat summaries (id, title, timestamp)."""
-    data = _load_data()
-    # Sort by timestamp descending
-    data.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
-    return [{"id": chat["id"], "title": chat.get("title", "New Chat"), "timestamp": chat.get("timestamp")} for chat in data]
+class HistoryStore:
+    """SQLite (WAL) chat store: one row per chat, so a save only writes that chat."""
+
+    def __init__(self, path=HISTORY_DB, legacy_file=HISTORY_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        # The timeout lets saves from several server processes wait for each other instead of failing
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL never corrupts the database on a crash; it may only drop the last commits on power loss
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS chats (id TEXT PRIMARY KEY, title TEXT NOT NULL, "
+                           "timestamp INTEGER NOT NULL, messages TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chats_by_timestamp ON chats (timestamp, id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS migrations (source TEXT PRIMARY KEY, migrated_at INTEGER NOT NULL)")
+        self._conn.commit()
+        if legacy_file and os.path.exists(legacy_file) and not self._migrated(legacy_file):
+            self._migrate(legacy_file)
+
+    def _migrated(self, legacy_file):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM migrations WHERE source = ?", (legacy_file,)).fetchone() is not None
+
+    def _migrate(self, legacy_file):
+        try:
+            with open(legacy_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Error reading {legacy_file} for migration: {e}")
+            return
+        rows = [
+            (chat["id"], chat.get("title", "New Chat"), chat.get("timestamp") or 0, json.dumps(chat.get("messages", [])))
+            for chat in data if "id" in chat
+        ]
+        with self._lock, self._conn:
+            # Chats already in the database are newer than the JSON copy
+            self._conn.executemany("INSERT OR IGNORE INTO chats (id, title, timestamp, messages) VALUES (?, ?, ?, ?)", rows)
+            # Recorded here rather than by renaming the file, which may be under version control
+            self._conn.execute("INSERT OR IGNORE INTO migrations (source, migrated_at) VALUES (?, ?)",
+                               (legacy_file, int(time.time() * 1000)))
+        print(f"Migrated {len(rows)} chats from {legacy_file} to {self.path}")
+
+    def list(self, limit=None, before=None):
+        """Newest first. before=(timestamp, id) of the last chat of the previous page continues after it."""
+        where, params = "", []
+        if before is not None:
+            # Keyset pagination: the index seeks straight to the page, however deep it is
+            where, params = "WHERE (timestamp, id) < (?, ?)", list(before)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, title, timestamp FROM chats {where} ORDER BY timestamp DESC, id DESC LIMIT ?",
+                params + [-1 if limit is None else limit]
+            ).fetchall()
+        return [{"id": row[0], "title": row[1], "timestamp": row[2]} for row in rows]
+
+    def get(self, chat_id):
+        with self._lock:
+            row = self._conn.execute("SELECT id, title, timestamp, messages FROM chats WHERE id = ?",
+                                     (chat_id,)).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "title": row[1], "messages": json.loads(row[3]), "timestamp": row[2]}
+
+    def save(self, chat_id, title, messages):
+        row = (chat_id, title, int(time.time() * 1000), json.dumps(messages))
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO chats (id, title, timestamp, messages) VALUES (?, ?, ?, ?)", row)
+
+    def delete(self, chat_id):
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,)).rowcount > 0
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+def get_history_store():
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None:
+            _STORE = HistoryStore()
+        return _STORE
+
+def get_all_chats(limit=None, before=None):
+    """Returns chat summaries (id, title, timestamp), newest first.
+
+    Pass limit for one page, and the (timestamp, id) of its last chat as before for the next.
+    """
+    return get_history_store().list(limit, before)
 
 def get_chat(chat_id):
     """Returns the full chat object for a given ID."""
-    data = _load_data()
-    for chat in data:
-        if chat["id"] == chat_id:
-            return chat
-    return None
+    return get_history_store().get(chat_id)
 
 def save_chat(chat_id, title, messages):
     """Upserts a chat session."""
-    data = _load_data()
-    chat_found = False
-    
-    # Update existing chat
-    for chat in data:
-        if chat["id"] == chat_id:
-            chat["title"] = title
-            chat["messages"] = messages
-            chat["timestamp"] = int(time.time() * 1000) # Update timestamp on save
-            chat_found = True
-            break
-    
-    # Create new chat if not found
-    if not chat_found:
-        new_chat = {
-            "id": chat_id,
-            "title": title,
-            "messages": messages,
-            "timestamp": int(time.time() * 1000)
-        }
-        data.append(new_chat)
-    
-    _save_data(data)
+    get_history_store().save(chat_id, title, messages)
 
 def delete_chat(chat_id):
     """Deletes a chat session by ID."""
-    data = _load_data()
-    initial_len = len(data)
-    data = [chat for chat in data if chat["id"] != chat_id]
-    
-    if len(data) < initial_len:
-        _save_data(data)
-        return True
-    return False
+    return get_history_store().delete(chat_id)
@@ -1,55 +1,153 @@
+import io
 import os
 import glob
-import chromadb
-from chromadb.utils import embedding_functions
-from sentence_transformers import SentenceTransformer
-import pypdf
-import docx
+import threading
+import time
+import resources
+import answer_cache
+import manifest
+import chunking
+import lexical_index
+import vector_index
+import scoped_search
+import telemetry
 
-CHROMA_PATH = "chroma_db"
-COLLECTION_NAME = "rag_collection"
-MODEL_NAME = "all-MiniLM-L6-v2"
-_EF = None
+CHROMA_PATH = resources.CHROMA_PATH
+COLLECTION_NAME = resources.COLLECTION_NAME
+MODEL_NAME = resources.MODEL_NAME
 
-def parse_pdf(file_path):
-    text = ""
+# Seconds the on-disk index size is cached for before the chroma directory is walked again
+INDEX_SIZE_TTL = float(os.getenv("INDEX_SIZE_TTL", "30"))
+
+# Characters read per TXT segment, and chunks upserted per batch, while streaming a file
+TXT_BLOCK_SIZE = 1 << 16
+# Read-ahead when parsing from an in-memory or memory-mapped buffer
+BUFFER_READ_SIZE = 1 << 16
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+
+_STATS_LOCK = threading.Lock()
+_SOURCE_COUNTS = None
+_INDEX_SIZE = 0
+_INDEX_SIZE_AT = 0.0
+# Latest manifest change this process has applied to its caches (see apply_external_changes)
+_SEEN_GENERATION = None
+_SEEN_LOCK = threading.Lock()
+
+class BufferReader(io.RawIOBase):
+    """Seekable read-only file over a bytes-like object (bytes, bytearray, memoryview, mmap).
+
+    Reads copy only the bytes asked for, never the whole buffer.
+    """
+
+    def __init__(self, buffer):
+        self._base = memoryview(buffer)
+        self._view = self._base.cast("B")
+        self._position = 0
+
+    def close(self):
+        # Release the views so an mmap passed in can be closed afterwards
+        if not self.closed:
+            self._view.release()
+            self._base.release()
+        super().close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target):
+        n = max(min(len(target), len(self._view) - self._position), 0)
+        target[:n] = self._view[self._position:self._position + n]
+        self._position += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(base + offset, 0)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+def open_source(source):
+    """A binary file object for a path, or for a bytes-like buffer without copying it."""
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, "rb")
+    return io.BufferedReader(BufferReader(source), buffer_size=BUFFER_READ_SIZE)
+
+def _describe(source):
+    return source if isinstance(source, (str, os.PathLike)) else f"<{len(memoryview(source))} byte buffer>"
+
+def iter_pdf_pages(source):
+    """Yields (text, page_number) for each page of a PDF, one page at a time."""
     try:
-        reader = pypdf.PdfReader(file_path)
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
+        # Imported here, like docx below, so importing ingest (and the app) stays fast
+        import pypdf
+        with open_source(source) as f:
+            reader = pypdf.PdfReader(f)
+            for page_number, page in enumerate(reader.pages, start=1):
+                yield page.extract_text() + "\n", page_number
+                # pypdf keeps every object it has parsed; drop them so memory stays flat across pages
+                reader.resolved_objects.clear()
     except Exception as e:
-        print(f"Error reading PDF {file_path}: {e}")
-    return text
+        print(f"Error reading PDF {_describe(source)}: {e}")
+        telemetry.ERRORS.inc(where="parse")
 
-def parse_docx(file_path):
-    text = ""
+def iter_docx_paragraphs(source):
     try:
-        doc = docx.Document(file_path)
-        for para in doc.paragraphs:
-            text += para.text + "\n"
+        import docx
+        with open_source(source) as f:
+            doc = docx.Document(f)
+            for para in doc.paragraphs:
+                yield para.text + "\n", None
     except Exception as e:
-        print(f"Error reading DOCX {file_path}: {e}")
-    return text
+        print(f"Error reading DOCX {_describe(source)}: {e}")
+        telemetry.ERRORS.inc(where="parse")
 
-def parse_txt(file_path):
+def iter_txt_blocks(source, block_size=TXT_BLOCK_SIZE):
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return f.read()
+        with io.TextIOWrapper(open_source(source), encoding="utf-8") as f:
+            for block in iter(lambda: f.read(block_size), ""):
+                yield block, None
     except Exception as e:
-        print(f"Error reading TXT {file_path}: {e}")
-        return ""
+        print(f"Error reading TXT {_describe(source)}: {e}")
+        telemetry.ERRORS.inc(where="parse")
 
-def load_file(file_path):
-    ext = os.path.splitext(file_path)[1].lower()
+def iter_segments(source, filename=None):
+    """Yields (text, page_number or None) segments of a supported file.
+
+    source is a path, or the file's bytes as a bytes-like object (e.g. an upload's
+    memoryview or an mmap), which is parsed in place; filename then gives its type.
+    """
+    if filename is None:
+        if not isinstance(source, (str, os.PathLike)):
+            raise ValueError("filename is required to parse a buffer")
+        filename = source
+    ext = os.path.splitext(filename)[1].lower()
     if ext == ".pdf":
-        return parse_pdf(file_path)
+        return iter_pdf_pages(source)
     elif ext == ".docx":
-        return parse_docx(file_path)
+        return iter_docx_paragraphs(source)
     elif ext == ".txt":
-        return parse_txt(file_path)
+        return iter_txt_blocks(source)
     else:
         print(f"Unsupported file type: {ext}")
-        return ""
+        return iter(())
+
+def parse_pdf(file_path):
+    return "".join(text for text, _ in iter_pdf_pages(file_path))
+
+def parse_docx(file_path):
+    return "".join(text for text, _ in iter_docx_paragraphs(file_path))
+
+def parse_txt(file_path):
+    return "".join(text for text, _ in iter_txt_blocks(file_path))
+
+def load_file(source, filename=None):
+    """Full text of a file given as a path or as a buffer (see iter_segments)."""
+    return "".join(text for text, _ in iter_segments(source, filename))
 
 def split_text(text, chunk_size=1000, overlap=200):
     if not text:
@@ -63,75 +161,301 @@ def split_text(text, chunk_size=1000, overlap=200):
         start += (chunk_size - overlap)
     return chunks
 
-def ingest_file(file_path):
+def iter_chunks(source, chunker=None, filename=None):
+    """Streams (chunk, pages) for a file (path or buffer) without materializing its full text.
+
+    chunker defaults to the one configured by the CHUNK_* environment settings.
+    """
+    if chunker is None:
+        chunker = chunking.get_chunker()
+    return chunker.chunk_stream(iter_segments(source, filename))
+
+def file_key(file_path, chunker=None, content_hash=None):
+    """Content hash of the file plus the chunking settings it would be indexed with.
+
+    Pass content_hash (manifest.hash_file's SHA-256) when it is already known, e.g. from
+    the upload, to skip reading the file again.
+    """
+    if chunker is None:
+        chunker = chunking.get_chunker()
+    return f"{content_hash or manifest.hash_file(file_path)}/{chunker.signature}"
+
+def _chunk_metadata(filename, index, pages):
+    metadata = {"source": filename, "chunk_id": index}
+    if pages:
+        metadata["page_start"], metadata["page_end"] = pages
+    return metadata
+
+def _indexed_ids(filename):
+    collection = resources.get_metadata_collection()
+    if collection is None:
+        return set()
+    return set(collection.get(where={"source": filename}, include=[])["ids"])
+
+class FileUpdate:
+    """Applies one file's chunks to the index as they stream in.
+
+    Chunk ids are content hashes, so chunks whose text is already indexed are kept
+    (only their position metadata is refreshed). add() tells the caller which chunks
+    still need embedding; close() deletes ids the file no longer produces.
+    """
+
+    def __init__(self, collection, filename):
+        self.collection = collection
+        self.filename = filename
+        self.ids = []
+        self.new_count = 0
+        self._assign_id = manifest.ChunkIdAssigner(filename)
+        self._kept = []
+
+        existing = manifest.get_manifest().chunk_ids(filename)
+        if existing is None:
+            # Not in the manifest (e.g. indexed before it existed or a crashed run): ask the collection
+            existing = _indexed_ids(filename)
+        self._existing = existing
+
+    def add(self, chunk, pages=None):
+        """Returns (chunk_id, metadata, is_new) for the next chunk of the file."""
+        chunk_id = self._assign_id(chunk)
+        metadata = _chunk_metadata(self.filename, len(self.ids), pages)
+        self.ids.append(chunk_id)
+        if chunk_id in self._existing:
+            self._kept.append((chunk_id, metadata))
+            if len(self._kept) >= INGEST_BATCH_SIZE:
+                self._flush_kept()
+            return chunk_id, metadata, False
+        self.new_count += 1
+        return chunk_id, metadata, True
+
+    def close(self):
+        self._flush_kept()
+        orphans = list(self._existing - set(self.ids))
+        if orphans:
+            self.collection.delete(ids=orphans)
+            remove_from_side_indexes(self.filename, orphans)
+        kept = len(self.ids) - self.new_count
+        print(f"{self.filename}: {self.new_count} new, {kept} unchanged, {len(orphans)} removed chunks")
+
+    def _flush_kept(self):
+        if self._kept:
+            self.collection.update(
+                ids=[chunk_id for chunk_id, _ in self._kept],
+                metadatas=[metadata for _, metadata in self._kept]
+            )
+            self._kept = []
+
+def finish_file_update(filename, file_hash, ids):
+    """Records the file in the manifest once all of its chunks are written."""
+    manifest.get_manifest().commit(filename, file_hash, ids)
+    on_file_ingested(filename, len(ids))
+
+def is_unchanged(filename, file_hash):
+    return manifest.get_manifest().file_hash(filename) == file_hash
+
+def add_to_side_indexes(ids, documents, metadatas, embeddings=None):
+    """Adds newly written chunks to the BM25 index (searchable after its commit()) and,
+    when VECTOR_INDEX=int8, their embeddings to the int8 vector index."""
+    sources = [metadata["source"] for metadata in metadatas]
+    lexical_index.get_lexical_index().add(ids, sources, documents)
+    if vector_index.enabled():
+        vector_index.get_vector_index().add(ids, sources, embeddings)
+
+def remove_from_side_indexes(filename, ids=None):
+    """Drops filename's chunks (or just the given ids of it) from the BM25 and vector indexes."""
+    if ids is None:
+        lexical_index.get_lexical_index().delete_source(filename)
+    else:
+        lexical_index.get_lexical_index().delete_ids(ids)
+    if vector_index.enabled():
+        vector_index.get_vector_index().delete(filename, ids)
+
+def _upsert(collection, batch):
+    ids = [chunk_id for chunk_id, _, _ in batch]
+    documents = [text for _, text, _ in batch]
+    metadatas = [metadata for _, _, metadata in batch]
+    embeddings = None
+    with telemetry.timed(telemetry.INGEST_STAGE_SECONDS, "upsert"):
+        if vector_index.enabled():
+            # The int8 index needs the vectors too, so embed here rather than inside Chroma
+            embeddings = resources.get_embedding_function()(documents)
+        collection.upsert(documents=documents, metadatas=metadatas, ids=ids, embeddings=embeddings)
+        add_to_side_indexes(ids, documents, metadatas, embeddings)
+    telemetry.CHUNKS_INGESTED.inc(len(ids))
+
+def ingest_file(file_path, progress=None, content_hash=None):
+    """Indexes one file; returns False if no text could be extracted from it.
+
+    content_hash is the file's SHA-256, if already known. progress, if given, is called as progress(stage, chunks) with stage "parsing",
+    "embedding" (before each batch is embedded and written) or "writing" (before
+    stale chunks are removed and the indexes committed), and the chunks seen so far.
+    """
+    with telemetry.request("ingest", file=os.path.basename(file_path)):
+        try:
+            return _ingest_file(file_path, progress, content_hash)
+        except Exception:
+            telemetry.FILES_INGESTED.inc(result="error")
+            raise
+
+def _ingest_file(file_path, progress, content_hash):
     filename = os.path.basename(file_path)
     print(f"Ingesting file: {filename}")
-    
-    text = load_file(file_path)
-    if not text:
+    if progress is None:
+        progress = lambda stage, chunks: None
+
+    file_hash = file_key(file_path, content_hash=content_hash)
+    if is_unchanged(filename, file_hash):
+        print(f"Skipping {filename}: unchanged since last ingest")
+        telemetry.FILES_INGESTED.inc(result="unchanged")
+        return True
+
+    progress("parsing", 0)
+    collection = resources.get_collection(create=True)
+    update = FileUpdate(collection, filename)
+
+    # Parse, chunk and upsert in bounded batches so large files never sit in memory whole
+    batch = []
+    for chunk, pages in iter_chunks(file_path):
+        chunk_id, metadata, is_new = update.add(chunk, pages)
+        if is_new:
+            batch.append((chunk_id, chunk, metadata))
+            if len(batch) >= INGEST_BATCH_SIZE:
+                progress("embedding", len(update.ids))
+                _upsert(collection, batch)
+                batch = []
+
+    if not update.ids:
         print(f"ERROR: No text extracted from {filename}")
-        return False
-    
-    chunks = split_text(text)
-    if not chunks:
-        print("ERROR: No chunks created")
+        telemetry.FILES_INGESTED.inc(result="empty")
         return False
 
-    chunked_texts = []
-    metadatas = []
-    ids = []
-    
-    for i, chunk in enumerate(chunks):
-        chunked_texts.append(chunk)
-        metadatas.append({"source": filename, "chunk_id": i})
-        ids.append(f"{filename}_{i}")
-
-    client = chromadb.PersistentClient(path=CHROMA_PATH)
-    # Use global EF if available, otherwise initialize (though it should be global ideally)
-    global _EF
-    if _EF is None:
-        _EF = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=MODEL_NAME)
-    
-    collection = client.get_or_create_collection(name=COLLECTION_NAME, embedding_function=_EF)
-
-    collection.upsert(
-        documents=chunked_texts,
-        metadatas=metadatas,
-        ids=ids
-    )
+    if batch:
+        progress("embedding", len(update.ids))
+        _upsert(collection, batch)
+    progress("writing", len(update.ids))
+    with telemetry.timed(telemetry.INGEST_STAGE_SECONDS, "commit"):
+        update.close()
+        lexical_index.get_lexical_index().commit()
+
+    finish_file_update(filename, file_hash, update.ids)
+    telemetry.FILES_INGESTED.inc(result="indexed")
     return True
 
+def on_file_ingested(filename, chunk_count):
+    """Updates cached stats and answers after filename was indexed as chunk_count chunks."""
+    _update_source_count(filename, lambda old: chunk_count)
+    answer_cache.invalidate_source(filename)
+    scoped_search.invalidate_source(filename)
+
+def apply_external_changes():
+    """Brings this process's caches (per-source counts, answers, scoped embedding blocks) up
+    to date with files ingested or deleted by other processes, e.g. when queries run in
+    QUERY_EXECUTOR=process workers and ingestion in the app process."""
+    global _SEEN_GENERATION
+    with _SEEN_LOCK:
+        generation, filenames = manifest.get_manifest().changes_since(_SEEN_GENERATION)
+        _SEEN_GENERATION = generation
+    for filename in filenames:
+        count = manifest.get_manifest().chunk_count(filename)
+        _update_source_count(filename, lambda old: count)
+        answer_cache.invalidate_source(filename)
+        scoped_search.invalidate_source(filename)
+
 def ingest_directory(directory="data"):
-    files = glob.glob(os.path.join(directory, "*"))
-    for f in files:
-        if os.path.isfile(f):
-            ingest_file(f)
+    # Bulk loads go through the parallel parse -> batched embed -> batched write pipeline
+    from ingest_pipeline import ingest_files
+    files = [f for f in glob.glob(os.path.join(directory, "*")) if os.path.isfile(f)]
+    return ingest_files(files)
+
+def _load_source_counts(from_manifest=True):
+    counts = {}
+    collection = resources.get_metadata_collection()
+    if collection is None:
+        return counts
+
+    total = collection.count()
+    if from_manifest:
+        # One query instead of a scan, as long as the manifest accounts for every chunk
+        # (it does not for collections indexed before it existed)
+        counts = manifest.get_manifest().chunk_counts()
+        if sum(counts.values()) == total:
+            return counts
+        counts = {}
+    batch_size = 5000
+    for offset in range(0, total, batch_size):
+        result = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+        for metadata in result["metadatas"]:
+            source = (metadata or {}).get("source", "Unknown")
+            counts[source] = counts.get(source, 0) + 1
+    return counts
+
+def _update_source_count(filename, update):
+    with _STATS_LOCK:
+        if _SOURCE_COUNTS is None:
+            # Nothing cached yet; the first stats call will read the real counts
+            return
+        count = update(_SOURCE_COUNTS.get(filename, 0))
+        if count:
+            _SOURCE_COUNTS[filename] = count
+        else:
+            _SOURCE_COUNTS.pop(filename, None)
 
-def get_collection_stats():
+def _index_size():
+    global _INDEX_SIZE, _INDEX_SIZE_AT
+    now = time.monotonic()
+    if now - _INDEX_SIZE_AT > INDEX_SIZE_TTL:
+        size = 0
+        for root, _, files in os.walk(CHROMA_PATH):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        _INDEX_SIZE = size
+        _INDEX_SIZE_AT = now
+    return _INDEX_SIZE
+
+def get_collection_stats(refresh=False):
+    """Returns cached document/chunk counts, per-source chunk counts and index size.
+
+    Counts are read once (from the manifest, or by scanning the collection's metadata
+    when the manifest does not cover it or refresh is set) and then kept up to date by
+    ingest_file and delete_file_embeddings, so polling this is cheap.
+    """
+    global _SOURCE_COUNTS
     try:
-        client = chromadb.PersistentClient(path=CHROMA_PATH)
-        ef = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=MODEL_NAME)
-        try:
-            collection = client.get_collection(name=COLLECTION_NAME, embedding_function=ef)
-            return collection.count()
-        except ValueError:
-            return 0
+        apply_external_changes()
+        with _STATS_LOCK:
+            if _SOURCE_COUNTS is None or refresh:
+                _SOURCE_COUNTS = _load_source_counts(from_manifest=not refresh)
+            sources = dict(_SOURCE_COUNTS)
+            index_size = _index_size()
+        return {
+            "document_count": len(sources),
+            "chunk_count": sum(sources.values()),
+            "sources": sources,
+            "index_size_bytes": index_size,
+        }
     except Exception as e:
         print(f"Error getting stats: {e}")
-        return 0
+        return {"document_count": 0, "chunk_count": 0, "sources": {}, "index_size_bytes": 0}
 
 if __name__ == "__main__":
     ingest_directory()
 
 def delete_file_embeddings(filename):
     try:
-        client = chromadb.PersistentClient(path=CHROMA_PATH)
-        ef = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=MODEL_NAME)
-        collection = client.get_collection(name=COLLECTION_NAME, embedding_function=ef)
-        
+        collection = resources.get_metadata_collection()
+        if collection is None:
+            raise ValueError(f"Collection {COLLECTION_NAME} does not exist")
+
         # Delete items where metadata 'source' matches the filename
         # Note: ChromaDB delete expects ids or where/where_document filter
         collection.delete(where={"source": filename})
+        remove_from_side_indexes(filename)
+        manifest.get_manifest().remove(filename)
+        _update_source_count(filename, lambda old: 0)
+        answer_cache.invalidate_source(filename)
+        scoped_search.invalidate_source(filename)
         return True
     except Exception as e:
         print(f"Error deleting embeddings for {filename}: {e}")
@@ -0,0 +1,272 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import ingest
+import lexical_index
+import manifest
+import resources
+import telemetry
+
+PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", str(os.cpu_count() or 1)))
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "256"))
+WRITE_BATCH_SIZE = int(os.getenv("INGEST_WRITE_BATCH_SIZE", "4096"))
+PROGRESS_INTERVAL = 5.0
+
+def _parse_file(file_path, known_hash):
+    """Runs in a worker process: hash, then parse and chunk the file if it changed."""
+    file_hash = ingest.file_key(file_path)
+    if file_hash == known_hash:
+        return file_path, file_hash, None, 0
+
+    chunks = list(ingest.iter_chunks(file_path))
+    # Non-PDF files count as a single page
+    pages = max((page_range[1] for _, page_range in chunks if page_range), default=1)
+    return file_path, file_hash, chunks, pages
+
+class _Progress:
+    """Counters updated from both the main thread and the writer thread."""
+
+    def __init__(self, total_files):
+        self.total_files = total_files
+        self.files = 0
+        self.skipped = 0
+        self.pages = 0
+        self.chunks = 0
+        self.start = time.perf_counter()
+        self._last_report = self.start
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def report(self, force=False):
+        now = time.perf_counter()
+        with self._lock:
+            if not force and now - self._last_report < PROGRESS_INTERVAL:
+                return
+            self._last_report = now
+            elapsed = max(now - self.start, 1e-9)
+            line = (f"[{self.files}/{self.total_files} files, {self.skipped} unchanged] {self.pages} pages, "
+                    f"{self.chunks} chunks | {self.pages / elapsed:.1f} pages/s, {self.chunks / elapsed:.1f} chunks/s")
+        print(line)
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        with self._lock:
+            return {
+                "files": self.files,
+                "unchanged_files": self.skipped,
+                "pages": self.pages,
+                "chunks": self.chunks,
+                "seconds": elapsed,
+                "pages_per_second": self.pages / elapsed,
+                "chunks_per_second": self.chunks / elapsed,
+            }
+
+class IngestPipeline:
+    """Parse (process pool) -> embed (batched across files) -> write (large upserts).
+
+    Parsing runs in worker processes because pypdf/python-docx are CPU bound and hold
+    the GIL. Chunks from different files are embedded together in EMBED_BATCH_SIZE
+    batches, and a writer thread upserts the precomputed embeddings in
+    WRITE_BATCH_SIZE batches while the next batch is being embedded.
+
+    Files whose content hash matches the manifest are skipped, and only chunks whose
+    text is not indexed yet are embedded. A file is committed to the manifest once
+    all of its chunks are written, so re-running after a crash resumes the work.
+    """
+
+    def __init__(self, parse_workers=PARSE_WORKERS, embed_batch_size=EMBED_BATCH_SIZE,
+                 write_batch_size=WRITE_BATCH_SIZE, force=False):
+        self.parse_workers = parse_workers
+        self.embed_batch_size = embed_batch_size
+        self.write_batch_size = write_batch_size
+        self.force = force
+        self._write_queue = queue.Queue(maxsize=2)
+        self._writer_error = None
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    def run(self, files):
+        self.progress = _Progress(len(files))
+        if not files:
+            return self.progress.summary()
+
+        self.manifest = manifest.get_manifest()
+        self.collection = resources.get_collection(create=True)
+        self.embed = resources.get_embedding_function()
+        max_batch = resources.get_client().get_max_batch_size()
+        self.write_batch_size = min(self.write_batch_size, max_batch)
+
+        writer = threading.Thread(target=self._writer, name="ingest-writer", daemon=True)
+        writer.start()
+        try:
+            self._parse_and_embed(files)
+        finally:
+            self._write_queue.put(None)
+            writer.join()
+
+        if self._writer_error is not None:
+            raise self._writer_error
+        lexical_index.get_lexical_index().commit()
+        self.progress.report(force=True)
+        return self.progress.summary()
+
+    def _parse_and_embed(self, files):
+        batch = []
+        window = max(self.parse_workers * 2, 1)
+        remaining = iter(files)
+        # Spawned, not forked: by now this process runs the writer thread and has loaded the
+        # embedder and Chroma client, whose locks a forked worker could inherit while held
+        with ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            in_flight = set()
+            while True:
+                while len(in_flight) < window:
+                    f = next(remaining, None)
+                    if f is None:
+                        break
+                    known_hash = None if self.force else self.manifest.file_hash(os.path.basename(f))
+                    in_flight.add(pool.submit(_parse_file, f, known_hash))
+                if not in_flight:
+                    break
+
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    try:
+                        file_path, file_hash, chunks, pages = future.result()
+                    except Exception as e:
+                        print(f"Error parsing file: {e}")
+                        telemetry.ERRORS.inc(where="parse")
+                        continue
+                    batch.extend(self._start_file(file_path, file_hash, chunks, pages))
+                    while len(batch) >= self.embed_batch_size:
+                        self._embed_and_queue(batch[:self.embed_batch_size])
+                        batch = batch[self.embed_batch_size:]
+                if self._writer_error is not None:
+                    return
+
+        if batch:
+            self._embed_and_queue(batch)
+
+    def _start_file(self, file_path, file_hash, chunks, pages):
+        filename = os.path.basename(file_path)
+        self.progress.add(pages=pages)
+        if chunks is None:
+            self.progress.add(skipped=1)
+            telemetry.FILES_INGESTED.inc(result="unchanged")
+            return []
+        if not chunks:
+            print(f"ERROR: No text extracted from {filename}")
+            telemetry.FILES_INGESTED.inc(result="empty")
+            return []
+
+        update = ingest.FileUpdate(self.collection, filename)
+        items = []
+        for chunk, page_range in chunks:
+            chunk_id, metadata, is_new = update.add(chunk, page_range)
+            if is_new:
+                items.append((chunk_id, chunk, metadata))
+
+        # The update is closed (dropping ids the file no longer produces) only once its new
+        # chunks are written, so a failed run never leaves the file without its old chunks
+        state = {"file_hash": file_hash, "update": update, "remaining": len(items)}
+        if not items:
+            self._finish_file(filename, state)
+            return []
+        with self._pending_lock:
+            self._pending[filename] = state
+        return items
+
+    def _embed_and_queue(self, items):
+        with telemetry.timed(telemetry.INGEST_STAGE_SECONDS, "embed"):
+            embeddings = np.asarray(self.embed([text for _, text, _ in items]), dtype=np.float32)
+        self._write_queue.put((items, embeddings))
+
+    def _writer(self):
+        ids, documents, metadatas, vectors = [], [], [], []
+        while True:
+            work = self._write_queue.get()
+            if work is not None:
+                items, embeddings = work
+                for (chunk_id, text, metadata) in items:
+                    ids.append(chunk_id)
+                    documents.append(text)
+                    metadatas.append(metadata)
+                vectors.append(embeddings)
+            if ids and (work is None or len(ids) >= self.write_batch_size):
+                if self._writer_error is None:
+                    try:
+                        self._flush(ids, documents, metadatas, np.concatenate(vectors))
+                    except Exception as e:
+                        self._writer_error = e
+                ids, documents, metadatas, vectors = [], [], [], []
+            if work is None:
+                return
+
+    def _flush(self, ids, documents, metadatas, embeddings):
+        with telemetry.timed(telemetry.INGEST_STAGE_SECONDS, "write"):
+            for start in range(0, len(ids), self.write_batch_size):
+                end = start + self.write_batch_size
+                self.collection.upsert(
+                    ids=ids[start:end],
+                    embeddings=embeddings[start:end],
+                    documents=documents[start:end],
+                    metadatas=metadatas[start:end]
+                )
+            ingest.add_to_side_indexes(ids, documents, metadatas, embeddings)
+        telemetry.CHUNKS_INGESTED.inc(len(ids))
+        self.progress.add(chunks=len(ids))
+
+        written = {}
+        for metadata in metadatas:
+            written[metadata["source"]] = written.get(metadata["source"], 0) + 1
+        for filename, count in written.items():
+            with self._pending_lock:
+                state = self._pending[filename]
+                state["remaining"] -= count
+                finished = state["remaining"] == 0
+                if finished:
+                    del self._pending[filename]
+            if finished:
+                self._finish_file(filename, state)
+        self.progress.report()
+
+    def _finish_file(self, filename, state):
+        state["update"].close()
+        ingest.finish_file_update(filename, state["file_hash"], state["update"].ids)
+        telemetry.FILES_INGESTED.inc(result="indexed")
+        self.progress.add(files=1)
+
+def ingest_files(files, **kwargs):
+    return IngestPipeline(**kwargs).run(files)
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-ingest a directory of documents into the RAG collection.")
+    parser.add_argument("directory", nargs="?", default="data")
+    parser.add_argument("--workers", type=int, default=PARSE_WORKERS, help="parser processes")
+    parser.add_argument("--embed-batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--write-batch-size", type=int, default=WRITE_BATCH_SIZE)
+    parser.add_argument("--force", action="store_true", help="re-chunk files even if their content hash is unchanged")
+    args = parser.parse_args()
+
+    files = sorted(f for f in glob.glob(os.path.join(args.directory, "*")) if os.path.isfile(f))
+    summary = ingest_files(
+        files,
+        parse_workers=args.workers,
+        embed_batch_size=args.embed_batch_size,
+        write_batch_size=args.write_batch_size,
+        force=args.force,
+    )
+    print(json.dumps(summary, indent=4))
+
+if __name__ == "__main__":
+    main()
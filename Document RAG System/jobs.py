@@ -0,0 +1,269 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import ingest
+import manifest
+
+# Ingestion jobs live in SQLite, so queued and half-done uploads survive a restart
+JOBS_DB = os.getenv("JOBS_DB", "jobs.sqlite3")
+# Worker threads ingesting at once, per server process
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Attempts per job, and the delay before the first retry (doubled for each further one)
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))
+# A running job whose worker reported no progress for this long is picked up again
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+# Longest an idle worker sleeps before checking for due retries and expired leases
+JOB_POLL_SECONDS = 1.0
+
+QUEUED, PARSING, EMBEDDING, WRITING, DONE, FAILED = "queued", "parsing", "embedding", "writing", "done", "failed"
+RUNNING_STATES = (PARSING, EMBEDDING, WRITING)
+
+_COLUMNS = "id, filename, path, content_hash, state, attempts, error, chunks, created, updated, owner"
+_FIELDS = [column.strip() for column in _COLUMNS.split(",")]
+
+def _now():
+    return int(time.time() * 1000)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _job(row):
+    """A jobs row as returned by the API; the server-side path stays internal."""
+    job = dict(zip(_FIELDS, row))
+    del job["path"]
+    return job
+
+class JobQueue:
+    """Durable queue of file ingestion jobs, worked off by a pool of threads.
+
+    A job moves queued -> parsing -> embedding -> writing -> done, or to failed once
+    JOB_MAX_ATTEMPTS attempts raised (or at once if the file has no text). Workers
+    claim jobs in an IMMEDIATE transaction, so several server processes can share one
+    database. Each progress report renews the job's lease; a job whose lease runs out
+    (its process died mid-ingest) is claimed again, and since ingest_file skips what is
+    already indexed, the retry finishes the half-indexed file.
+    """
+
+    def __init__(self, path=JOBS_DB):
+        self.path = path
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._workers = []
+        self._stopping = False
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, filename TEXT NOT NULL, "
+                           "path TEXT NOT NULL, content_hash TEXT NOT NULL, state TEXT NOT NULL, "
+                           "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, chunks INTEGER NOT NULL DEFAULT 0, "
+                           "created INTEGER NOT NULL, updated INTEGER NOT NULL, "
+                           "not_before INTEGER NOT NULL DEFAULT 0, lease_until INTEGER NOT NULL DEFAULT 0, owner TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, not_before)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_by_hash ON jobs (content_hash)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_by_created ON jobs (created, id)")
+
+    def _transaction(self, work):
+        """Runs work() inside BEGIN IMMEDIATE, which holds off other processes' writers."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work()
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def _duplicate(self, content_hash):
+        rows = self._conn.execute(f"SELECT {_COLUMNS} FROM jobs WHERE content_hash = ? AND state != ? "
+                                  "ORDER BY created DESC", (content_hash, FAILED)).fetchall()
+        for row in rows:
+            job = dict(zip(_FIELDS, row))
+            if job["state"] == DONE:
+                # A finished job only counts while its file is still indexed with this content,
+                # not deleted or overwritten by a later upload since (manifest keys are "hash/chunking")
+                indexed = manifest.get_manifest().file_hash(job["filename"])
+                if indexed is not None and indexed.split("/")[0] == content_hash and os.path.exists(job["path"]):
+                    return _job(row)
+            elif self._conn.execute("SELECT 1 FROM jobs WHERE path = ? AND created > ? AND content_hash != ? "
+                                    "AND state != ?", (job["path"], job["created"], content_hash, FAILED)).fetchone() is None:
+                # A pending job counts unless a later upload to its path will overwrite it
+                return _job(row)
+        return None
+
+    def enqueue(self, path, content_hash, staged=None):
+        """Queues ingestion of path; returns (job, duplicate).
+
+        If a pending, running or finished job already has this content hash, that job is
+        returned with duplicate True and nothing is queued. staged, if given, is a file
+        moved to path only when the job is queued (and deleted otherwise).
+        """
+        def work():
+            existing = self._duplicate(content_hash)
+            if existing is not None:
+                return existing, True
+            if staged is not None:
+                os.replace(staged, path)
+            now = _now()
+            job_id = uuid.uuid4().hex
+            self._conn.execute("INSERT INTO jobs (id, filename, path, content_hash, state, created, updated) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (job_id, os.path.basename(path), path, content_hash, QUEUED, now, now))
+            return self.get(job_id, locked=True), False
+
+        job, duplicate = self._transaction(work)
+        if duplicate and staged is not None and os.path.exists(staged):
+            os.remove(staged)
+        if not duplicate:
+            with self._wakeup:
+                self._wakeup.notify()
+        return job, duplicate
+
+    def get(self, job_id, locked=False):
+        query = lambda: self._conn.execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if locked:
+            row = query()
+        else:
+            with self._lock:
+                row = query()
+        return _job(row) if row is not None else None
+
+    def list(self, limit=50, active=False):
+        """Newest first; active=True lists only jobs still queued or running."""
+        where, params = "", []
+        if active:
+            where = f"WHERE state IN ({', '.join('?' * (len(RUNNING_STATES) + 1))})"
+            params = [QUEUED, *RUNNING_STATES]
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {_COLUMNS} FROM jobs {where} ORDER BY created DESC, id DESC LIMIT ?",
+                                      params + [limit]).fetchall()
+        return [_job(row) for row in rows]
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+    def _claim(self):
+        """Marks the oldest due job as parsing and returns it with its path, or returns None."""
+        def work():
+            now = _now()
+            while True:
+                row = self._conn.execute(
+                    f"SELECT {_COLUMNS} FROM jobs WHERE (state = ? AND not_before <= ?) "
+                    "OR (state IN (?, ?, ?) AND lease_until < ?) ORDER BY created, id LIMIT 1",
+                    (QUEUED, now, *RUNNING_STATES, now)
+                ).fetchone()
+                if row is None:
+                    return None
+                job = dict(zip(_FIELDS, row))
+                if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                    # Only reachable through an expired lease: the job keeps killing its worker
+                    self._conn.execute("UPDATE jobs SET state = ?, error = ?, updated = ? WHERE id = ?",
+                                       (FAILED, job["error"] or "Worker stopped during ingestion", now, job["id"]))
+                    continue
+                self._conn.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, chunks = 0, updated = ?, "
+                                   "lease_until = ?, owner = ? WHERE id = ?",
+                                   (PARSING, now, now + int(JOB_LEASE_SECONDS * 1000), self.owner, job["id"]))
+                job.update(state=PARSING, attempts=job["attempts"] + 1)
+                return job
+        return self._transaction(work)
+
+    def _update(self, job_id, state, chunks=None, error=None, not_before=0):
+        now = _now()
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET state = ?, chunks = COALESCE(?, chunks), error = COALESCE(?, error), "
+                               "updated = ?, not_before = ?, lease_until = ? WHERE id = ?",
+                               (state, chunks, error, now, not_before, now + int(JOB_LEASE_SECONDS * 1000), job_id))
+
+    def _run(self, job):
+        job_id = job["id"]
+        try:
+            # The hash taken while the upload streamed in saves reading the file once more
+            indexed = ingest.ingest_file(job["path"], progress=lambda state, chunks: self._update(job_id, state, chunks),
+                                         content_hash=job["content_hash"])
+        except Exception as e:
+            print(f"Error ingesting {job['filename']} (attempt {job['attempts']}): {e}")
+            if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                self._update(job_id, FAILED, error=str(e))
+            else:
+                delay = JOB_RETRY_DELAY * 2 ** (job["attempts"] - 1)
+                self._update(job_id, QUEUED, error=str(e), not_before=_now() + int(delay * 1000))
+            return
+        if indexed:
+            self._update(job_id, DONE)
+        else:
+            # Nothing to extract; retrying would not change that
+            self._update(job_id, FAILED, error="No text extracted")
+
+    def _work(self):
+        while not self._stopping:
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"Error claiming ingestion job: {e}")
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(JOB_POLL_SECONDS)
+                continue
+            self._run(job)
+
+    def _recover(self):
+        """Frees jobs left running by dead processes on this host now instead of when their lease ends."""
+        host = socket.gethostname()
+        def work():
+            rows = self._conn.execute("SELECT id, owner FROM jobs WHERE state IN (?, ?, ?)", RUNNING_STATES).fetchall()
+            for job_id, owner in rows:
+                owner_host, _, pid = (owner or "").rpartition(":")
+                # Our own pid here means a previous process that had it (e.g. pid 1 in a container)
+                if owner_host == host and pid.isdigit() and (int(pid) == os.getpid() or not _alive(int(pid))):
+                    self._conn.execute("UPDATE jobs SET lease_until = 0 WHERE id = ?", (job_id,))
+        self._transaction(work)
+
+    def start(self, workers=INGEST_WORKERS):
+        """Starts the worker threads; further calls do nothing."""
+        with self._wakeup:
+            if self._workers:
+                return
+            self._recover()
+            self._stopping = False
+            for i in range(workers):
+                thread = threading.Thread(target=self._work, name=f"ingest-{i}", daemon=True)
+                thread.start()
+                self._workers.append(thread)
+
+    def stop(self, wait=True):
+        """Stops workers after their current job; unfinished jobs stay in the queue.
+
+        With wait=False this returns at once; a job cut short by the process exiting is
+        picked up again on the next start.
+        """
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+            workers, self._workers = self._workers, []
+        if wait:
+            for thread in workers:
+                thread.join()
+
+_QUEUE = None
+_QUEUE_LOCK = threading.Lock()
+
+def get_job_queue():
+    global _QUEUE
+    with _QUEUE_LOCK:
+        if _QUEUE is None:
+            _QUEUE = JobQueue()
+        return _QUEUE
@@ -0,0 +1,400 @@
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import threading
+from collections import Counter
+from functools import lru_cache
+import numpy as np
+
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", "lexical_index")
+# Pending documents are written out as a new segment once this many accumulate
+SEGMENT_FLUSH_DOCS = int(os.getenv("LEXICAL_SEGMENT_FLUSH_DOCS", "50000"))
+# Beyond this many segments the smaller ones are merged, dropping deleted documents
+MAX_SEGMENTS = int(os.getenv("LEXICAL_MAX_SEGMENTS", "16"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Terms in more than this fraction of documents barely move BM25 scores and are skipped at query time
+MAX_DOC_FREQUENCY = 0.5
+# ...but only in an index of at least this many documents; in a small one that would drop
+# most useful terms (with one document, all of them)
+MAX_DOC_FREQUENCY_MIN_DOCS = int(os.getenv("LEXICAL_MAX_DF_MIN_DOCS", "1000"))
+
+# Words, numbers and identifiers such as "xj-9921" or "v2.1.0"; compounds are also indexed by their parts
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-_./:][a-z0-9]+)*")
+_PART = re.compile(r"[a-z0-9]+")
+
+def tokenize(text):
+    tokens = _TOKEN.findall(text.lower())
+    return tokens + [part for token in tokens if not token.isalnum() for part in _PART.findall(token)]
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+# Vocabularies are small next to token counts, so term hashes are worth memoizing
+_term_hash = lru_cache(maxsize=1 << 20)(_hash)
+
+class Segment:
+    """An immutable, memory-mapped block of postings plus a mutable deleted-documents bitmap.
+
+    term_hashes (sorted uint64) and term_offsets locate each term's run in post_docs
+    (local document numbers) and post_tfs (term frequencies).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        load = lambda name, mode="r": np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode)
+        self.term_hashes = load("term_hashes")
+        self.term_offsets = load("term_offsets")
+        self.post_docs = load("post_docs")
+        self.post_tfs = load("post_tfs")
+        self.doc_lengths = load("doc_lengths")
+        self.id_hashes = load("id_hashes")
+        self.source_hashes = load("source_hashes")
+        self.id_offsets = load("id_offsets")
+        self.deleted = load("deleted", "r+")
+        with open(os.path.join(path, "ids.bin"), "rb") as f:
+            self._ids = f.read()
+
+    @property
+    def size(self):
+        return len(self.doc_lengths)
+
+    def chunk_id(self, doc):
+        return self._ids[self.id_offsets[doc]:self.id_offsets[doc + 1]].decode("utf-8")
+
+    def postings(self, term_hash):
+        i = np.searchsorted(self.term_hashes, term_hash)
+        if i >= len(self.term_hashes) or self.term_hashes[i] != term_hash:
+            return None, None
+        start, end = self.term_offsets[i], self.term_offsets[i + 1]
+        return self.post_docs[start:end], self.post_tfs[start:end]
+
+    def delete_where(self, mask):
+        newly = mask & ~self.deleted
+        if newly.any():
+            self.deleted[newly] = True
+            self.deleted.flush()
+        return int(newly.sum())
+
+    @staticmethod
+    def write(path, ids, sources, token_lists):
+        """Builds a segment directory from parallel lists of chunk ids, sources and token lists."""
+        os.makedirs(path)
+        term_parts, doc_parts, tf_parts = [], [], []
+        for doc, tokens in enumerate(token_lists):
+            counts = Counter(tokens)
+            term_parts.append(np.fromiter((_term_hash(t) for t in counts), dtype=np.uint64, count=len(counts)))
+            tf_parts.append(np.fromiter(counts.values(), dtype=np.int64, count=len(counts)))
+            doc_parts.append(np.full(len(counts), doc, dtype=np.int32))
+        Segment._write_arrays(
+            path,
+            np.concatenate(term_parts) if term_parts else np.zeros(0, dtype=np.uint64),
+            np.concatenate(doc_parts) if doc_parts else np.zeros(0, dtype=np.int32),
+            np.concatenate(tf_parts) if tf_parts else np.zeros(0, dtype=np.int64),
+            np.array([len(tokens) for tokens in token_lists], dtype=np.int32),
+            ids,
+            np.fromiter((_hash(s) for s in sources), dtype=np.uint64, count=len(sources)),
+        )
+
+    @staticmethod
+    def _write_arrays(path, terms, docs, tfs, doc_lengths, ids, source_hashes):
+        order = np.lexsort((docs, terms))
+        terms, docs, tfs = terms[order], docs[order], np.minimum(tfs[order], np.iinfo(np.uint16).max)
+        term_hashes, starts = np.unique(terms, return_index=True)
+        encoded = [chunk_id.encode("utf-8") for chunk_id in ids]
+        save = lambda name, array: np.save(os.path.join(path, f"{name}.npy"), array)
+        save("term_hashes", term_hashes)
+        save("term_offsets", np.append(starts, len(terms)).astype(np.int64))
+        save("post_docs", docs.astype(np.int32))
+        save("post_tfs", tfs.astype(np.uint16))
+        save("doc_lengths", doc_lengths)
+        save("id_hashes", np.fromiter((_hash(i) for i in ids), dtype=np.uint64, count=len(ids)))
+        save("source_hashes", source_hashes)
+        save("id_offsets", np.concatenate(([0], np.cumsum([len(e) for e in encoded]))).astype(np.int64))
+        save("deleted", np.zeros(len(ids), dtype=bool))
+        with open(os.path.join(path, "ids.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+
+    @staticmethod
+    def merge(path, segments):
+        """Writes the live documents of several segments into one new segment."""
+        os.makedirs(path)
+        terms, docs, tfs, lengths, ids, sources = [], [], [], [], [], []
+        base = 0
+        for segment in segments:
+            live = ~np.asarray(segment.deleted)
+            remap = np.cumsum(live) - 1 + base
+            run_lengths = np.diff(segment.term_offsets)
+            seg_terms = np.repeat(np.asarray(segment.term_hashes), run_lengths)
+            seg_docs = np.asarray(segment.post_docs)
+            keep = live[seg_docs]
+            terms.append(seg_terms[keep])
+            docs.append(remap[seg_docs[keep]].astype(np.int32))
+            tfs.append(np.asarray(segment.post_tfs)[keep].astype(np.int64))
+            lengths.append(np.asarray(segment.doc_lengths)[live])
+            sources.append(np.asarray(segment.source_hashes)[live])
+            ids.extend(segment.chunk_id(doc) for doc in np.nonzero(live)[0])
+            base += int(live.sum())
+        Segment._write_arrays(path, np.concatenate(terms), np.concatenate(docs), np.concatenate(tfs),
+                              np.concatenate(lengths).astype(np.int32), ids, np.concatenate(sources))
+
+class LexicalIndex:
+    """On-disk BM25 index kept alongside the Chroma collection.
+
+    New chunks are buffered and written as immutable segments; deletions flip bits in
+    the owning segment's deleted bitmap; segments are merged once there are more than
+    MAX_SEGMENTS. Other processes' commits are picked up on the next search; writers in
+    any process hold the directory's lock file while they change segments.json.
+    """
+
+    def __init__(self, path=LEXICAL_INDEX_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._pending = ([], [], [])
+        self._segments = []
+        self._loaded_mtime = None
+        os.makedirs(path, exist_ok=True)
+        self._reload()
+
+    def _state_path(self):
+        return os.path.join(self.path, "segments.json")
+
+    def _read_state(self):
+        if not os.path.exists(self._state_path()):
+            return {"segments": [], "next": 0}
+        with open(self._state_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_state(self, state):
+        tmp = self._state_path() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self._state_path())
+        self._loaded_mtime = os.path.getmtime(self._state_path())
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        """Holds the thread lock and the index directory's lock file, then syncs with segments.json."""
+        with self._lock, open(os.path.join(self.path, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have committed or merged since the last reload, possibly
+            # within the mtime's resolution, so compare the segment names themselves
+            state = self._read_state()
+            if state["segments"] != [os.path.basename(segment.path) for segment in self._segments]:
+                self._reload(state)
+            yield state
+
+    def _reload(self, state=None):
+        state = state or self._read_state()
+        self._segments = [Segment(os.path.join(self.path, name)) for name in state["segments"]]
+        self._loaded_mtime = os.path.getmtime(self._state_path()) if os.path.exists(self._state_path()) else None
+        self._refresh_stats()
+
+    def _reload_if_changed(self):
+        if not os.path.exists(self._state_path()):
+            return
+        if os.path.getmtime(self._state_path()) != self._loaded_mtime:
+            self._reload()
+
+    def _refresh_stats(self):
+        live_docs = 0
+        live_length = 0
+        for segment in self._segments:
+            live = ~np.asarray(segment.deleted)
+            live_docs += int(live.sum())
+            live_length += int(np.asarray(segment.doc_lengths)[live].sum())
+        self.doc_count = live_docs
+        self.avg_doc_length = live_length / live_docs if live_docs else 0.0
+
+    def add(self, ids, sources, texts):
+        """Buffers chunks for indexing; they become searchable after commit()."""
+        with self._lock:
+            pending_ids, pending_sources, pending_tokens = self._pending
+            pending_ids.extend(ids)
+            pending_sources.extend(sources)
+            pending_tokens.extend(tokenize(text) for text in texts)
+            if len(pending_ids) >= SEGMENT_FLUSH_DOCS:
+                self.commit()
+
+    def commit(self):
+        """Writes buffered chunks as a new segment, merging segments if there are too many."""
+        with self._lock:
+            ids, sources, token_lists = self._pending
+            if not ids:
+                return
+            self._pending = ([], [], [])
+        with self._exclusive() as state:
+            name = f"seg_{state['next']:06d}"
+            # A chunk id that is re-added replaces its older copy
+            self._delete_mask(lambda segment: np.isin(segment.id_hashes, [_hash(i) for i in ids]))
+            Segment.write(os.path.join(self.path, name), ids, sources, token_lists)
+            state["segments"].append(name)
+            state["next"] += 1
+            self._write_state(state)
+            self._segments.append(Segment(os.path.join(self.path, name)))
+            if len(self._segments) > MAX_SEGMENTS:
+                # Merge the smaller half, so large segments are rewritten only rarely
+                by_size = sorted(self._segments, key=lambda segment: segment.size)
+                self._merge(state, by_size[:MAX_SEGMENTS // 2 + 1])
+            self._refresh_stats()
+
+    def optimize(self):
+        """Merges all segments into one, dropping deleted documents."""
+        with self._exclusive() as state:
+            if len(self._segments) > 1:
+                self._merge(state, self._segments)
+                self._refresh_stats()
+
+    def _merge(self, state, segments):
+        name = f"seg_{state['next']:06d}"
+        Segment.merge(os.path.join(self.path, name), segments)
+        merged = {os.path.basename(segment.path) for segment in segments}
+        state["segments"] = [n for n in state["segments"] if n not in merged] + [name]
+        state["next"] += 1
+        self._write_state(state)
+        self._segments = [s for s in self._segments if s not in segments]
+        self._segments.append(Segment(os.path.join(self.path, name)))
+        for old_name in merged:
+            shutil.rmtree(os.path.join(self.path, old_name), ignore_errors=True)
+
+    def _delete_mask(self, mask_for):
+        deleted = 0
+        for segment in self._segments:
+            deleted += segment.delete_where(np.asarray(mask_for(segment)))
+        return deleted
+
+    def delete_ids(self, ids):
+        if not ids:
+            return 0
+        hashes = np.fromiter((_hash(i) for i in ids), dtype=np.uint64, count=len(ids))
+        with self._exclusive():
+            deleted = self._delete_mask(lambda segment: np.isin(segment.id_hashes, hashes))
+            self._refresh_stats()
+            return deleted
+
+    def delete_source(self, source):
+        source_hash = np.uint64(_hash(source))
+        with self._exclusive():
+            deleted = self._delete_mask(lambda segment: segment.source_hashes == source_hash)
+            self._refresh_stats()
+            return deleted
+
+    def search(self, query, k=10, sources=None):
+        """Returns up to k (chunk_id, bm25_score) pairs, best first; sources, if given, limits
+        the hits to chunks of those files."""
+        source_hashes = None
+        if sources is not None:
+            source_hashes = np.fromiter((_hash(s) for s in sources), dtype=np.uint64, count=len(sources))
+        # Segments are immutable apart from their deleted bitmaps, so queries score a snapshot
+        # of the segment list outside the lock and run concurrently
+        with self._lock:
+            self._reload_if_changed()
+            segments, n, avg_doc_length = list(self._segments), self.doc_count, self.avg_doc_length
+        if not n:
+            return []
+        # Document frequencies include deleted documents, so a small index must skip the cutoff
+        # altogether rather than compare them with the live count
+        max_df = MAX_DOC_FREQUENCY * n if n >= MAX_DOC_FREQUENCY_MIN_DOCS else math.inf
+        term_hashes = [np.uint64(_term_hash(t)) for t in set(tokenize(query))]
+        per_segment = [{h: segment.postings(h) for h in term_hashes} for segment in segments]
+
+        document_frequency = {h: 0 for h in term_hashes}
+        for postings in per_segment:
+            for h, (docs, _) in postings.items():
+                if docs is not None:
+                    document_frequency[h] += len(docs)
+
+        hits = []
+        for segment, postings in zip(segments, per_segment):
+            scores = None
+            matched = []
+            for h, (docs, tfs) in postings.items():
+                df = document_frequency[h]
+                if docs is None or df > max_df:
+                    continue
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                tf = tfs.astype(np.float32)
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * segment.doc_lengths[docs] / avg_doc_length)
+                if scores is None:
+                    scores = np.zeros(segment.size, dtype=np.float32)
+                # A term's postings never repeat a document, so plain fancy-index += is safe
+                scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                matched.append(docs)
+            if scores is None:
+                continue
+            # Rank only the matched documents, not the whole segment
+            candidates = np.unique(np.concatenate(matched))
+            candidates = candidates[~segment.deleted[candidates]]
+            if source_hashes is not None:
+                candidates = candidates[np.isin(segment.source_hashes[candidates], source_hashes)]
+            candidate_scores = scores[candidates]
+            if len(candidates) > k:
+                best = np.argpartition(-candidate_scores, k)[:k]
+                candidates, candidate_scores = candidates[best], candidate_scores[best]
+            hits.extend(zip(candidate_scores.tolist(), [segment] * len(candidates), candidates.tolist()))
+
+        hits.sort(key=lambda hit: -hit[0])
+        return [(segment.chunk_id(doc), score) for score, segment, doc in hits[:k]]
+
+    def clear(self):
+        with self._exclusive() as state:
+            self._write_state({"segments": [], "next": state["next"]})
+            for name in state["segments"]:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            self._segments = []
+            self._pending = ([], [], [])
+            self._refresh_stats()
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+def get_lexical_index():
+    global _INDEX
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            _INDEX = LexicalIndex()
+        return _INDEX
+
+def rebuild_from_collection(batch_size=5000):
+    """Re-creates the lexical index from every chunk stored in the Chroma collection."""
+    import resources
+    index = get_lexical_index()
+    index.clear()
+    collection = resources.get_metadata_collection()
+    if collection is None:
+        return 0
+    total = collection.count()
+    for offset in range(0, total, batch_size):
+        result = collection.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+        index.add(result["ids"], [(m or {}).get("source", "Unknown") for m in result["metadatas"]], result["documents"])
+    index.commit()
+    index.optimize()
+    return index.doc_count
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuses ranked id lists: score(id) = sum over lists of 1 / (k + rank)."""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda chunk_id: -scores[chunk_id])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the BM25 lexical index.")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild from the Chroma collection")
+    parser.add_argument("--optimize", action="store_true", help="merge all segments into one")
+    parser.add_argument("--search", help="run a query and print the top hits")
+    args = parser.parse_args()
+    if args.rebuild:
+        print(f"Indexed {rebuild_from_collection()} chunks")
+    if args.optimize:
+        get_lexical_index().optimize()
+    if args.search:
+        for chunk_id, score in get_lexical_index().search(args.search):
+            print(f"{score:8.3f}  {chunk_id}")
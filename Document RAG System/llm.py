@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+
+# "gemini" (default), "stub" (offline, for load tests) or "http" (OpenAI-compatible server)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+
+# Stub backend: seconds before the first token, tokens streamed per second (0 = instant),
+# fraction of calls that fail, and answer length in words
+LLM_STUB_LATENCY = float(os.getenv("LLM_STUB_LATENCY", "0.05"))
+LLM_STUB_TOKENS_PER_SECOND = float(os.getenv("LLM_STUB_TOKENS_PER_SECOND", "0"))
+LLM_STUB_FAILURE_RATE = float(os.getenv("LLM_STUB_FAILURE_RATE", "0"))
+LLM_STUB_ANSWER_TOKENS = int(os.getenv("LLM_STUB_ANSWER_TOKENS", "64"))
+LLM_STUB_SEED = int(os.getenv("LLM_STUB_SEED", "0"))
+
+# HTTP backend: base URL of an OpenAI-compatible API (vLLM, llama.cpp server, Ollama, ...)
+LLM_HTTP_URL = os.getenv("LLM_HTTP_URL", "http://localhost:8080/v1")
+LLM_HTTP_MODEL = os.getenv("LLM_HTTP_MODEL", "default")
+LLM_HTTP_API_KEY = os.getenv("LLM_HTTP_API_KEY")
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "32"))
+LLM_HTTP_TIMEOUT = float(os.getenv("LLM_HTTP_TIMEOUT", "60"))
+
+class LLMError(Exception):
+    pass
+
+class LLMBackend:
+    """What rag.py needs from a language model: a full answer, or the answer as text pieces.
+
+    system is an optional system instruction sent alongside the prompt, so fixed
+    instructions need not be repeated inside every prompt.
+    """
+
+    name = None
+
+    def generate(self, prompt, system=None):
+        return "".join(self.stream(prompt, system))
+
+    def stream(self, prompt, system=None):
+        raise NotImplementedError
+
+    async def agenerate(self, prompt, system=None):
+        return await asyncio.to_thread(self.generate, prompt, system)
+
+    def describe(self):
+        return {"backend": self.name}
+
+def _chunk_text(chunk):
+    try:
+        return chunk.text
+    except ValueError:
+        # Chunks without text parts (e.g. the final finish_reason chunk) raise on .text
+        return ""
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+
+    def __init__(self, model):
+        self.model = model
+        self._system_models = {}
+        self._lock = threading.Lock()
+
+    def _model_for(self, system):
+        """The model itself, or a copy of it built once per system instruction."""
+        if not system:
+            return self.model
+        with self._lock:
+            model = self._system_models.get(system)
+            if model is None:
+                import google.generativeai as genai
+                model = genai.GenerativeModel(self.model.model_name, system_instruction=system)
+                self._system_models[system] = model
+            return model
+
+    def generate(self, prompt, system=None):
+        return self._model_for(system).generate_content(prompt).text
+
+    def stream(self, prompt, system=None):
+        for chunk in self._model_for(system).generate_content(prompt, stream=True):
+            text = _chunk_text(chunk)
+            if text:
+                yield text
+
+    def describe(self):
+        return {"backend": self.name, "model": getattr(self.model, "model_name", None)}
+
+# The value of the last "Label: value" line, i.e. the question in rag.py's prompts
+_LAST_FIELD = re.compile(r"^[ \t]*[\w ]+:[ \t]*(\S.*)$", re.M)
+
+class StubBackend(LLMBackend):
+    """Deterministic offline model for load tests and profiling.
+
+    Replies echo the prompt's question; prompts ending in "Answer:" are padded to
+    answer_tokens words drawn from the prompt, so the same prompt always gets the
+    same answer. Sleeps latency seconds before the first token, then streams at
+    tokens_per_second. failure_rate of calls raise LLMError, in a sequence fixed by seed.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency=LLM_STUB_LATENCY, tokens_per_second=LLM_STUB_TOKENS_PER_SECOND,
+                 failure_rate=LLM_STUB_FAILURE_RATE, answer_tokens=LLM_STUB_ANSWER_TOKENS, seed=LLM_STUB_SEED):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.failure_rate = failure_rate
+        self.answer_tokens = answer_tokens
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _reply(self, prompt):
+        fields = _LAST_FIELD.findall(prompt)
+        words = fields[-1].split() if fields else []
+        if prompt.rstrip().endswith("Answer:") and len(words) < self.answer_tokens:
+            vocabulary = prompt.split()
+            rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+            words += [rng.choice(vocabulary) for _ in range(self.answer_tokens - len(words))]
+        return words
+
+    def _check_failure(self):
+        with self._lock:
+            failed = self._rng.random() < self.failure_rate
+        if failed:
+            raise LLMError("Injected stub failure")
+
+    def stream(self, prompt, system=None):
+        self._check_failure()
+        time.sleep(self.latency)
+        for i, word in enumerate(self._reply(prompt)):
+            if self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            yield word if i == 0 else " " + word
+
+    def generate(self, prompt, system=None):
+        self._check_failure()
+        words = self._reply(prompt)
+        delay = self.latency + (len(words) / self.tokens_per_second if self.tokens_per_second else 0)
+        time.sleep(delay)
+        return " ".join(words)
+
+    async def agenerate(self, prompt, system=None):
+        self._check_failure()
+        words = self._reply(prompt)
+        await asyncio.sleep(self.latency + (len(words) / self.tokens_per_second if self.tokens_per_second else 0))
+        return " ".join(words)
+
+    def describe(self):
+        return {"backend": self.name, "latency": self.latency, "tokens_per_second": self.tokens_per_second,
+                "failure_rate": self.failure_rate}
+
+class HTTPBackend(LLMBackend):
+    """OpenAI-compatible /chat/completions over pooled keep-alive connections.
+
+    generate/stream use a shared httpx.Client (for rag.py's worker threads);
+    agenerate uses a shared httpx.AsyncClient, for callers on an event loop.
+    """
+
+    name = "http"
+
+    def __init__(self, base_url=LLM_HTTP_URL, model=LLM_HTTP_MODEL, api_key=LLM_HTTP_API_KEY,
+                 max_connections=LLM_HTTP_MAX_CONNECTIONS, timeout=LLM_HTTP_TIMEOUT):
+        import httpx
+        self.model = model
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        options = dict(base_url=base_url.rstrip("/"), headers=headers, limits=limits, timeout=timeout)
+        self._client = httpx.Client(**options)
+        self._async_client = httpx.AsyncClient(**options)
+
+    def _body(self, prompt, system, stream):
+        messages = [{"role": "user", "content": prompt}]
+        if system:
+            # A fixed leading system message also lets servers reuse its cached prefix
+            messages.insert(0, {"role": "system", "content": system})
+        return {"model": self.model, "messages": messages, "stream": stream}
+
+    def generate(self, prompt, system=None):
+        response = self._client.post("/chat/completions", json=self._body(prompt, system, False))
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    def stream(self, prompt, system=None):
+        with self._client.stream("POST", "/chat/completions", json=self._body(prompt, system, True)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                text = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                if text:
+                    yield text
+
+    async def agenerate(self, prompt, system=None):
+        response = await self._async_client.post("/chat/completions", json=self._body(prompt, system, False))
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    def describe(self):
+        return {"backend": self.name, "model": self.model, "url": str(self._client.base_url)}
+
+def make_backend(name=None):
+    """Builds the stub or HTTP backend; Gemini backends are built by resources.get_llm()."""
+    name = name or LLM_BACKEND
+    if name == "stub":
+        return StubBackend()
+    if name == "http":
+        return HTTPBackend()
+    raise ValueError(f"Unknown LLM backend {name!r}; choose from gemini, stub, http")
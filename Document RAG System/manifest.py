@@ -0,0 +1,125 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+# Content hashes of every ingested file and of each of its chunks
+MANIFEST_PATH = os.getenv("INGEST_MANIFEST_PATH", "ingest_manifest.sqlite3")
+
+def hash_file(file_path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ChunkIdAssigner:
+    """Content-addressed chunk ids: unchanged text keeps its id wherever it moves in the file.
+
+    Call it with each chunk of a file in order; repeated texts get an occurrence suffix.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._seen = {}
+
+    def __call__(self, chunk):
+        digest = hash_text(chunk)[:16]
+        n = self._seen.get(digest, 0)
+        self._seen[digest] = n + 1
+        return f"{self.filename}_{digest}" if n == 0 else f"{self.filename}_{digest}_{n}"
+
+_CHUNK_ID = re.compile(r"^(.*)_[0-9a-f]{16}(?:_\d+)?$", re.DOTALL)
+
+def chunk_source(chunk_id):
+    """The filename a ChunkIdAssigner id was made for, or None for ids in another format."""
+    match = _CHUNK_ID.match(chunk_id)
+    return match.group(1) if match else None
+
+def make_chunk_ids(filename, chunks):
+    assign = ChunkIdAssigner(filename)
+    return [assign(chunk) for chunk in chunks]
+
+class Manifest:
+    """SQLite record of file hashes and chunk ids, used to skip unchanged work on re-ingest."""
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, file_hash TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS chunks (filename TEXT NOT NULL, chunk_id TEXT NOT NULL, "
+                           "PRIMARY KEY (filename, chunk_id))")
+        # One row per commit or remove, so other processes can tell which files changed
+        self._conn.execute("CREATE TABLE IF NOT EXISTS changes (generation INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "filename TEXT NOT NULL, pid INTEGER NOT NULL)")
+        self._conn.commit()
+
+    def file_hash(self, filename):
+        with self._lock:
+            row = self._conn.execute("SELECT file_hash FROM files WHERE filename = ?", (filename,)).fetchone()
+        return row[0] if row else None
+
+    def chunk_ids(self, filename):
+        """Returns the chunk ids recorded for filename, or None if the file is unknown."""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM files WHERE filename = ?", (filename,)).fetchone() is None:
+                return None
+            rows = self._conn.execute("SELECT chunk_id FROM chunks WHERE filename = ?", (filename,)).fetchall()
+        return {row[0] for row in rows}
+
+    def chunk_count(self, filename):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks WHERE filename = ?", (filename,)).fetchone()[0]
+
+    def chunk_counts(self):
+        """Chunk count per recorded file."""
+        with self._lock:
+            rows = self._conn.execute("SELECT filename, COUNT(*) FROM chunks GROUP BY filename").fetchall()
+        return dict(rows)
+
+    def changes_since(self, generation):
+        """Returns (latest generation, files committed or removed by other processes since generation).
+
+        With generation None only the latest generation is looked up.
+        """
+        with self._lock:
+            latest = self._conn.execute("SELECT COALESCE(MAX(generation), 0) FROM changes").fetchone()[0]
+            if generation is None or generation >= latest:
+                return latest, []
+            rows = self._conn.execute("SELECT DISTINCT filename FROM changes WHERE generation > ? AND generation <= ? "
+                                      "AND pid != ?", (generation, latest, os.getpid())).fetchall()
+        return latest, [row[0] for row in rows]
+
+    def commit(self, filename, file_hash, ids):
+        """Records that filename (with file_hash) is now indexed as exactly these chunk ids."""
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO files (filename, file_hash) VALUES (?, ?)", (filename, file_hash))
+            self._conn.execute("DELETE FROM chunks WHERE filename = ?", (filename,))
+            self._conn.executemany("INSERT OR IGNORE INTO chunks (filename, chunk_id) VALUES (?, ?)",
+                                   [(filename, chunk_id) for chunk_id in ids])
+            self._log_change(filename)
+
+    def remove(self, filename):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM files WHERE filename = ?", (filename,))
+            self._conn.execute("DELETE FROM chunks WHERE filename = ?", (filename,))
+            self._log_change(filename)
+
+    def _log_change(self, filename):
+        self._conn.execute("INSERT INTO changes (filename, pid) VALUES (?, ?)", (filename, os.getpid()))
+
+_MANIFEST = None
+_MANIFEST_LOCK = threading.Lock()
+
+def get_manifest():
+    global _MANIFEST
+    with _MANIFEST_LOCK:
+        if _MANIFEST is None:
+            _MANIFEST = Manifest()
+        return _MANIFEST
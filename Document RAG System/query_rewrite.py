@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# Skip the rewrite LLM call for follow-ups that already read as standalone questions
+QUERY_REWRITE_SKIP = os.getenv("QUERY_REWRITE_SKIP", "1") == "1"
+# Rewritten queries remembered per (recent history, query); 0 disables the memo
+QUERY_REWRITE_CACHE_SIZE = int(os.getenv("QUERY_REWRITE_CACHE_SIZE", "1024"))
+# Embed and search the raw query while the rewrite runs, used if the rewrite comes back unchanged
+QUERY_REWRITE_SPECULATIVE = os.getenv("QUERY_REWRITE_SPECULATIVE", "0") == "1"
+
+# The rewrite prompt only sees this many trailing messages, so only they key the memo
+HISTORY_WINDOW = 5
+
+# Words that point back at earlier turns
+_REFERENCES = {
+    "it", "its", "it's", "itself", "they", "them", "their", "theirs", "this", "that", "these", "those",
+    "he", "him", "his", "she", "her", "hers", "there", "here", "former", "latter", "above", "previous",
+    "earlier", "same", "such", "another", "other", "others", "else", "more", "again", "too", "also",
+}
+# Openings of elliptical follow-ups such as "and the second one?" or "what about pricing?"
+_FOLLOW_UP = re.compile(r"^(and|but|or|so|also|then|ok|okay|what about|how about|why not|what else)\b")
+_WORD = re.compile(r"[a-z']+")
+MIN_STANDALONE_WORDS = 4
+
+def is_standalone(query_text):
+    """Cheap check that a follow-up needs no history to be understood.
+
+    False (rewrite) for short queries, follow-up openings and words referring back to
+    earlier turns. It errs towards rewriting, which is only slower, never less accurate.
+    """
+    text = query_text.strip().lower()
+    words = _WORD.findall(text)
+    if len(words) < MIN_STANDALONE_WORDS or _FOLLOW_UP.match(text):
+        return False
+    return not any(word in _REFERENCES for word in words)
+
+def _key(query_text, history):
+    recent = json.dumps(history[-HISTORY_WINDOW:], sort_keys=True)
+    return hashlib.sha256(f"{recent}\x00{query_text}".encode("utf-8")).hexdigest()
+
+class QueryRewriteMemo:
+    """Standalone-ness shortcut, LRU memo of rewrites, and counters for both."""
+
+    def __init__(self, max_entries=QUERY_REWRITE_CACHE_SIZE, skip=QUERY_REWRITE_SKIP):
+        self.max_entries = max_entries
+        self.skip = skip
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"follow_ups": 0, "skipped": 0, "memo_hits": 0, "rewrites": 0, "rewrite_seconds": 0.0,
+                       "speculative_hits": 0, "speculative_misses": 0, "speculative_seconds_saved": 0.0}
+
+    def lookup(self, query_text, history):
+        """Returns the search query if no LLM rewrite is needed, else None."""
+        with self._lock:
+            self._stats["follow_ups"] += 1
+            if self.skip and is_standalone(query_text):
+                self._stats["skipped"] += 1
+                return query_text
+            key = _key(query_text, history)
+            rewritten = self._entries.get(key)
+            if rewritten is not None:
+                self._entries.move_to_end(key)
+                self._stats["memo_hits"] += 1
+            return rewritten
+
+    def store(self, query_text, history, rewritten, seconds):
+        with self._lock:
+            self._stats["rewrites"] += 1
+            self._stats["rewrite_seconds"] += seconds
+            if self.max_entries <= 0:
+                return
+            key = _key(query_text, history)
+            self._entries[key] = rewritten
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_speculation(self, hit, seconds_saved=0.0):
+        with self._lock:
+            self._stats["speculative_hits" if hit else "speculative_misses"] += 1
+            self._stats["speculative_seconds_saved"] += seconds_saved
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        avoided = stats["skipped"] + stats["memo_hits"]
+        average = stats["rewrite_seconds"] / stats["rewrites"] if stats["rewrites"] else 0.0
+        stats["skip_rate"] = avoided / stats["follow_ups"] if stats["follow_ups"] else 0.0
+        stats["average_rewrite_seconds"] = average
+        # Each avoided rewrite saves about one average rewrite round-trip
+        stats["latency_saved_seconds"] = avoided * average + stats["speculative_seconds_saved"]
+        return stats
+
+_MEMO = None
+_MEMO_LOCK = threading.Lock()
+
+def get_rewrite_memo():
+    global _MEMO
+    with _MEMO_LOCK:
+        if _MEMO is None:
+            _MEMO = QueryRewriteMemo()
+        return _MEMO
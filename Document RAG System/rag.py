@@ -1,111 +1,439 @@
 import os
-import chromadb
-from chromadb.utils import embedding_functions
-from dotenv import load_dotenv
-import google.generativeai as genai
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import resources
+import answer_cache
+import ingest
+import lexical_index
+import vector_index
+import rerank
+import context_packing
+import llm
+import query_rewrite
+import scoped_search
+import telemetry
 
-load_dotenv()
+CHROMA_PATH = resources.CHROMA_PATH
+COLLECTION_NAME = resources.COLLECTION_NAME
+MODEL_NAME = resources.MODEL_NAME
 
-CHROMA_PATH = "chroma_db"
-COLLECTION_NAME = "rag_collection"
-MODEL_NAME = "all-MiniLM-L6-v2"
+TOP_K = 3
+# Fuse BM25 keyword hits with the vector hits; helps exact terms such as error codes and part numbers
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+# Candidates taken from each retriever before reciprocal rank fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "10"))
+# Rewrites and generations query_rag_batch runs at once
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
 
-def query_rag(query_text, history=None):
-    if history is None:
-        history = []
+# Sent as the model's system instruction rather than repeated inside every prompt
+SYSTEM_INSTRUCTION = """You are a helpful assistant. Answer the user's question based strictly on the context provided with it.
 
-    client = chromadb.PersistentClient(path=CHROMA_PATH)
-    ef = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=MODEL_NAME)
-    
-    try:
-        collection = client.get_collection(name=COLLECTION_NAME, embedding_function=ef)
-    except ValueError:
-        return {"answer": "System not initialized. Please upload documents first.", "citations": []}
-
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-         return {"answer": "API Key missing. Please check server configuration.", "citations": []}
-         
-    genai.configure(api_key=api_key)
-    available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-    model_name = next((m for m in available_models if 'gemini' in m and 'flash' in m), None)
-    if not model_name:
-        model_name = next((m for m in available_models if 'gemini' in m), None)
-    
-    if not model_name:
-        return {"answer": "No available Gemini models found.", "citations": []}
-        
-    model = genai.GenerativeModel(model_name)
+Instructions:
+1. If the user's input is a greeting (e.g., "Hello", "Hi") or small talk, reply politely and ask how you can help with their documents.
+2. If the user asks about the technical implementation (e.g., "How do you work?", "What stack is this?"), reply exactly: "I am built using Python, FastAPI, ChromaDB (Vector DB), SentenceTransformers (Embeddings), and Google Gemini (LLM)."
+3. For all other questions, answer STRICTLY based on the provided Context.
+4. If the answer is not in the Context, say: "I couldn't find any relevant information in the documents."
+5. Context passages are numbered like [1]; cite them by number when you use them."""
 
-    search_query = query_text
-    if history:
-        history_str = "\n".join([f"{msg['role']}: {msg['content']}" for msg in history[-5:]]) 
-        rewrite_prompt = f"""
-        Given the following conversation history, rewrite the last user query to be a standalone question that includes all necessary context.
-        If the query is already standalone, return it exactly as is.
-        
-        History:
-        {history_str}
-        
-        Last User Query: {query_text}
-        
-        Rewritten Query:"""
-        
-        try:
-            rewrite_response = model.generate_content(rewrite_prompt)
-            search_query = rewrite_response.text.strip()
-        except Exception as e:
-            print(f"Error rewriting query: {e}. Using original.")
-
-    results = collection.query(
-        query_texts=[search_query],
-        n_results=3
-    )
-    
-    if not results['documents'] or not results['documents'][0]:
-        return {"answer": "I couldn't find any relevant information in the documents.", "citations": []}
+_speculation_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculate")
 
-    retrieved_docs = results['documents'][0]
-    metadatas = results['metadatas'][0]
-    
-    context_str = ""
-    citations = []
-    
-    for i, doc in enumerate(retrieved_docs):
-        source = metadatas[i].get("source", "Unknown")
-        chunk_id = metadatas[i].get("chunk_id", "Unknown")
-        context_str += f"---\nSource: {source} (Chunk {chunk_id})\nContent: {doc}\n"
-        citations.append(f"{source}: Chunk {chunk_id}")
+@contextmanager
+def _timed(timings, stage):
+    """Times a query stage into timings (if given), the stage histogram and the request trace."""
+    start = time.perf_counter()
+    try:
+        with telemetry.timed(telemetry.STAGE_SECONDS, stage):
+            yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + (time.perf_counter() - start)
 
-    prompt = f"""You are a helpful assistant. Answer the user's question based strictly on the context provided below.
-    
-    Instructions:
-    1. If the user's input is a greeting (e.g., "Hello", "Hi") or small talk, reply politely and ask how you can help with their documents.
-    2. If the user asks about the technical implementation (e.g., "How do you work?", "What stack is this?"), reply exactly: "I am built using Python, FastAPI, ChromaDB (Vector DB), SentenceTransformers (Embeddings), and Google Gemini (LLM)."
-    3. For all other questions, answer STRICTLY based on the provided Context.
-    4. If the answer is not in the Context, say: "I couldn't find any relevant information in the documents."
+def _rewrite_query(model, query_text, history):
+    history_str = "\n".join([f"{msg['role']}: {msg['content']}" for msg in history[-query_rewrite.HISTORY_WINDOW:]]) 
+    rewrite_prompt = f"""
+    Given the following conversation history, rewrite the last user query to be a standalone question that includes all necessary context.
+    If the query is already standalone, return it exactly as is.
     
-    Context:
-    {context_str}
+    History:
+    {history_str}
     
-    Question: {query_text}
+    Last User Query: {query_text}
     
-    Answer:"""
+    Rewritten Query:"""
+
+    return model.generate(rewrite_prompt).strip()
+
+def _search_query(model, query_text, history, speculate=None):
+    """Returns (search_query, speculated) for a follow-up question.
+
+    Standalone questions and memoized rewrites skip the LLM. Otherwise, if speculate
+    is given (and QUERY_REWRITE_SPECULATIVE is on), it runs on the raw query during
+    the rewrite and its result is returned as speculated when the rewrite leaves the
+    query unchanged; speculated is None in every other case.
+    """
+    memo = query_rewrite.get_rewrite_memo()
+    search_query = memo.lookup(query_text, history)
+    if search_query is not None:
+        return search_query, None
+
+    future = None
+    if speculate is not None and query_rewrite.QUERY_REWRITE_SPECULATIVE:
+        future = _speculation_pool.submit(telemetry.propagate(speculate))
+    start = time.perf_counter()
+    try:
+        search_query = _rewrite_query(model, query_text, history)
+    except Exception as e:
+        print(f"Error rewriting query: {e}. Using original.")
+        telemetry.ERRORS.inc(where="rewrite")
+        search_query = query_text
+    else:
+        memo.store(query_text, history, search_query, time.perf_counter() - start)
+    if future is None:
+        return search_query, None
+
+    if search_query.strip().lower() != query_text.strip().lower():
+        future.cancel()
+        memo.record_speculation(False)
+        return search_query, None
+    waited = time.perf_counter()
+    speculated, seconds = future.result()
+    memo.record_speculation(True, max(seconds - (time.perf_counter() - waited), 0.0))
+    return search_query, speculated
+
+def _build_prompt(query_text, context):
+    """The per-request part of the prompt; the instructions go in SYSTEM_INSTRUCTION."""
+    return f"Context:\n{context.text}\n\nQuestion: {query_text}\n\nAnswer:"
+
+def _setup(model):
+    """Returns (message, collection, model); message is set when queries cannot be answered."""
+    ingest.apply_external_changes()
+    collection = resources.get_collection()
+    if collection is None:
+        return "System not initialized. Please upload documents first.", None, None
+
+    if model is None:
+        if llm.LLM_BACKEND == "gemini" and not resources.get_api_key():
+            return "API Key missing. Please check server configuration.", None, None
+
+        model = resources.get_llm()
+        if model is None:
+            return "No available Gemini models found.", None, None
+    return None, collection, model
+
+def _vector_search(collection, query_embeddings, n_results, sources=None):
+    """Same result shape as collection.query, searched in the int8 index instead of Chroma's HNSW."""
+    index = vector_index.get_vector_index()
+    return _fetch_ranked(collection, [[chunk_id for chunk_id, _ in index.search(e, n_results, sources)]
+                                      for e in query_embeddings])
+
+def _fetch_ranked(collection, ranked):
+    """collection.query's result shape for ranked chunk id lists found outside Chroma."""
+    wanted = list(dict.fromkeys(chunk_id for ids in ranked for chunk_id in ids))
+    found = {}
+    if wanted:
+        stored = collection.get(ids=wanted, include=["documents", "metadatas"])
+        found = dict(zip(stored["ids"], zip(stored["documents"], stored["metadatas"])))
+    # Ids Chroma no longer has (e.g. an interrupted delete) are skipped
+    ranked = [[chunk_id for chunk_id in ids if chunk_id in found] for ids in ranked]
+    return {
+        "ids": ranked,
+        "documents": [[found[chunk_id][0] for chunk_id in ids] for ids in ranked],
+        "metadatas": [[found[chunk_id][1] for chunk_id in ids] for ids in ranked],
+    }
+
+def _vector_hits(collection, query_embeddings, n_results, scope):
+    """Vector search in collection.query's result shape, limited to scope if given.
+
+    A scope of source files only is searched exactly from cached embeddings while it is
+    small (see scoped_search); other scopes go to the index search as a filter.
+    """
+    if scope is not None and scope.where is None:
+        ranked = scoped_search.search(collection, scope.sources, query_embeddings, n_results)
+        if ranked is not None:
+            return _fetch_ranked(collection, ranked)
+    if vector_index.enabled() and (scope is None or scope.where is None):
+        return _vector_search(collection, query_embeddings, n_results, scope.sources if scope else None)
+    return collection.query(query_embeddings=list(query_embeddings), n_results=n_results,
+                            where=scope.filter() if scope else None)
+
+def _in_scope(collection, keyword_hits, scope):
+    """The keyword hits whose chunks match the scope's metadata filter."""
+    if not keyword_hits:
+        return keyword_hits
+    kept = set(collection.get(ids=[chunk_id for chunk_id, _ in keyword_hits], where=scope.filter(),
+                              include=[])["ids"])
+    return [hit for hit in keyword_hits if hit[0] in kept]
+
+def _search(collection, search_queries, query_embeddings, timings, scope=None):
+    """Searches for several queries with one vector index call.
+
+    Returns one (ids, documents, metadatas) triple per query: at most TOP_K chunks, or
+    with RERANK=1 the chunks the cross-encoder keeps out of RERANK_CANDIDATES. scope (a
+    scoped_search.Scope) limits both the vector and the keyword search.
+    """
+    reranker = rerank.get_reranker()
+    depth = rerank.RERANK_CANDIDATES if reranker is not None else TOP_K
+    n_results = max(HYBRID_CANDIDATES, depth) if HYBRID_SEARCH else depth
+    with _timed(timings, "search"):
+        results = _vector_hits(collection, query_embeddings, n_results, scope)
+
+    hits = []
+    for i, search_query in enumerate(search_queries):
+        ids, documents, metadatas = results['ids'][i], results['documents'][i], results['metadatas'][i]
+        if HYBRID_SEARCH:
+            with _timed(timings, "lexical"):
+                keyword_hits = lexical_index.get_lexical_index().search(
+                    search_query, k=n_results, sources=scope.sources if scope else None)
+                if scope is not None and scope.where is not None:
+                    keyword_hits = _in_scope(collection, keyword_hits, scope)
+                ids, documents, metadatas = _fuse(collection, ids, documents, metadatas, keyword_hits, depth)
+        hits.append((ids[:depth], documents[:depth], metadatas[:depth]))
+
+    if reranker is not None and hits:
+        with _timed(timings, "rerank"):
+            hits = reranker.rerank(search_queries, hits)
+    return hits
+
+def _retrieval(model, search_query, query_embedding, hit, timings=None):
+    ids, documents, metadatas = hit
+    if not documents:
+        return "I couldn't find any relevant information in the documents.", None
+    with _timed(timings, "pack"):
+        context = context_packing.pack(documents, metadatas)
+    return None, {
+        "model": model,
+        "search_query": search_query,
+        "embedding": query_embedding,
+        "ids": ids,
+        "documents": documents,
+        "metadatas": metadatas,
+        "context": context,
+    }
+
+def _retrieve(query_text, history, timings, model, scope=None):
+    """Runs everything up to generation.
+
+    Returns (message, retrieval). message is set instead of retrieval when the
+    query cannot be answered; otherwise retrieval holds the model, the search
+    query and its embedding, and the retrieved ids, documents and metadatas.
+    """
+    message, collection, model = _setup(model)
+    if message:
+        return message, None
+
+    search_query, speculated = query_text, None
+    if history:
+        with _timed(timings, "rewrite"):
+            search_query, speculated = _search_query(
+                model, query_text, history, lambda: _embed_and_search(collection, query_text, None, scope))
+    if speculated is None:
+        speculated, _ = _embed_and_search(collection, search_query, timings, scope)
+
+    query_embedding, hit = speculated
+    return _retrieval(model, search_query, query_embedding, hit, timings)
+
+def _embed_and_search(collection, search_query, timings, scope=None):
+    """Returns ((query_embedding, hit), seconds) for one search query."""
+    start = time.perf_counter()
+    with _timed(timings, "embed"):
+        query_embedding = resources.get_embedding_function()([search_query])[0]
+    hit = _search(collection, [search_query], [query_embedding], timings, scope)[0]
+    return (query_embedding, hit), time.perf_counter() - start
+
+def _fuse(collection, ids, documents, metadatas, keyword_hits, limit=TOP_K):
+    """Reciprocal rank fusion of vector and BM25 rankings, cut to limit chunks."""
+    fused = lexical_index.reciprocal_rank_fusion([ids, [chunk_id for chunk_id, _ in keyword_hits]])[:limit]
+    found = {chunk_id: (document, metadata) for chunk_id, document, metadata in zip(ids, documents, metadatas)}
+    missing = [chunk_id for chunk_id in fused if chunk_id not in found]
+    if missing:
+        # Keyword-only hits still need their text and metadata
+        extra = collection.get(ids=missing, include=["documents", "metadatas"])
+        found.update(zip(extra["ids"], zip(extra["documents"], extra["metadatas"])))
+    # Ids the collection no longer has (e.g. an interrupted delete) are skipped
+    fused = [chunk_id for chunk_id in fused if chunk_id in found]
+    return fused, [found[chunk_id][0] for chunk_id in fused], [found[chunk_id][1] for chunk_id in fused]
+
+def _sources(retrieval):
+    """Retrieved chunks; citation is the [n] of the prompt passage carrying each (None if cut)."""
+    return [
+        {"source": m.get("source"), "chunk_id": m.get("chunk_id"), "page_start": m.get("page_start"),
+         "page_end": m.get("page_end"), "text": d, "citation": citation}
+        for m, d, citation in zip(retrieval["metadatas"], retrieval["documents"], retrieval["context"].citations)
+    ]
+
+def _cached_answer(retrieval):
+    cache = answer_cache.get_answer_cache()
+    if cache is None:
+        return None
+    return cache.lookup(retrieval["embedding"], retrieval["ids"])
+
+def _cache_answer(retrieval, result, generate_seconds):
+    cache = answer_cache.get_answer_cache()
+    if cache is None:
+        return
+    cited = {m.get("source") for m in retrieval["metadatas"]}
+    cache.store(retrieval["embedding"], retrieval["ids"], cited, result, generate_seconds)
+
+def _generate(query_text, retrieval, timings=None):
+    with _timed(timings, "prompt"):
+        prompt = _build_prompt(query_text, retrieval["context"])
     
     try:
-        response = model.generate_content(prompt)
-
-        return {
-            "answer": response.text,
-            "sources": [
-                {"source": m.get("source"), "chunk_id": m.get("chunk_id"), "text": d} 
-                for m, d in zip(metadatas, retrieved_docs)
-            ]
+        start = time.perf_counter()
+        with _timed(timings, "generate"):
+            answer = retrieval["model"].generate(prompt, system=SYSTEM_INSTRUCTION)
+
+        result = {
+            "answer": answer,
+            "sources": _sources(retrieval),
+            "context": retrieval["context"].stats,
         }
+        _cache_answer(retrieval, result, time.perf_counter() - start)
+        return result
             
     except Exception as e:
+        telemetry.ERRORS.inc(where="generate")
         return {"answer": f"Error generating response: {str(e)}", "sources": []}
 
+def query_rag(query_text, history=None, timings=None, model=None, sources=None, where=None):
+    """Answers query_text from the indexed documents.
+
+    sources (filenames) and where (a Chroma metadata filter) limit retrieval to matching
+    chunks; a few files are searched exactly from cached embeddings instead of the index.
+
+    If a timings dict is passed, the seconds spent in the rewrite, embed, search,
+    lexical, rerank, pack, prompt and generate stages are recorded in it (they also
+    feed the telemetry stage histograms). The result's "context"
+    entry reports how many prompt tokens context packing saved. model overrides the shared LLM backend
+    (an llm.LLMBackend).
+    """
+    if history is None:
+        history = []
+
+    with telemetry.request("query", follow_up=bool(history), scoped=bool(sources or where)):
+        message, retrieval = _retrieve(query_text, history, timings, model, scoped_search.make_scope(sources, where))
+        if message:
+            return {"answer": message, "citations": []}
+
+        cached = _cached_answer(retrieval)
+        if cached is not None:
+            return cached
+
+        return _generate(query_text, retrieval, timings)
+
+def query_rag_batch(queries, histories=None, concurrency=None, model=None, stats=None, sources=None, where=None):
+    """Answers many queries, yielding (index, result) in input order as results become ready.
+
+    Identical (query, history) pairs are answered once. All search queries are embedded
+    in one batch and searched with one Chroma call; rewrites and generations run on up
+    to concurrency threads (BATCH_CONCURRENCY by default). If a stats dict is passed it
+    receives the question and unique counts, elapsed seconds and questions per second.
+    sources and where scope every query, as in query_rag.
+    """
+    scope = scoped_search.make_scope(sources, where)
+    return telemetry.traced("batch", _query_rag_batch(queries, histories, concurrency, model, stats, scope),
+                            questions=len(queries))
+
+def _query_rag_batch(queries, histories, concurrency, model, stats, scope):
+    start = time.perf_counter()
+    if histories is None:
+        histories = [None] * len(queries)
+
+    unique = []
+    position = {}
+    for query_text, history in zip(queries, histories):
+        key = (query_text, repr(history or []))
+        if key not in position:
+            position[key] = len(unique)
+            unique.append((query_text, history or []))
+    order = [position[(q, repr(h or []))] for q, h in zip(queries, histories)]
+
+    def finish():
+        if stats is not None:
+            seconds = time.perf_counter() - start
+            stats.update(questions=len(queries), unique=len(unique), seconds=seconds,
+                         questions_per_second=len(queries) / seconds if seconds else 0.0)
+
+    message, collection, model = _setup(model)
+    if message:
+        for index in range(len(queries)):
+            yield index, {"answer": message, "citations": []}
+        finish()
+        return
+
+    pool = ThreadPoolExecutor(max_workers=concurrency or BATCH_CONCURRENCY, thread_name_prefix="batch")
+    try:
+        search_queries = list(pool.map(
+            lambda item: _search_query(model, item[0], item[1])[0] if item[1] else item[0], unique))
+        query_embeddings = resources.get_embedding_function()(search_queries) if unique else []
+        hits = _search(collection, search_queries, query_embeddings, None, scope) if unique else []
+
+        answers = []
+        for (query_text, _), search_query, query_embedding, hit in zip(unique, search_queries, query_embeddings, hits):
+            message, retrieval = _retrieval(model, search_query, query_embedding, hit)
+            if message:
+                answers.append({"answer": message, "citations": []})
+                continue
+            cached = _cached_answer(retrieval)
+            answers.append(cached if cached is not None
+                           else pool.submit(telemetry.propagate(_generate), query_text, retrieval))
+
+        for index, u in enumerate(order):
+            answer = answers[u]
+            yield index, answer.result() if isinstance(answer, Future) else answer
+    finally:
+        # Stop unstarted generations if the consumer gives up early
+        pool.shutdown(wait=False, cancel_futures=True)
+    finish()
+
+def query_rag_stream(query_text, history=None, timings=None, model=None, sources=None, where=None):
+    """Streaming variant of query_rag.
+
+    Yields a {"type": "sources"} event as soon as retrieval finishes, then one
+    {"type": "token"} event per chunk the model produces, and finally {"type": "done"}.
+    Failures are reported as a single {"type": "error"} event. sources and where scope
+    retrieval as in query_rag.
+    """
+    scope = scoped_search.make_scope(sources, where)
+    return telemetry.traced("stream", _query_rag_stream(query_text, history or [], timings, model, scope),
+                            follow_up=bool(history), scoped=scope is not None)
+
+def _query_rag_stream(query_text, history, timings, model, scope):
+    message, retrieval = _retrieve(query_text, history, timings, model, scope)
+    if message:
+        yield {"type": "sources", "sources": []}
+        yield {"type": "token", "text": message}
+        yield {"type": "done"}
+        return
+
+    sources = _sources(retrieval)
+    yield {"type": "sources", "sources": sources, "context": retrieval["context"].stats}
+
+    cached = _cached_answer(retrieval)
+    if cached is not None:
+        yield {"type": "token", "text": cached["answer"]}
+        yield {"type": "done"}
+        return
+
+    with _timed(timings, "prompt"):
+        prompt = _build_prompt(query_text, retrieval["context"])
+    answer = []
+    try:
+        start = time.perf_counter()
+        with _timed(timings, "generate"):
+            for text in retrieval["model"].stream(prompt, system=SYSTEM_INSTRUCTION):
+                answer.append(text)
+                yield {"type": "token", "text": text}
+    except Exception as e:
+        telemetry.ERRORS.inc(where="generate")
+        yield {"type": "error", "message": f"Error generating response: {str(e)}"}
+        return
+
+    result = {"answer": "".join(answer), "sources": sources, "context": retrieval["context"].stats}
+    _cache_answer(retrieval, result, time.perf_counter() - start)
+    yield {"type": "done"}
+
 if __name__ == "__main__":
     result = query_rag("What is the Turing test?")
     print(result['answer'])
@@ -0,0 +1,183 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+import resources
+
+# Re-score a wider candidate set with a cross-encoder and keep only the relevant chunks
+RERANK_ENABLED = os.getenv("RERANK", "0") == "1"
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# Most first-stage candidates a query may have scored
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+# Candidates scored in the first round; each further round doubles the depth
+RERANK_MIN_CANDIDATES = int(os.getenv("RERANK_MIN_CANDIDATES", "5"))
+# Relevance (sigmoid of the cross-encoder logit) a chunk needs to reach the prompt
+RERANK_THRESHOLD = float(os.getenv("RERANK_THRESHOLD", "0.1"))
+# Most chunks kept per query, and the most embedder tokens of context they may add up to
+RERANK_KEEP = int(os.getenv("RERANK_KEEP", "5"))
+RERANK_TOKEN_BUDGET = int(os.getenv("RERANK_TOKEN_BUDGET", "1200"))
+# (query, chunk) scores remembered; 0 disables the cache
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "20000"))
+RERANK_BATCH_SIZE = 32
+
+def _key(query_text, document):
+    # Keyed on the chunk text, so a re-ingested chunk with new content is scored again
+    return hashlib.blake2b(f"{query_text}\x00{document}".encode("utf-8"), digest_size=16).digest()
+
+def _relevance(logit):
+    return 1 / (1 + math.exp(-logit)) if logit > -30 else 0.0
+
+class Reranker:
+    """Cross-encoder re-ranking of first-stage hits with adaptive depth.
+
+    Every query starts with its top min_candidates hits. A query gets another, twice
+    as deep, round while fewer than keep of its scored chunks clear the threshold and
+    either none does yet or the lowest-ranked half of its last round still had one;
+    easy queries, whose relevant chunks rank first, stop after one round. Each round
+    scores the pending pairs of all queries in one batched predict call.
+
+    Kept chunks are the relevant ones in score order, up to keep chunks and
+    token_budget embedder tokens. The best chunk is always kept, so greetings and
+    questions about the assistant itself still reach the LLM.
+    """
+
+    def __init__(self, model_name=RERANK_MODEL, min_candidates=RERANK_MIN_CANDIDATES, max_candidates=RERANK_CANDIDATES,
+                 threshold=RERANK_THRESHOLD, keep=RERANK_KEEP, token_budget=RERANK_TOKEN_BUDGET,
+                 cache_size=RERANK_CACHE_SIZE):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, max_length=512, device="cpu")
+        self.min_candidates = max(min_candidates, 1)
+        self.max_candidates = max(max_candidates, self.min_candidates)
+        self.threshold = threshold
+        self.keep = keep
+        self.token_budget = token_budget
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"queries": 0, "rounds": 0, "deepened": 0, "candidates": 0, "pairs_scored": 0,
+                       "cache_hits": 0, "kept": 0, "below_threshold": 0, "over_budget": 0,
+                       "score_seconds": 0.0, "pack_seconds": 0.0}
+
+    def _cached(self, key):
+        with self._lock:
+            score = self._cache.get(key)
+            if score is not None:
+                self._cache.move_to_end(key)
+            return score
+
+    def _store(self, scores):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache.update(scores)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _score(self, pairs):
+        """Relevance for each (query, document) pair, from the cache or one predict call."""
+        keys = [_key(query_text, document) for query_text, document in pairs]
+        scores = [self._cached(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            start = time.perf_counter()
+            logits = self.model.predict([pairs[i] for i in missing], batch_size=RERANK_BATCH_SIZE,
+                                        show_progress_bar=False)
+            fresh = {keys[i]: _relevance(float(logit)) for i, logit in zip(missing, logits)}
+            self._store(fresh)
+            for i in missing:
+                scores[i] = fresh[keys[i]]
+            with self._lock:
+                self._stats["score_seconds"] += time.perf_counter() - start
+        with self._lock:
+            self._stats["pairs_scored"] += len(missing)
+            self._stats["cache_hits"] += len(pairs) - len(missing)
+        return scores
+
+    def _needs_more(self, scores, depth, previous, available):
+        if depth >= min(self.max_candidates, available):
+            return False
+        relevant = [score >= self.threshold for score in scores]
+        if sum(relevant) >= self.keep:
+            return False
+        if not any(relevant):
+            return True
+        # Otherwise relevance has tailed off within the ranking unless the tail still had a hit
+        return any(relevant[previous + (depth - previous) // 2:depth])
+
+    def rerank(self, search_queries, hits):
+        """Re-ranks one (ids, documents, metadatas) hit per query; returns hits in the same shape."""
+        scores = [[] for _ in hits]
+        depths = [0] * len(hits)
+        pending = list(range(len(hits)))
+        target = self.min_candidates
+        rounds = 0
+        while pending:
+            rounds += 1
+            pairs, owners = [], []
+            for i in pending:
+                documents = hits[i][1]
+                for document in documents[depths[i]:target]:
+                    pairs.append((search_queries[i], document))
+                    owners.append(i)
+            for i, score in zip(owners, self._score(pairs) if pairs else []):
+                scores[i].append(score)
+            previous = {i: depths[i] for i in pending}
+            for i in pending:
+                depths[i] = len(scores[i])
+            pending = [i for i in pending
+                       if self._needs_more(scores[i], depths[i], previous[i], len(hits[i][1]))]
+            target = min(target * 2, self.max_candidates)
+
+        start = time.perf_counter()
+        results = [self._pack(hit, query_scores) for hit, query_scores in zip(hits, scores)]
+        with self._lock:
+            self._stats["queries"] += len(hits)
+            self._stats["rounds"] += rounds
+            self._stats["deepened"] += sum(depth > self.min_candidates for depth in depths)
+            self._stats["candidates"] += sum(depths)
+            self._stats["pack_seconds"] += time.perf_counter() - start
+        return results
+
+    def _pack(self, hit, scores):
+        ids, documents, metadatas = hit
+        order = sorted(range(len(scores)), key=lambda i: -scores[i])
+        passing = [i for i in order if scores[i] >= self.threshold]
+        relevant = passing[:self.keep] or order[:1]
+        lengths = resources.count_tokens([documents[i] for i in relevant])
+        kept, used = [], 0
+        for i, length in zip(relevant, lengths):
+            if kept and used + length > self.token_budget:
+                break
+            kept.append(i)
+            used += length
+        with self._lock:
+            self._stats["kept"] += len(kept)
+            self._stats["below_threshold"] += len(scores) - len(passing)
+            self._stats["over_budget"] += len(relevant) - len(kept)
+        return [ids[i] for i in kept], [documents[i] for i in kept], [metadatas[i] for i in kept]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cache_entries"] = len(self._cache)
+        queries = stats["queries"]
+        looked_up = stats["pairs_scored"] + stats["cache_hits"]
+        stats["average_depth"] = stats["candidates"] / queries if queries else 0.0
+        stats["average_kept"] = stats["kept"] / queries if queries else 0.0
+        stats["cache_hit_rate"] = stats["cache_hits"] / looked_up if looked_up else 0.0
+        return stats
+
+_RERANKER = None
+_RERANKER_LOCK = threading.Lock()
+
+def get_reranker(create=True):
+    """Returns the process-wide reranker, or None if RERANK=0 (or, with create False, if not loaded yet)."""
+    global _RERANKER
+    if not RERANK_ENABLED:
+        return None
+    with _RERANKER_LOCK:
+        if _RERANKER is None and create:
+            _RERANKER = Reranker()
+        return _RERANKER
@@ -0,0 +1,316 @@
+import os
+import threading
+import time
+from dotenv import load_dotenv
+import llm
+# chromadb, sentence-transformers (torch) and google.generativeai each take a second or
+# more to import, so they are imported where first used rather than when the app loads
+
+load_dotenv()
+
+CHROMA_PATH = "chroma_db"
+COLLECTION_NAME = "rag_collection"
+MODEL_NAME = "all-MiniLM-L6-v2"
+# Longest input (in tokens, special tokens included) the embedder reads before truncating
+MAX_SEQ_LENGTH = int(os.getenv("EMBED_MAX_SEQ_LENGTH", "256"))
+
+# How long (seconds) the resolved Gemini model name is trusted before list_models() is called again
+MODEL_LIST_TTL = float(os.getenv("MODEL_LIST_TTL", "3600"))
+# Preloading of the query hot path at startup: "background" (serve at once; /ready turns
+# true when done), "blocking" (finish before serving) or "off" (load on first use)
+WARM_UP = os.getenv("WARM_UP", "background")
+
+# Each resource is built under its own lock, so a slow load (the embedding model, the Chroma
+# client) only holds up callers that need that resource; _LOCK just guards the counters
+_LOCK = threading.Lock()
+_BUILD_LOCKS = {
+    name: threading.Lock()
+    for name in ("client", "embedder", "tokenizer", "collection", "metadata_collection", "model", "llm")
+}
+_CLIENT = None
+_EF = None
+_TOKENIZER = None
+_TOKENIZER_ERROR = None
+_COLLECTION = None
+_METADATA_COLLECTION = None
+_MODEL = None
+_MODEL_NAME = None
+_LLM = None
+_MODEL_RESOLVED_AT = 0.0
+_CONFIGURED_KEY = None
+_WARM_UP = {"state": "pending", "seconds": None, "steps": {}, "error": None}
+
+_COUNTERS = {
+    name: {"built": 0, "reused": 0}
+    for name in ("client", "embedder", "collection", "metadata_collection", "model", "model_list", "llm")
+}
+
+def _count(name, built):
+    with _LOCK:
+        _COUNTERS[name]["built" if built else "reused"] += 1
+
+def get_client():
+    """Returns the process-wide Chroma client, creating it on first use."""
+    global _CLIENT
+    with _BUILD_LOCKS["client"]:
+        built = _CLIENT is None
+        if built:
+            import chromadb
+            _CLIENT = chromadb.PersistentClient(path=CHROMA_PATH)
+        _count("client", built)
+        return _CLIENT
+
+def get_embedding_function():
+    """Returns the process-wide SentenceTransformer embedding function.
+
+    With EMBED_BATCHING (the default) concurrent calls share model batches, in this
+    process or in the EMBED_SOCKET sidecar; see embedding_service.
+    """
+    global _EF
+    with _BUILD_LOCKS["embedder"]:
+        built = _EF is None
+        if built:
+            import embedding_service
+            if embedding_service.EMBED_BATCHING:
+                _EF = embedding_service.BatchedEmbeddingFunction(MODEL_NAME)
+            else:
+                from chromadb.utils import embedding_functions
+                _EF = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=MODEL_NAME)
+        _count("embedder", built)
+        return _EF
+
+def get_tokenizer():
+    """Returns the embedder's tokenizer without loading the model weights when possible.
+
+    A failed load (e.g. offline with no cached tokenizer) is remembered and raised again
+    at once rather than retried on every call.
+    """
+    global _TOKENIZER, _TOKENIZER_ERROR
+    with _BUILD_LOCKS["tokenizer"]:
+        if _TOKENIZER is None:
+            if _EF is not None and _EF._model is not None:
+                _TOKENIZER = _EF._model.tokenizer
+            elif _TOKENIZER_ERROR is not None:
+                raise RuntimeError(f"Tokenizer unavailable: {_TOKENIZER_ERROR}")
+            else:
+                try:
+                    from transformers import AutoTokenizer
+                    _TOKENIZER = AutoTokenizer.from_pretrained(f"sentence-transformers/{MODEL_NAME}")
+                except Exception as e:
+                    _TOKENIZER_ERROR = e
+                    raise
+        return _TOKENIZER
+
+def count_tokens(texts):
+    """Embedder tokens (no special tokens) in each text; a length estimate if no tokenizer loads."""
+    if not texts:
+        return []
+    failed_before = _TOKENIZER_ERROR is not None
+    try:
+        return [len(ids) for ids in get_tokenizer()(list(texts), add_special_tokens=False)["input_ids"]]
+    except Exception as e:
+        if not failed_before:
+            print(f"Error counting tokens: {e}. Estimating from length.")
+        return [len(text) // 4 for text in texts]
+
+def _sharded_collection(create):
+    # With SHARD_COUNT > 1 the chunks live in shard worker processes instead
+    import shards
+    if shards.SHARD_COUNT <= 1:
+        return None, False
+    return shards.get_sharded_collection(create), True
+
+def get_collection(create=False):
+    """Returns the RAG collection, or None if it does not exist and create is False.
+
+    With SHARD_COUNT > 1 this is a shards.ShardedCollection, which has the same methods.
+    """
+    global _COLLECTION
+    with _BUILD_LOCKS["collection"]:
+        if _COLLECTION is not None:
+            _count("collection", False)
+            return _COLLECTION
+
+        collection, sharded = _sharded_collection(create)
+        if collection is None and sharded:
+            return None
+        if not sharded:
+            client = get_client()
+            ef = get_embedding_function()
+            try:
+                if create:
+                    collection = client.get_or_create_collection(name=COLLECTION_NAME, embedding_function=ef)
+                else:
+                    collection = client.get_collection(name=COLLECTION_NAME, embedding_function=ef)
+            except Exception:
+                # Missing collection: ValueError on older chromadb, NotFoundError on newer
+                return None
+
+        _COLLECTION = collection
+        _count("collection", True)
+        return _COLLECTION
+
+def get_metadata_collection():
+    """Returns a handle on the RAG collection without an embedding function.
+
+    Good for count(), get() and delete(where=...), which never need embeddings, so the
+    SentenceTransformer model is not loaded. Returns None if the collection does not exist.
+    """
+    global _METADATA_COLLECTION
+    with _BUILD_LOCKS["metadata_collection"]:
+        if _METADATA_COLLECTION is not None:
+            _count("metadata_collection", False)
+            return _METADATA_COLLECTION
+
+        collection, sharded = _sharded_collection(False)
+        if not sharded:
+            try:
+                collection = get_client().get_collection(name=COLLECTION_NAME, embedding_function=None)
+            except Exception:
+                return None
+        elif collection is None:
+            return None
+
+        _METADATA_COLLECTION = collection
+        _count("metadata_collection", True)
+        return _METADATA_COLLECTION
+
+def get_api_key():
+    return os.getenv("GOOGLE_API_KEY")
+
+def _resolve_model_name():
+    import google.generativeai as genai
+    available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
+    model_name = next((m for m in available_models if 'gemini' in m and 'flash' in m), None)
+    if not model_name:
+        model_name = next((m for m in available_models if 'gemini' in m), None)
+    return model_name
+
+def get_model():
+    """Returns a cached GenerativeModel, refreshing the model list every MODEL_LIST_TTL seconds.
+
+    Returns None if no API key is configured or no Gemini model is available.
+    """
+    global _MODEL, _MODEL_NAME, _MODEL_RESOLVED_AT, _CONFIGURED_KEY
+    api_key = get_api_key()
+    if not api_key:
+        return None
+
+    import google.generativeai as genai
+    with _BUILD_LOCKS["model"]:
+        if api_key != _CONFIGURED_KEY:
+            genai.configure(api_key=api_key)
+            _CONFIGURED_KEY = api_key
+            _MODEL_RESOLVED_AT = 0.0
+
+        now = time.monotonic()
+        if _MODEL_NAME is None or now - _MODEL_RESOLVED_AT > MODEL_LIST_TTL:
+            model_name = _resolve_model_name()
+            _count("model_list", True)
+            _MODEL_RESOLVED_AT = now
+            if model_name != _MODEL_NAME:
+                _MODEL_NAME = model_name
+                _MODEL = None
+        else:
+            _count("model_list", False)
+
+        if not _MODEL_NAME:
+            return None
+
+        built = _MODEL is None
+        if built:
+            _MODEL = genai.GenerativeModel(_MODEL_NAME)
+        _count("model", built)
+        return _MODEL
+
+def get_llm():
+    """Returns the LLM backend selected by LLM_BACKEND.
+
+    For Gemini this wraps get_model() and is None when that is; the stub and HTTP
+    backends are built once per process.
+    """
+    global _LLM
+    if llm.LLM_BACKEND == "gemini":
+        model = get_model()
+        if model is None:
+            return None
+        with _BUILD_LOCKS["llm"]:
+            built = _LLM is None or _LLM.model is not model
+            if built:
+                _LLM = llm.GeminiBackend(model)
+            _count("llm", built)
+            return _LLM
+
+    with _BUILD_LOCKS["llm"]:
+        built = _LLM is None
+        if built:
+            _LLM = llm.make_backend()
+        _count("llm", built)
+        return _LLM
+
+def _warm_up_steps():
+    """(name, step, required) for everything the first query would otherwise load."""
+    import lexical_index
+    import rag
+    import rerank
+    import shards
+    import vector_index
+    # Shard workers open their own clients; this process needs none
+    steps = [("client", get_client, True)] if shards.SHARD_COUNT <= 1 else []
+    steps += [
+        # One encode, not just the load: the first forward pass allocates and is slow too
+        ("embedder", lambda: get_embedding_function()(["warm up"]), True),
+        ("tokenizer", lambda: get_tokenizer()(["warm up"]), False),
+        ("collection", get_collection, True),  # starts the shard workers when sharded
+    ]
+    if vector_index.enabled():
+        steps.append(("vector_index", vector_index.get_vector_index, True))
+    if rag.HYBRID_SEARCH:
+        steps.append(("lexical_index", lexical_index.get_lexical_index, False))
+    steps.append(("llm", get_llm, False))
+    steps.append(("reranker", rerank.get_reranker, False))
+    return steps
+
+def warm_up(extra_steps=()):
+    """Loads the query hot path (embedder, collection, indexes, LLM backend, reranker) ahead of the first request.
+
+    A failing required step marks warm-up failed; optional ones (the LLM, which may
+    lack an API key, or the reranker) only print an error. extra_steps are further
+    (name, step, required) tuples, run first. Returns the seconds each step took.
+    """
+    _WARM_UP.update(state="warming", error=None)
+    start = time.perf_counter()
+    timings = {}
+    try:
+        for name, step, required in [*extra_steps, *_warm_up_steps()]:
+            step_start = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                if required:
+                    raise RuntimeError(f"{name}: {e}") from e
+                print(f"Error warming up {name}: {e}")
+            timings[name] = time.perf_counter() - step_start
+    except Exception as e:
+        print(f"Error during warm-up, {e}")
+        _WARM_UP.update(state="failed", error=str(e))
+    else:
+        _WARM_UP.update(state="ready")
+    _WARM_UP.update(seconds=time.perf_counter() - start, steps=timings)
+    print(f"Resources warmed up in {_WARM_UP['seconds']:.2f}s ("
+          + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()) + ")")
+    return timings
+
+def get_readiness():
+    """Warm-up progress; ready once the hot path is loaded, or at once with WARM_UP=off."""
+    readiness = dict(_WARM_UP, steps=dict(_WARM_UP["steps"]))
+    readiness["ready"] = readiness["state"] == "ready" or WARM_UP == "off"
+    return readiness
+
+def get_resource_stats():
+    """Returns how often each shared resource was built versus reused."""
+    with _LOCK:
+        stats = {name: dict(counts) for name, counts in _COUNTERS.items()}
+    stats["model_name"] = _MODEL_NAME
+    stats["llm_backend"] = _LLM.describe() if _LLM is not None else {"backend": llm.LLM_BACKEND}
+    return stats
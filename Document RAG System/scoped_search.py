@@ -0,0 +1,156 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import manifest
+
+# Scopes of at most this many chunks are searched exactly with NumPy rather than through the vector index
+SCOPE_BRUTE_FORCE_MAX_CHUNKS = int(os.getenv("SCOPE_BRUTE_FORCE_MAX_CHUNKS", "20000"))
+# Memory (MiB) kept for per-source embedding blocks; the least recently used are dropped first
+SCOPE_CACHE_MB = float(os.getenv("SCOPE_CACHE_MB", "256"))
+
+class Scope:
+    """The source files and the metadata filter a query is limited to."""
+
+    def __init__(self, sources=None, where=None):
+        self.sources = sorted(set(sources)) if sources else None
+        self.where = where or None
+
+    def filter(self):
+        """The scope as a Chroma where filter."""
+        clauses = []
+        if self.sources:
+            clauses.append({"source": self.sources[0]} if len(self.sources) == 1
+                           else {"source": {"$in": self.sources}})
+        if self.where:
+            clauses.append(self.where)
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def make_scope(sources=None, where=None):
+    """A Scope, or None when neither sources nor where limit the search."""
+    if not sources and not where:
+        return None
+    return Scope(sources, where)
+
+class _Block:
+    __slots__ = ("ids", "vectors", "sq_norms", "version", "nbytes")
+
+    def __init__(self, ids, vectors, version):
+        self.ids = ids
+        self.vectors = vectors
+        self.sq_norms = (vectors * vectors).sum(axis=1)
+        self.version = version
+        self.nbytes = vectors.nbytes + self.sq_norms.nbytes
+
+class SourceBlocks:
+    """LRU cache of each source file's chunk ids and embeddings, for exact scoped search.
+
+    A block is reloaded once the manifest's hash of its file changes (re-ingested here or
+    in another process), and dropped by invalidate_source.
+    """
+
+    def __init__(self, max_bytes=int(SCOPE_CACHE_MB * 2**20)):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._bytes = 0
+        self._metrics = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0,
+                         "exact_searches": 0, "index_searches": 0}
+
+    def get(self, collection, source):
+        version = manifest.get_manifest().file_hash(source)
+        with self._lock:
+            block = self._blocks.get(source)
+            if block is not None and block.version == version:
+                self._blocks.move_to_end(source)
+                self._metrics["hits"] += 1
+                return block
+            self._metrics["misses"] += 1
+
+        result = collection.get(where={"source": source}, include=["embeddings"])
+        vectors = np.asarray(result["embeddings"], dtype=np.float32) if result["ids"] \
+            else np.zeros((0, 0), dtype=np.float32)
+        block = _Block(result["ids"], vectors, version)
+        with self._lock:
+            self._drop(source)
+            # A block bigger than the whole cache is used once and not kept
+            if block.nbytes <= self.max_bytes:
+                self._blocks[source] = block
+                self._bytes += block.nbytes
+                while self._bytes > self.max_bytes:
+                    self._drop(next(iter(self._blocks)))
+                    self._metrics["evictions"] += 1
+        return block
+
+    def _drop(self, source):
+        block = self._blocks.pop(source, None)
+        if block is not None:
+            self._bytes -= block.nbytes
+        return block
+
+    def invalidate_source(self, source):
+        with self._lock:
+            if self._drop(source) is not None:
+                self._metrics["invalidations"] += 1
+
+    def record(self, exact):
+        with self._lock:
+            self._metrics["exact_searches" if exact else "index_searches"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+            stats["blocks"] = len(self._blocks)
+            stats["cached_mb"] = self._bytes / 2**20
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            return stats
+
+_BLOCKS = None
+_BLOCKS_LOCK = threading.Lock()
+
+def get_source_blocks():
+    global _BLOCKS
+    with _BLOCKS_LOCK:
+        if _BLOCKS is None:
+            _BLOCKS = SourceBlocks()
+        return _BLOCKS
+
+def invalidate_source(source):
+    if _BLOCKS is not None:
+        _BLOCKS.invalidate_source(source)
+
+def search(collection, sources, query_embeddings, n_results):
+    """Exact L2 search over the chunks of sources; one ranked chunk id list per query.
+
+    Returns None when the sources hold more than SCOPE_BRUTE_FORCE_MAX_CHUNKS chunks, so
+    the caller runs a filtered index search instead.
+    """
+    import ingest
+    blocks_cache = get_source_blocks()
+    counts = ingest.get_collection_stats()["sources"]
+    if sum(counts.get(source, 0) for source in sources) > SCOPE_BRUTE_FORCE_MAX_CHUNKS:
+        blocks_cache.record(exact=False)
+        return None
+    blocks_cache.record(exact=True)
+    return rank([blocks_cache.get(collection, source) for source in sources], query_embeddings, n_results)
+
+def rank(blocks, query_embeddings, n_results):
+    """The n_results chunk ids of blocks nearest to each query (L2, as Chroma's default space)."""
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+    blocks = [block for block in blocks if block.ids]
+    if not blocks:
+        return [[] for _ in range(len(queries))]
+    ids = [chunk_id for block in blocks for chunk_id in block.ids]
+    # |q - x|^2 = |x|^2 - 2 q.x + |q|^2, per block so the blocks are never copied together
+    distances = np.concatenate([block.sq_norms - 2 * queries @ block.vectors.T for block in blocks], axis=1)
+    distances += (queries * queries).sum(axis=1)[:, None]
+    k = min(n_results, len(ids))
+    ranked = []
+    for row in distances:
+        top = np.argpartition(row, k - 1)[:k] if len(row) > k else np.arange(len(row))
+        ranked.append([ids[i] for i in top[np.argsort(row[top])]])
+    return ranked
+
+def get_stats():
+    return {"max_chunks": SCOPE_BRUTE_FORCE_MAX_CHUNKS, "cache_mb": SCOPE_CACHE_MB, **get_source_blocks().stats()}
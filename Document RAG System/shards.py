@@ -0,0 +1,632 @@
+import atexit
+import fcntl
+import fnmatch
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import manifest
+import resources
+import telemetry
+
+# Shards the collection is split into, each served by its own worker process; 1 keeps the
+# single collection searched inside the request process
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+# Routing rules "pattern=shard,..." matched against source filenames (e.g. "*.pdf=0,contract-*=1");
+# files no rule matches are placed by a hash of their name
+SHARD_ROUTES = os.getenv("SHARD_ROUTES", "")
+# Seconds a shard worker may take to open its collection and load the HNSW index
+SHARD_START_TIMEOUT = float(os.getenv("SHARD_START_TIMEOUT", "120"))
+
+def _parse_routes(routes):
+    rules = []
+    for rule in filter(None, (part.strip() for part in routes.split(","))):
+        pattern, _, shard = rule.rpartition("=")
+        if not pattern.strip() or not shard.strip().isdigit():
+            raise ValueError(f"Bad SHARD_ROUTES rule {rule!r}; expected pattern=shard")
+        rules.append((pattern.strip(), int(shard)))
+    return rules
+
+_ROUTES = _parse_routes(SHARD_ROUTES)
+
+def shard_for(source, shard_count=SHARD_COUNT, routes=None):
+    """The shard holding source's chunks: the first matching routing rule's, else a hash of the name."""
+    for pattern, shard in _ROUTES if routes is None else routes:
+        if fnmatch.fnmatchcase(source, pattern):
+            return shard
+    # A cryptographic hash: CRC low bits barely change between names like doc_1.txt and doc_2.txt
+    return int(manifest.hash_text(source)[:16], 16) % shard_count
+
+def _where_sources(where):
+    """The sources a Chroma where filter is limited to, or None if it may match any."""
+    if not where:
+        return None
+    if "$and" in where:
+        limits = [sources for sources in map(_where_sources, where["$and"]) if sources is not None]
+        return set.intersection(*limits) if limits else None
+    condition = where.get("source")
+    if isinstance(condition, str):
+        return {condition}
+    if isinstance(condition, dict):
+        if "$eq" in condition:
+            return {condition["$eq"]}
+        if "$in" in condition:
+            return set(condition["$in"])
+    return None
+
+def layout_path(shard_count=SHARD_COUNT):
+    return os.path.join(resources.CHROMA_PATH, f"shards-{shard_count}")
+
+def _send(stream, payload):
+    stream.write(struct.pack(">I", len(payload)) + payload)
+
+def _receive(stream):
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    (length,) = struct.unpack(">I", header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        raise ConnectionError("Shard connection closed mid-message")
+    return payload
+
+def _write_message(stream, header, vectors=None):
+    """A JSON header, followed by a float32 matrix frame when vectors are given."""
+    if vectors is not None:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        header = dict(header, rows=vectors.shape[0], dim=vectors.shape[1] if vectors.ndim == 2 else 0)
+    _send(stream, json.dumps(header).encode("utf-8"))
+    if vectors is not None:
+        _send(stream, vectors.tobytes())
+    stream.flush()
+
+def _read_message(stream):
+    """Returns (header, vectors or None), or (None, None) once the other side has closed."""
+    payload = _receive(stream)
+    if payload is None:
+        return None, None
+    header = json.loads(payload)
+    if "rows" not in header:
+        return header, None
+    data = _receive(stream)
+    if data is None:
+        raise ConnectionError("Shard connection closed mid-message")
+    return header, np.frombuffer(data, dtype=np.float32).reshape(header["rows"], header["dim"])
+
+def _open(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock.makefile("rwb")
+
+def _reachable(path):
+    try:
+        _open(path).close()
+        return True
+    except OSError:
+        return False
+
+class ShardUnavailable(ConnectionError):
+    pass
+
+class _Shard:
+    """One shard's Chroma collection, inside its worker process. It holds no embedding model."""
+
+    def __init__(self, path):
+        import chromadb
+        self.collection = chromadb.PersistentClient(path=path).get_or_create_collection(
+            name=resources.COLLECTION_NAME, embedding_function=None)
+
+    def warm_up(self):
+        # One query now loads the HNSW index, rather than the first request doing it
+        sample = self.collection.get(limit=1, include=["embeddings"])
+        if sample["ids"]:
+            self.collection.query(query_embeddings=np.asarray(sample["embeddings"], dtype=np.float32),
+                                  n_results=1, include=[])
+
+    def handle(self, request, vectors):
+        """Returns (reply, reply vectors or None) for one request."""
+        op = request["op"]
+        collection = self.collection
+        if op == "query":
+            result = collection.query(query_embeddings=vectors, n_results=request["n_results"],
+                                      where=request.get("where"), include=["documents", "metadatas", "distances"])
+            return {
+                "ids": result["ids"],
+                "distances": [[float(d) for d in row] for row in result["distances"]],
+                "documents": result["documents"],
+                "metadatas": result["metadatas"],
+            }, None
+        if op == "get":
+            include = request["include"]
+            result = collection.get(ids=request.get("ids"), where=request.get("where"), include=include,
+                                    limit=request.get("limit"), offset=request.get("offset"))
+            reply = {"ids": result["ids"]}
+            for key in ("documents", "metadatas"):
+                if key in include:
+                    reply[key] = result[key]
+            if "embeddings" not in include:
+                return reply, None
+            if not result["ids"]:
+                return reply, np.zeros((0, 0), dtype=np.float32)
+            return reply, np.asarray(result["embeddings"], dtype=np.float32)
+        if op == "upsert":
+            collection.upsert(ids=request["ids"], embeddings=vectors, metadatas=request["metadatas"],
+                              documents=request["documents"])
+            return {}, None
+        if op == "update":
+            collection.update(ids=request["ids"], metadatas=request["metadatas"])
+            return {}, None
+        if op == "delete":
+            collection.delete(ids=request.get("ids"), where=request.get("where"))
+            return {}, None
+        if op == "count":
+            where = request.get("where")
+            count = len(collection.get(where=where, include=[])["ids"]) if where else collection.count()
+            return {"count": count}, None
+        raise ValueError(f"Unknown shard op {op!r}")
+
+class _Handler(socketserver.StreamRequestHandler):
+    """One client connection: length-prefixed JSON requests, each with an optional float32 matrix."""
+
+    def handle(self):
+        while True:
+            try:
+                request, vectors = _read_message(self.rfile)
+            except ConnectionError:
+                return
+            if request is None:
+                return
+            start = time.perf_counter()
+            try:
+                reply, reply_vectors = self.server.shard.handle(request, vectors)
+            except Exception as e:
+                print(f"Error in shard {self.server.index} {request.get('op')}: {e}")
+                reply, reply_vectors = {"error": str(e)}, None
+            # Service time, so clients can tell a slow shard from a slow connection
+            reply["seconds"] = time.perf_counter() - start
+            try:
+                _write_message(self.wfile, reply, reply_vectors)
+            except OSError:
+                return
+
+class ShardServer(socketserver.ThreadingUnixStreamServer):
+    """Serves one shard to every process of the app over a Unix socket."""
+
+    daemon_threads = True
+
+    def __init__(self, path, shard, index):
+        if os.path.exists(path):
+            os.remove(path)
+        self.shard = shard
+        self.index = index
+        super().__init__(path, _Handler)
+
+def _exit_with(server, parent):
+    while os.getppid() == parent:
+        time.sleep(1)
+    server.shutdown()
+
+def serve(path, index, parent=None):
+    """Runs the worker for shard index of the layout at path until terminated (or parent exits)."""
+    shard = _Shard(os.path.join(path, str(index)))
+    shard.warm_up()
+    socket_path = os.path.join(path, f"{index}.sock")
+    server = ShardServer(socket_path, shard, index)
+    # Terminating the worker ends serve_forever like Ctrl+C, so the socket is removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if parent:
+        threading.Thread(target=_exit_with, args=(server, parent), daemon=True).start()
+    print(f"Shard {index} serving {shard.collection.count()} chunks on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+class ShardedCollection:
+    """The Chroma collection calls this app makes (query, get, upsert, update, delete, count),
+    spread over shard worker processes.
+
+    Writes go to the shard of each chunk's source file, reads by id or by source only to
+    the shards that can hold them, and queries to every shard at once; the per-shard top
+    results are merged by distance. Workers are started on first use, or reused when
+    another process (a query worker, the ingest CLI) already runs them.
+    """
+
+    def __init__(self, shard_count=SHARD_COUNT, path=None, routes=None):
+        self.shard_count = shard_count
+        self.path = path or layout_path(shard_count)
+        self.routes = _ROUTES if routes is None else routes
+        for pattern, shard in self.routes:
+            if not 0 <= shard < shard_count:
+                raise ValueError(f"SHARD_ROUTES sends {pattern} to shard {shard}, but there are {shard_count} shards")
+        os.makedirs(self.path, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._owner = os.getpid()
+        self._workers = {}
+        self._stats = [{"requests": 0, "errors": 0, "seconds": 0.0} for _ in range(shard_count)]
+        self._queries = 0
+        self._query_seconds = 0.0
+        atexit.register(self.close)
+
+    def socket_path(self, shard):
+        return os.path.join(self.path, f"{shard}.sock")
+
+    def shard_for(self, source):
+        return shard_for(source, self.shard_count, self.routes)
+
+    def start(self):
+        """Starts any shard workers not running yet and waits until every shard answers."""
+        self._start_workers([shard for shard in range(self.shard_count) if not _reachable(self.socket_path(shard))])
+
+    def _start_workers(self, shards):
+        locks = []
+        started = {}
+        try:
+            for shard in shards:
+                # The lock keeps two processes from starting the same shard at once
+                lock = open(os.path.join(self.path, f"{shard}.lock"), "w")
+                locks.append(lock)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not _reachable(self.socket_path(shard)):
+                    started[shard] = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(shard),
+                                                       "--path", self.path, "--parent", str(os.getpid())])
+            with self._lock:
+                self._workers.update(started)
+            deadline = time.monotonic() + SHARD_START_TIMEOUT
+            for shard, worker in started.items():
+                while not _reachable(self.socket_path(shard)):
+                    if worker.poll() is not None or time.monotonic() > deadline:
+                        worker.kill()
+                        raise ShardUnavailable(f"Shard {shard} worker did not start")
+                    time.sleep(0.05)
+        finally:
+            for lock in locks:
+                lock.close()
+
+    def close(self):
+        """Stops the shard workers this process started."""
+        if os.getpid() != self._owner:
+            return
+        with self._lock:
+            workers, self._workers = self._workers, {}
+        for worker in workers.values():
+            worker.terminate()
+        for worker in workers.values():
+            try:
+                worker.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+
+    def _stream(self, shard):
+        streams = getattr(self._local, "streams", None)
+        if streams is None:
+            streams = self._local.streams = {}
+        if shard not in streams:
+            try:
+                streams[shard] = _open(self.socket_path(shard))
+            except OSError:
+                self._start_workers([shard])
+                streams[shard] = _open(self.socket_path(shard))
+        return streams[shard]
+
+    def _reset(self, shard):
+        stream = getattr(self._local, "streams", {}).pop(shard, None)
+        if stream is not None:
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    def _read(self, shard):
+        reply, vectors = _read_message(self._stream(shard))
+        if reply is None:
+            raise ConnectionError(f"Shard {shard} closed the connection")
+        return reply, vectors
+
+    def _record(self, shard, reply):
+        failed = reply is None or "error" in reply
+        with self._lock:
+            stats = self._stats[shard]
+            stats["requests"] += 1
+            stats["errors"] += failed
+            if reply is not None:
+                stats["seconds"] += reply["seconds"]
+        if reply is not None:
+            telemetry.SHARD_SECONDS.observe(reply["seconds"], shard=str(shard))
+
+    def _call(self, calls, partial=False):
+        """Sends every (shard, request, vectors) call, then collects the replies in order.
+
+        The shards work on their calls at the same time. Returns one (reply, vectors) per
+        call. With partial, a shard that fails (even after reconnecting) gives (None, None)
+        and the rest still answer; otherwise its error is raised.
+        """
+        replies = [None] * len(calls)
+        retry = []
+        sent = []
+        for i, (shard, request, vectors) in enumerate(calls):
+            try:
+                _write_message(self._stream(shard), request, vectors)
+                sent.append(i)
+            except OSError:
+                self._reset(shard)
+                retry.append(i)
+        for i in sent:
+            try:
+                replies[i] = self._read(calls[i][0])
+            except OSError:
+                self._reset(calls[i][0])
+                retry.append(i)
+        for i in retry:
+            # A connection kept from before a worker restart fails on first use; retry once on a new one
+            shard, request, vectors = calls[i]
+            try:
+                _write_message(self._stream(shard), request, vectors)
+                replies[i] = self._read(shard)
+            except OSError as e:
+                self._reset(shard)
+                self._record(shard, None)
+                if not partial:
+                    raise ShardUnavailable(f"Shard {shard} is unreachable: {e}") from e
+                print(f"Error reaching shard {shard}: {e}. Answering without it.")
+                telemetry.ERRORS.inc(where="shard")
+                replies[i] = (None, None)
+
+        for i, (shard, request, _) in enumerate(calls):
+            reply = replies[i][0]
+            if reply is None:
+                continue
+            self._record(shard, reply)
+            if "error" in reply:
+                if not partial:
+                    raise RuntimeError(f"Shard {shard} {request['op']} failed: {reply['error']}")
+                print(f"Error from shard {shard}: {reply['error']}. Answering without it.")
+                telemetry.ERRORS.inc(where="shard")
+                replies[i] = (None, None)
+        return replies
+
+    def _shards_for(self, where):
+        sources = _where_sources(where)
+        if sources is None:
+            return list(range(self.shard_count))
+        return sorted({self.shard_for(source) for source in sources})
+
+    def _group_ids(self, ids):
+        # Chunk ids start with their source filename; ids in another format are sent to every shard
+        groups = {}
+        for chunk_id in ids:
+            source = manifest.chunk_source(chunk_id)
+            for shard in range(self.shard_count) if source is None else (self.shard_for(source),):
+                groups.setdefault(shard, []).append(chunk_id)
+        return groups
+
+    def _group_rows(self, metadatas):
+        groups = {}
+        for row, metadata in enumerate(metadatas):
+            groups.setdefault(self.shard_for(metadata["source"]), []).append(row)
+        return groups
+
+    def count(self):
+        return sum(reply["count"] for reply, _ in self._call([(shard, {"op": "count"}, None)
+                                                              for shard in range(self.shard_count)]))
+
+    def query(self, query_embeddings, n_results=10, where=None):
+        """Chroma's query result (ids, distances, documents, metadatas) over all shards the filter allows."""
+        start = time.perf_counter()
+        vectors = np.asarray(query_embeddings, dtype=np.float32)
+        request = {"op": "query", "n_results": n_results, "where": where}
+        replies = [reply for reply, _ in self._call([(shard, request, vectors) for shard in self._shards_for(where)],
+                                                    partial=True) if reply is not None]
+        result = {"ids": [], "distances": [], "documents": [], "metadatas": []}
+        for q in range(len(vectors)):
+            hits = sorted((hit for reply in replies for hit in zip(
+                reply["distances"][q], reply["ids"][q], reply["documents"][q], reply["metadatas"][q])),
+                key=lambda hit: hit[0])[:n_results]
+            for key, values in zip(("distances", "ids", "documents", "metadatas"), zip(*hits) if hits else ([],) * 4):
+                result[key].append(list(values))
+        with self._lock:
+            self._queries += 1
+            self._query_seconds += time.perf_counter() - start
+        return result
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=None):
+        include = list(include)
+        if ids is not None:
+            calls = [(shard, {"op": "get", "ids": group, "where": where, "include": include}, None)
+                     for shard, group in self._group_ids(ids).items()]
+        elif limit is not None or offset:
+            calls = self._page_calls(where, include, limit, offset or 0)
+        else:
+            calls = [(shard, {"op": "get", "where": where, "include": include}, None)
+                     for shard in self._shards_for(where)]
+        result = {"ids": [], **{key: [] for key in include}}
+        for reply, vectors in self._call(calls):
+            result["ids"].extend(reply["ids"])
+            for key in ("documents", "metadatas"):
+                if key in include:
+                    result[key].extend(reply[key])
+            if "embeddings" in include:
+                result["embeddings"].extend(vectors)
+        return result
+
+    def _page_calls(self, where, include, limit, offset):
+        # Pages run through the shards in order, as if they were one collection
+        shards = self._shards_for(where)
+        counts = [reply["count"] for reply, _ in self._call([(shard, {"op": "count", "where": where}, None)
+                                                             for shard in shards])]
+        calls = []
+        for shard, count in zip(shards, counts):
+            if limit is not None and limit <= 0:
+                break
+            if offset >= count:
+                offset -= count
+                continue
+            take = count - offset if limit is None else min(limit, count - offset)
+            calls.append((shard, {"op": "get", "where": where, "include": include, "limit": take, "offset": offset},
+                          None))
+            offset = 0
+            if limit is not None:
+                limit -= take
+        return calls
+
+    def upsert(self, ids, embeddings=None, metadatas=None, documents=None):
+        if embeddings is None:
+            # Shard workers hold no model; embed here with the shared (batched) embedder
+            embeddings = resources.get_embedding_function()(documents)
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        self._call([(shard, {"op": "upsert", "ids": [ids[row] for row in rows],
+                             "metadatas": [metadatas[row] for row in rows],
+                             "documents": [documents[row] for row in rows]}, vectors[rows])
+                    for shard, rows in self._group_rows(metadatas).items()])
+
+    def update(self, ids, metadatas):
+        self._call([(shard, {"op": "update", "ids": [ids[row] for row in rows],
+                             "metadatas": [metadatas[row] for row in rows]}, None)
+                    for shard, rows in self._group_rows(metadatas).items()])
+
+    def delete(self, ids=None, where=None):
+        if ids is not None:
+            calls = [(shard, {"op": "delete", "ids": group, "where": where}, None)
+                     for shard, group in self._group_ids(ids).items()]
+        else:
+            calls = [(shard, {"op": "delete", "where": where}, None) for shard in self._shards_for(where)]
+        self._call(calls)
+
+    def stats(self):
+        counts = self._call([(shard, {"op": "count"}, None) for shard in range(self.shard_count)], partial=True)
+        with self._lock:
+            shards = [
+                {"shard": shard, "chunks": reply["count"] if reply is not None else None,
+                 "requests": stats["requests"], "errors": stats["errors"],
+                 "average_ms": stats["seconds"] / stats["requests"] * 1000 if stats["requests"] else 0.0}
+                for shard, ((reply, _), stats) in enumerate(zip(counts, self._stats))
+            ]
+            return {
+                "shard_count": self.shard_count,
+                "path": self.path,
+                "routes": [f"{pattern}={shard}" for pattern, shard in self.routes],
+                "queries": self._queries,
+                "average_query_ms": self._query_seconds / self._queries * 1000 if self._queries else 0.0,
+                "shards": shards,
+            }
+
+_SHARDED = None
+_LOCK = threading.Lock()
+
+def _after_fork():
+    # A forked child (e.g. a query worker process) opens its own connections, and must
+    # not stop the workers its parent started when it exits
+    global _LOCK
+    _LOCK = threading.Lock()
+    if _SHARDED is not None:
+        _SHARDED._local = threading.local()
+        _SHARDED._lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def get_sharded_collection(create=False):
+    """Returns the process-wide ShardedCollection for SHARD_COUNT, starting its workers.
+
+    Returns None if the layout does not exist yet and create is False.
+    """
+    global _SHARDED
+    with _LOCK:
+        if _SHARDED is None:
+            if not create and not os.path.isdir(layout_path()):
+                return None
+            collection = ShardedCollection()
+            collection.start()
+            _SHARDED = collection
+        return _SHARDED
+
+def get_stats():
+    if SHARD_COUNT <= 1:
+        return {"enabled": False}
+    collection = get_sharded_collection()
+    if collection is None:
+        return {"enabled": True, "shard_count": SHARD_COUNT, "shards": []}
+    return {"enabled": True, **collection.stats()}
+
+def migrate(from_count, batch_size=2000):
+    """Copies every chunk from the from_count layout (1: the unsharded collection) into the
+    current one, or, when from_count is SHARD_COUNT, moves chunks whose route has changed.
+
+    Chunk ids do not change, so the lexical and vector indexes stay valid. Returns the chunks copied.
+    """
+    target = resources.get_collection(create=True)
+    if from_count == SHARD_COUNT:
+        return _rebalance(target, batch_size) if SHARD_COUNT > 1 else 0
+
+    if from_count == 1:
+        source = resources.get_client().get_collection(name=resources.COLLECTION_NAME, embedding_function=None)
+    else:
+        if not os.path.isdir(layout_path(from_count)):
+            raise ValueError(f"No {from_count}-shard layout at {layout_path(from_count)}")
+        source = ShardedCollection(from_count)
+        source.start()
+    total = source.count()
+    for offset in range(0, total, batch_size):
+        page = source.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+        if page["ids"]:
+            target.upsert(ids=page["ids"], embeddings=page["embeddings"], metadatas=page["metadatas"],
+                          documents=page["documents"])
+        print(f"Copied {min(offset + batch_size, total)}/{total} chunks")
+    return total
+
+def _rebalance(collection, batch_size):
+    moved = 0
+    for shard in range(collection.shard_count):
+        (reply, _), = collection._call([(shard, {"op": "get", "include": ["metadatas"]}, None)])
+        stray = [chunk_id for chunk_id, metadata in zip(reply["ids"], reply["metadatas"])
+                 if collection.shard_for(metadata["source"]) != shard]
+        for start in range(0, len(stray), batch_size):
+            ids = stray[start:start + batch_size]
+            (page, vectors), = collection._call([(shard, {"op": "get", "ids": ids,
+                                                          "include": ["embeddings", "documents", "metadatas"]}, None)])
+            collection.upsert(ids=page["ids"], embeddings=vectors, metadatas=page["metadatas"],
+                              documents=page["documents"])
+            collection._call([(shard, {"op": "delete", "ids": page["ids"]}, None)])
+            moved += len(page["ids"])
+        if stray:
+            print(f"Moved {len(stray)} chunks off shard {shard}")
+    return moved
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Shard workers and shard layout maintenance (SHARD_COUNT, SHARD_ROUTES).")
+    parser.add_argument("--serve", type=int, metavar="SHARD", help="run the worker for one shard")
+    parser.add_argument("--path", help="layout directory (default: the SHARD_COUNT layout)")
+    parser.add_argument("--parent", type=int, help="exit when this process does")
+    parser.add_argument("--migrate", action="store_true",
+                        help="copy chunks from the --from-shards layout into the SHARD_COUNT one, "
+                             "or re-route them within it after SHARD_ROUTES changed")
+    parser.add_argument("--from-shards", type=int, default=1, help="layout --migrate reads (1: the unsharded collection)")
+    parser.add_argument("--stats", action="store_true", help="print chunk counts per shard")
+    args = parser.parse_args()
+    if args.serve is not None:
+        serve(args.path or layout_path(), args.serve, args.parent)
+    elif args.migrate:
+        print(f"Migrated {migrate(args.from_shards)} chunks into {SHARD_COUNT} shard(s)")
+    elif args.stats:
+        print(json.dumps(get_stats(), indent=4))
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
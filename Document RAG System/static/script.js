@@ -36,6 +36,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     let files = [];
+    const scopedFiles = new Set(); // Files the next questions are limited to (none = all files)
     async function loadFiles() {
         try {
             const response = await fetch('/files');
@@ -58,6 +59,12 @@ document.addEventListener('DOMContentLoaded', () => {
         files.forEach(file => {
             const div = document.createElement('div');
             div.className = 'file-item';
+            div.classList.toggle('scoped', scopedFiles.has(file));
+            div.title = "Click to ask only about this file (click again to include all files)";
+            div.addEventListener('click', () => {
+                if (!scopedFiles.delete(file)) scopedFiles.add(file);
+                div.classList.toggle('scoped', scopedFiles.has(file));
+            });
 
             const nameSpan = document.createElement('span');
             nameSpan.className = 'file-name';
@@ -70,6 +77,7 @@ document.addEventListener('DOMContentLoaded', () => {
             deleteBtn.title = "Delete File";
 
             deleteBtn.addEventListener('click', async (e) => {
+                e.stopPropagation();
                 if (confirm(`Are you sure you want to delete ${file}? This will likely break any queries referencing this document.`)) {
                     await deleteFile(file);
                 }
@@ -84,6 +92,7 @@ document.addEventListener('DOMContentLoaded', () => {
         try {
             const res = await fetch(`/files/${filename}`, { method: 'DELETE' });
             if (res.ok) {
+                scopedFiles.delete(filename);
                 await loadFiles();
                 renderFilesSidebar();
             } else {
@@ -296,7 +305,8 @@ document.addEventListener('DOMContentLoaded', () => {
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
                     query: query,
-                    history: history
+                    history: history,
+                    sources: scopedFiles.size > 0 ? [...scopedFiles] : null
                 })
             });
 
@@ -531,16 +541,21 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch('/upload', { method: 'POST', body: formData });
             const data = await response.json();
             if (response.ok) {
-                uploadStatus.textContent = `✅ Uploaded`;
-                uploadStatus.style.color = '#10a37f';
-                setTimeout(() => { uploadStatus.textContent = ''; }, 3000);
-
                 // Inject message into chat
                 renderMessage(`Uploaded file: **${file.name}**`, 'user', [], true);
                 addMessageToSession(`Uploaded file: ${file.name}`, 'user');
 
                 await loadFiles();
                 renderFilesSidebar();
+
+                const job = await waitForJob(data.job, file.name);
+                if (job.state === 'failed') {
+                    throw new Error(job.error);
+                }
+                uploadStatus.textContent = data.duplicate ? `✅ Already indexed` : `✅ Indexed`;
+                uploadStatus.style.color = '#10a37f';
+                setTimeout(() => { uploadStatus.textContent = ''; }, 3000);
+                fetchStatus();
             } else {
                 throw new Error(data.message);
             }
@@ -551,6 +566,21 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Polls the ingestion job until it is done or failed, showing its stage meanwhile
+    async function waitForJob(job, name) {
+        while (job.state !== 'done' && job.state !== 'failed') {
+            const chunks = job.chunks ? ` (${job.chunks} chunks)` : '';
+            uploadStatus.textContent = `Indexing ${name}: ${job.state}${chunks}...`;
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const response = await fetch(`/jobs/${job.id}`);
+            if (!response.ok) {
+                throw new Error(`Job ${job.id} not found`);
+            }
+            job = await response.json();
+        }
+        return job;
+    }
+
     async function fetchStatus() {
         try {
             const statusText = document.getElementById('system-status-text');
@@ -0,0 +1,368 @@
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as _Tally
+from contextlib import contextmanager
+
+# Append one JSON line of spans per traced query or ingest to this file; empty disables tracing
+TRACE_PATH = os.getenv("TRACE_PATH", "")
+# Share of requests traced when TRACE_PATH is set
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+# Sample the stacks of running requests and dump those slower than this (ms) as folded stacks; 0 disables
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+# Milliseconds between stack samples while profiling
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Where slow-request profiles are written, one <kind>-<time>-<trace id>.folded file each
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Histogram bucket bounds in seconds, from sub-millisecond lookups to slow LLM calls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_REGISTRY = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), function=None):
+        """function, if given, is called at scrape time and returns the value, or a
+        {label values tuple: value} dict for a labelled metric."""
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def _samples(self):
+        if self.function is None:
+            with self._lock:
+                return dict(self._values)
+        value = self.function()
+        return value if isinstance(value, dict) else {(): value}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            samples = self._samples()
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {e}")
+            samples = {}
+        for key, value in sorted(samples.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per-bucket (not cumulative) counts, then the +Inf count and the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip([*self.buckets, float("inf")], counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+def render():
+    """All registered metrics in the Prometheus text exposition format (0.0.4)."""
+    return "\n".join(line for metric in list(_REGISTRY) for line in metric.render()) + "\n"
+
+def _cache_lookups():
+    import answer_cache
+    import query_rewrite
+    counts = {}
+    cache = answer_cache.get_answer_cache()
+    if cache is not None:
+        stats = cache.stats()
+        counts[("answer", "hit")], counts[("answer", "miss")] = stats["hits"], stats["misses"]
+    stats = query_rewrite.get_rewrite_memo().stats()
+    counts[("rewrite", "hit")], counts[("rewrite", "miss")] = stats["memo_hits"], stats["rewrites"]
+    rerank = sys.modules.get("rerank")
+    reranker = rerank.get_reranker(create=False) if rerank is not None else None
+    if reranker is not None:
+        stats = reranker.stats()
+        counts[("rerank", "hit")], counts[("rerank", "miss")] = stats["cache_hits"], stats["pairs_scored"]
+    scoped_search = sys.modules.get("scoped_search")
+    if scoped_search is not None and scoped_search._BLOCKS is not None:
+        stats = scoped_search._BLOCKS.stats()
+        counts[("scope", "hit")], counts[("scope", "miss")] = stats["hits"], stats["misses"]
+    return counts
+
+def _collection_size():
+    import ingest
+    stats = ingest.get_collection_stats()
+    return {("chunks",): stats["chunk_count"], ("documents",): stats["document_count"]}
+
+def _embedding_counts(field):
+    # Only once something embedded: importing embedding_service loads chromadb
+    embedding_service = sys.modules.get("embedding_service")
+    if embedding_service is None:
+        return {}
+    return {(name,): stats[field] for name, stats in embedding_service.get_stats(sidecar=False)["local"].items()}
+
+STAGE_SECONDS = Histogram("rag_stage_seconds", "Seconds spent in each query stage (rewrite, embed, search, "
+                          "lexical, rerank, pack, prompt, generate)", ["stage"])
+REQUEST_SECONDS = Histogram("rag_request_seconds", "Seconds per query_rag call, stream, batch or ingested file",
+                            ["kind"])
+INGEST_STAGE_SECONDS = Histogram("rag_ingest_stage_seconds", "Seconds per ingestion stage (ingest_file: upsert "
+                                 "embeds and writes one batch, commit removes stale chunks and commits the indexes; "
+                                 "bulk pipeline: embed, write)", ["stage"])
+SHARD_SECONDS = Histogram("rag_shard_seconds", "Seconds each shard worker spent serving a request (SHARD_COUNT > 1)",
+                          ["shard"])
+IN_FLIGHT = Gauge("rag_in_flight", "Queries and ingests running right now", ["kind"])
+ERRORS = Counter("rag_errors_total", "Errors, by where they happened", ["where"])
+CHUNKS_INGESTED = Counter("rag_chunks_ingested_total", "Chunks embedded and written to the index")
+FILES_INGESTED = Counter("rag_files_ingested_total", "Files ingested, by outcome", ["result"])
+SLOW_REQUESTS = Counter("rag_slow_requests_total", "Requests slower than PROFILE_SLOW_MS (profiled)", ["kind"])
+CACHE_LOOKUPS = Counter("rag_cache_lookups_total", "Answer cache, rewrite memo, rerank score cache "
+                        "and scoped embedding block lookups",
+                        ["cache", "result"], function=_cache_lookups)
+COLLECTION_SIZE = Gauge("rag_collection_size", "Indexed chunks and documents", ["unit"], function=_collection_size)
+EMBEDDED_TEXTS = Counter("rag_embedded_texts_total", "Texts embedded in this process, by model", ["model"],
+                         function=lambda: _embedding_counts("texts"))
+EMBEDDING_BATCHES = Counter("rag_embedding_batches_total", "Embedding model calls in this process, by model",
+                            ["model"], function=lambda: _embedding_counts("batches"))
+
+_CURRENT = contextvars.ContextVar("rag_request", default=None)
+_TRACE_LOCK = threading.Lock()
+
+class _Sampler:
+    """Samples the Python stacks of threads serving profiled requests every interval."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, thread_id, request):
+        with self._lock:
+            self._active[thread_id] = request
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, thread_id):
+        with self._lock:
+            self._active.pop(thread_id, None)
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, request in active.items():
+                frame = frames.get(thread_id)
+                if frame is not None and thread_id != me:
+                    request.samples[_stack(frame)] += 1
+
+def _stack(frame):
+    """Root-first frames as "function (file:line)", the line being where the function starts."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+_SAMPLER = _Sampler(PROFILE_INTERVAL_MS / 1000)
+
+class Request:
+    """One query or ingest: in-flight gauge, duration histogram, error count, and if
+    enabled its trace spans and stack samples.
+
+    Spans are only recorded while the request is active in the calling thread (see
+    activate), so a generator can re-activate it around each step.
+    """
+
+    def __init__(self, kind, **attributes):
+        self.kind = kind
+        self.attributes = attributes
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.traced = bool(TRACE_PATH) and random.random() < TRACE_SAMPLE_RATE
+        self.spans = []
+        self.samples = _Tally()
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+        IN_FLIGHT.inc(kind=kind)
+
+    @contextmanager
+    def activate(self):
+        token = _CURRENT.set(self)
+        thread_id = threading.get_ident()
+        if PROFILE_SLOW_MS > 0:
+            _SAMPLER.add(thread_id, self)
+        try:
+            yield self
+        finally:
+            if PROFILE_SLOW_MS > 0:
+                _SAMPLER.remove(thread_id)
+            _CURRENT.reset(token)
+
+    def add_span(self, name, start, seconds):
+        if self.traced:
+            with self._lock:
+                self.spans.append({"name": name, "start_ms": (start - self.start) * 1000,
+                                   "duration_ms": seconds * 1000, "thread": threading.current_thread().name})
+
+    def finish(self, error=None):
+        seconds = time.perf_counter() - self.start
+        IN_FLIGHT.dec(kind=self.kind)
+        REQUEST_SECONDS.observe(seconds, kind=self.kind)
+        if error is not None:
+            ERRORS.inc(where=self.kind)
+        if self.traced:
+            self._write_trace(seconds, error)
+        if PROFILE_SLOW_MS > 0 and seconds * 1000 >= PROFILE_SLOW_MS:
+            SLOW_REQUESTS.inc(kind=self.kind)
+            self._write_profile(seconds)
+
+    def _write_trace(self, seconds, error):
+        record = {"trace_id": self.trace_id, "kind": self.kind, "start": self.started_at,
+                  "duration_ms": seconds * 1000, "error": str(error) if error is not None else None,
+                  "attributes": self.attributes, "spans": sorted(self.spans, key=lambda span: span["start_ms"])}
+        try:
+            with _TRACE_LOCK, open(TRACE_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+        except OSError as e:
+            print(f"Error writing trace to {TRACE_PATH}: {e}")
+
+    def _write_profile(self, seconds):
+        if not self.samples:
+            return
+        path = os.path.join(PROFILE_DIR, f"{self.kind}-{time.strftime('%Y%m%d-%H%M%S')}-{self.trace_id}.folded")
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            print(f"Error writing profile to {path}: {e}")
+            return
+        print(f"Slow {self.kind} ({seconds * 1000:.0f} ms, {sum(self.samples.values())} samples): {path}")
+
+@contextmanager
+def request(kind, **attributes):
+    """Instruments a synchronous query or ingest; see Request."""
+    current = Request(kind, **attributes)
+    error = None
+    try:
+        with current.activate():
+            yield current
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        current.finish(error)
+
+def traced(kind, events, **attributes):
+    """Instruments a generator (e.g. a streamed answer) that may be resumed from different threads."""
+    current = Request(kind, **attributes)
+    error = None
+    try:
+        while True:
+            with current.activate():
+                event = next(events, None)
+            if event is None:
+                break
+            yield event
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        # Also reached when the consumer stops early (GeneratorExit)
+        events.close()
+        current.finish(error)
+
+@contextmanager
+def timed(histogram, stage):
+    """Observes the block's seconds in histogram (labelled stage) and records it as a span."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        histogram.observe(seconds, stage=stage)
+        current = _CURRENT.get()
+        if current is not None:
+            current.add_span(stage, start, seconds)
+
+def propagate(fn):
+    """fn bound to the caller's context, so spans it records in a pool thread reach the caller's trace."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import os
+import time
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    # python-multipart releases before 0.0.13 only ship the "multipart" package name
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# Largest accepted upload in bytes; a request declaring a bigger body is refused before it is read
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(100 << 20)))
+# File bytes buffered in memory before each write to disk (and hash update)
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Room left in Content-Length for the multipart boundaries and part headers
+MULTIPART_OVERHEAD = 64 << 10
+
+class UploadError(Exception):
+    """The request is not a multipart upload with a file in the expected field."""
+
+class UploadTooLarge(UploadError):
+    pass
+
+class StagedUpload:
+    """A file streamed into the staging directory, hashed (SHA-256, as manifest.hash_file) on the way."""
+
+    def __init__(self, filename, path, size, content_hash):
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.content_hash = content_hash
+
+class _FileStager:
+    """Writes the file part of a multipart body to disk in UPLOAD_CHUNK_SIZE pieces.
+
+    The parser callbacks only collect bytes; the async caller flushes them from a worker
+    thread, so neither disk writes nor hashing run on the event loop and at most about
+    one chunk plus one network read is held in memory.
+    """
+
+    def __init__(self, field, staging_dir, max_bytes):
+        self.field = field
+        self.staging_dir = staging_dir
+        self.max_bytes = max_bytes
+        self.filename = None
+        self.path = None
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = None
+        self._pending = bytearray()
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._in_file = False
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self._part_begin,
+            "on_header_field": lambda data, start, end: self._add(data, start, end, "_header_field"),
+            "on_header_value": lambda data, start, end: self._add(data, start, end, "_header_value"),
+            "on_header_end": self._header_end,
+            "on_headers_finished": self._headers_finished,
+            "on_part_data": self._part_data,
+            "on_part_end": self._part_end,
+        }
+
+    def _add(self, data, start, end, name):
+        setattr(self, name, getattr(self, name) + data[start:end])
+
+    def _part_begin(self):
+        self._headers = {}
+
+    def _header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        filename = options.get(b"filename")
+        if options.get(b"name") != self.field.encode() or filename is None or self.path is not None:
+            return
+        # Only the base name: "../" in a client-supplied name must not escape data/
+        self.filename = os.path.basename(filename.decode("utf-8", "replace").replace("\\", "/"))
+        if not self.filename:
+            raise UploadError("The uploaded file has no name")
+        self.path = os.path.join(self.staging_dir, f"{os.getpid()}-{time.time_ns()}-{self.filename}")
+        self._file = open(self.path, "wb")
+        self._in_file = True
+
+    def _part_data(self, data, start, end):
+        if not self._in_file:
+            return
+        self.size += end - start
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"Upload exceeds the {self.max_bytes} byte limit")
+        self._pending += data[start:end]
+
+    def _part_end(self):
+        self._in_file = False
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def flush(self):
+        if self._pending:
+            self._hash.update(self._pending)
+            self._file.write(self._pending)
+            self._pending.clear()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        self._file = None
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    @property
+    def content_hash(self):
+        return self._hash.hexdigest()
+
+async def stage_multipart(request, staging_dir, field="file", max_bytes=MAX_UPLOAD_BYTES):
+    """Streams the file in a multipart/form-data request's `field` into staging_dir.
+
+    Returns a StagedUpload. Raises UploadTooLarge as soon as the declared or received
+    size passes max_bytes, and UploadError for a malformed request; the partial file
+    is removed in both cases.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadError("Expected a multipart/form-data request")
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes + MULTIPART_OVERHEAD:
+        raise UploadTooLarge(f"Upload exceeds the {max_bytes} byte limit")
+
+    stager = _FileStager(field, staging_dir, max_bytes)
+    parser = MultipartParser(boundary, stager.callbacks())
+    try:
+        try:
+            async for data in request.stream():
+                parser.write(data)
+                if stager.pending >= UPLOAD_CHUNK_SIZE:
+                    await asyncio.to_thread(stager.flush)
+            parser.finalize()
+        except UploadError:
+            raise
+        except ValueError as e:
+            # python-multipart's parse errors are ValueErrors
+            raise UploadError(f"Malformed multipart body: {e}") from e
+        if stager.path is None:
+            raise UploadError(f"No file in form field {field!r}")
+        await asyncio.to_thread(stager.close)
+    except BaseException:
+        # Not awaited, so a cancelled (disconnected) upload is cleaned up too
+        stager.discard()
+        raise
+    return StagedUpload(stager.filename, stager.path, stager.size, stager.content_hash)
@@ -0,0 +1,400 @@
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+# "chroma" (default) searches Chroma's HNSW index; "int8" searches the memory-mapped index below
+# and only reads chunk text and metadata from Chroma
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "chroma")
+VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH", "vector_index")
+# Approximate candidates re-ranked with full-precision vectors, per requested result
+VECTOR_INDEX_RERANK = int(os.getenv("VECTOR_INDEX_RERANK", "10"))
+# IVF lists probed per query once the index is trained (python vector_index.py --train NLIST)
+VECTOR_INDEX_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", "16"))
+# Rows scored per step of a scan; small enough that the float32 copy of the codes stays in cache
+SCAN_BLOCK = 1 << 12
+
+def enabled():
+    return VECTOR_INDEX == "int8"
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+def quantize(vectors):
+    """Symmetric per-vector int8 quantization: vector ~= scale * codes."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+class VectorIndex:
+    """Append-only int8 vector store with exact re-ranking, for L2 search like Chroma's default.
+
+    Each row lives in flat files that are memory-mapped on demand: int8 codes, a scale
+    and squared norm for the approximate scan, the float32 vector (only read for the
+    candidates being re-ranked), id and source hashes, the chunk id, and a deleted flag.
+    id_ends is written last, so its length is the number of complete rows after a crash.
+    Writers in any process hold the directory's lock file; searches only read mapped rows.
+    Once trained, every row also has an IVF list (nearest k-means centroid) and queries
+    only scan the VECTOR_INDEX_NPROBE lists nearest to them.
+    """
+
+    # name -> (dtype, values per row); "dim" means the embedding dimension
+    FILES = {
+        "vectors": (np.float32, "dim"),
+        "codes": (np.int8, "dim"),
+        "scales": (np.float32, 1),
+        "sq_norms": (np.float32, 1),
+        "id_hashes": (np.uint64, 1),
+        "source_hashes": (np.uint64, 1),
+        "deleted": (np.uint8, 1),
+        "clusters": (np.int32, 1),
+        "id_ends": (np.int64, 1),
+    }
+
+    def __init__(self, path=VECTOR_INDEX_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self.dim = None
+        self.centroids = None
+        self.count = 0
+        self._maps = {}
+        self._lists = None
+        self._listed = 0
+        self._read_meta()
+        self._refresh()
+
+    def _file(self, name):
+        return os.path.join(self.path, f"{name}.bin")
+
+    def _read_meta(self):
+        meta_path = os.path.join(self.path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        centroids_path = os.path.join(self.path, "centroids.npy")
+        if os.path.exists(centroids_path):
+            self.centroids = np.load(centroids_path)
+
+    def _width(self, name):
+        dtype, per_row = self.FILES[name]
+        return np.dtype(dtype).itemsize * (self.dim if per_row == "dim" else per_row)
+
+    def _refresh(self):
+        """Re-maps the files if rows were appended (by this or another process)."""
+        if self.dim is None:
+            self._read_meta()
+        if self.dim is None or not os.path.exists(self._file("id_ends")):
+            return
+        count = os.path.getsize(self._file("id_ends")) // self._width("id_ends")
+        if count == self.count and self._maps:
+            return
+        self.count = count
+        self._maps = {}
+        for name, (dtype, per_row) in self.FILES.items():
+            if name == "clusters" and self.centroids is None or count == 0:
+                continue
+            shape = (count, self.dim) if per_row == "dim" else (count,)
+            mode = "r+" if name == "deleted" else "r"
+            self._maps[name] = np.memmap(self._file(name), dtype=dtype, mode=mode, shape=shape)
+        if count and self._ids_end():
+            self._maps["ids"] = np.memmap(self._file("ids"), dtype=np.uint8, mode="r", shape=(self._ids_end(),))
+        if self.centroids is not None and self._lists is not None:
+            self._extend_lists()
+
+    def _append(self, name, array):
+        with open(self._file(name), "ab") as f:
+            f.write(np.ascontiguousarray(array, dtype=self.FILES[name][0]).tobytes())
+
+    def _ids_end(self):
+        if not self.count:
+            return 0
+        return int(np.fromfile(self._file("id_ends"), dtype=np.int64, offset=(self.count - 1) * 8, count=1)[0])
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        """Holds the thread lock and the index directory's lock file, for writes from any process."""
+        with self._lock, open(os.path.join(self.path, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _truncate_partial_rows(self):
+        # A crash between appends can leave some files a few rows ahead of id_ends
+        sizes = {name: self.count * self._width(name) for name in self.FILES}
+        sizes["ids"] = self._ids_end()
+        for name, size in sizes.items():
+            if os.path.exists(self._file(name)):
+                with open(self._file(name), "r+b") as f:
+                    f.truncate(size)
+
+    def add(self, ids, sources, embeddings):
+        source_hashes = np.fromiter((_hash(s) for s in sources), dtype=np.uint64, count=len(sources))
+        self._write_rows(ids, source_hashes, embeddings)
+
+    def _write_rows(self, ids, source_hashes, embeddings):
+        if not len(ids):
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        with self._exclusive():
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(os.path.join(self.path, "meta.json"), "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim}, f)
+            self._refresh()
+            self._truncate_partial_rows()
+            self._maps = {}
+            codes, scales = quantize(vectors)
+            encoded = [chunk_id.encode("utf-8") for chunk_id in ids]
+            start = self._ids_end()
+            self._append("vectors", vectors)
+            self._append("codes", codes)
+            self._append("scales", scales)
+            self._append("sq_norms", (vectors * vectors).sum(axis=1))
+            self._append("id_hashes", np.fromiter((_hash(i) for i in ids), dtype=np.uint64, count=len(ids)))
+            self._append("source_hashes", source_hashes)
+            self._append("deleted", np.zeros(len(ids), dtype=np.uint8))
+            if self.centroids is not None:
+                self._append("clusters", self._assign(vectors))
+            with open(self._file("ids"), "ab") as f:
+                f.write(b"".join(encoded))
+            self._append("id_ends", start + np.cumsum([len(e) for e in encoded]))
+            self._refresh()
+
+    def _rows_of_source(self, source):
+        return np.nonzero(self._maps["source_hashes"] == np.uint64(_hash(source)))[0]
+
+    @staticmethod
+    def _rows_of_sources(maps, sources):
+        hashes = np.fromiter((_hash(s) for s in sources), dtype=np.uint64, count=len(sources))
+        return np.nonzero(np.isin(maps["source_hashes"], hashes))[0]
+
+    def delete(self, source, ids=None):
+        """Marks source's rows deleted, or only the given ids of it."""
+        with self._lock:
+            self._refresh()
+            if not self.count:
+                return 0
+            rows = self._rows_of_source(source)
+            if ids is not None:
+                wanted = np.fromiter((_hash(i) for i in ids), dtype=np.uint64, count=len(ids))
+                rows = rows[np.isin(self._maps["id_hashes"][rows], wanted)]
+            deleted = self._maps["deleted"]
+            rows = rows[deleted[rows] == 0]
+            deleted[rows] = 1
+            deleted.flush()
+            return len(rows)
+
+    def chunk_id(self, row):
+        return self._chunk_id(self._maps, row)
+
+    @staticmethod
+    def _chunk_id(maps, row):
+        ends = maps["id_ends"]
+        start = int(ends[row - 1]) if row else 0
+        return maps["ids"][start:int(ends[row])].tobytes().decode("utf-8")
+
+    def _assign(self, vectors):
+        # argmin |v - c|^2 = argmin |c|^2 - 2 v.c
+        c = self.centroids
+        return np.argmin((c * c).sum(axis=1) - 2 * vectors @ c.T, axis=1).astype(np.int32)
+
+    def _extend_lists(self):
+        """Adds rows appended since the IVF lists were built to them."""
+        clusters = np.asarray(self._maps["clusters"][self._listed:self.count])
+        order = np.argsort(clusters, kind="stable")
+        bounds = np.searchsorted(clusters[order], np.arange(len(self.centroids) + 1))
+        for c in range(len(self.centroids)):
+            new = order[bounds[c]:bounds[c + 1]] + self._listed
+            if len(new):
+                self._lists[c] = np.concatenate((self._lists[c], new))
+        self._listed = self.count
+
+    def train(self, nlist, sample_size=100000, iterations=10, seed=0):
+        """Builds nlist k-means centroids from a sample and assigns every row to its nearest."""
+        with self._exclusive():
+            self._refresh()
+            if self.count < nlist:
+                raise ValueError(f"Need at least {nlist} vectors to train {nlist} lists, have {self.count}")
+            rng = np.random.default_rng(seed)
+            sample = np.sort(rng.choice(self.count, min(sample_size, self.count), replace=False))
+            data = np.asarray(self._maps["vectors"][sample])
+            centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+            for _ in range(iterations):
+                self.centroids = centroids
+                labels = self._assign(data)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, data)
+                sizes = np.bincount(labels, minlength=nlist)
+                filled = sizes > 0
+                centroids[filled] = sums[filled] / sizes[filled, None]
+            self.centroids = centroids.astype(np.float32)
+
+            if os.path.exists(self._file("clusters")):
+                os.remove(self._file("clusters"))
+            for start in range(0, self.count, SCAN_BLOCK):
+                self._append("clusters", self._assign(np.asarray(self._maps["vectors"][start:start + SCAN_BLOCK])))
+            np.save(os.path.join(self.path, "centroids.npy"), self.centroids)
+            self._maps = {}
+            self._lists = None
+            self._refresh()
+
+    def _candidate_rows(self, query):
+        if self.centroids is None:
+            return None
+        if self._lists is None:
+            self._lists = [np.zeros(0, dtype=np.int64) for _ in range(len(self.centroids))]
+            self._listed = 0
+            self._extend_lists()
+        nprobe = min(VECTOR_INDEX_NPROBE, len(self.centroids))
+        nearest = np.argpartition(self._assign_scores(query), nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([self._lists[c] for c in nearest]))
+
+    def _assign_scores(self, query):
+        c = self.centroids
+        return (c * c).sum(axis=1) - 2 * c @ query
+
+    @staticmethod
+    def _approximate(maps, query, rows, start, stop):
+        """Approximate |x - q|^2 - |q|^2 for rows (or the block start:stop), deleted rows at +inf."""
+        select = rows if rows is not None else slice(start, stop)
+        codes = maps["codes"][select]
+        scores = maps["sq_norms"][select] - 2 * maps["scales"][select] * (codes.astype(np.float32) @ query)
+        scores[maps["deleted"][select] != 0] = np.inf
+        return scores
+
+    def search(self, query, k=10, sources=None):
+        """Returns up to k (chunk_id, squared_l2_distance) pairs, nearest first.
+
+        sources, if given, limits the scan to those files' rows (skipping the IVF lists).
+        """
+        query = np.asarray(query, dtype=np.float32)
+        # Only the refresh and IVF lookup are locked; rows are append-only, so the maps
+        # taken here stay valid for the scan while writers append or remap
+        with self._lock:
+            self._refresh()
+            if not self.count:
+                return []
+            maps, count = self._maps, self.count
+            rows = self._candidate_rows(query) if sources is None else None
+        if sources is not None:
+            rows = self._rows_of_sources(maps, sources)
+        depth = max(k * VECTOR_INDEX_RERANK, k)
+
+        best_rows, best_scores = [], []
+        blocks = [(rows[i:i + SCAN_BLOCK], 0, 0) for i in range(0, len(rows), SCAN_BLOCK)] if rows is not None \
+            else [(None, i, min(i + SCAN_BLOCK, count)) for i in range(0, count, SCAN_BLOCK)]
+        for block_rows, start, stop in blocks:
+            scores = self._approximate(maps, query, block_rows, start, stop)
+            keep = np.argpartition(scores, depth - 1)[:depth] if len(scores) > depth else np.arange(len(scores))
+            best_rows.append(block_rows[keep] if block_rows is not None else keep + start)
+            best_scores.append(scores[keep])
+        if not best_rows:
+            return []
+        candidates, scores = np.concatenate(best_rows), np.concatenate(best_scores)
+        keep = np.argpartition(scores, depth - 1)[:depth] if len(scores) > depth else np.arange(len(scores))
+        candidates = np.sort(candidates[keep][np.isfinite(scores[keep])])
+
+        # Exact distances from the float32 vectors; only these rows are read from disk
+        exact = ((np.asarray(maps["vectors"][candidates]) - query) ** 2).sum(axis=1)
+        results, seen = [], set()
+        for i in np.argsort(exact):
+            chunk_id = self._chunk_id(maps, int(candidates[i]))
+            # An id re-added after an interrupted update may exist twice; keep the nearest
+            if chunk_id not in seen:
+                seen.add(chunk_id)
+                results.append((chunk_id, float(exact[i])))
+            if len(results) == k:
+                break
+        return results
+
+    def live_count(self):
+        with self._lock:
+            self._refresh()
+            return int(self.count - self._maps["deleted"].sum()) if self.count else 0
+
+    def compact(self):
+        """Rewrites the files without deleted rows, block by block, then swaps them in."""
+        with self._lock:
+            self._refresh()
+            if not self.count:
+                return
+            target = VectorIndex(self.path + ".compact")
+            target.clear()
+            target.centroids = self.centroids
+            for start in range(0, self.count, SCAN_BLOCK):
+                stop = min(start + SCAN_BLOCK, self.count)
+                live = np.nonzero(self._maps["deleted"][start:stop] == 0)[0] + start
+                target._write_rows([self.chunk_id(int(row)) for row in live], self._maps["source_hashes"][live],
+                                   self._maps["vectors"][live])
+            self._maps = {}
+            target._maps = {}
+            old = self.path + ".old"
+            os.replace(self.path, old)
+            os.replace(target.path, self.path)
+            for name in os.listdir(old):
+                os.remove(os.path.join(old, name))
+            os.rmdir(old)
+            if self.centroids is not None:
+                np.save(os.path.join(self.path, "centroids.npy"), self.centroids)
+            self.count = 0
+            self._lists = None
+            self._read_meta()
+            self._refresh()
+
+    def clear(self, keep_centroids=False):
+        with self._lock:
+            self._maps = {}
+            self._lists = None
+            for name in list(self.FILES) + ["ids"]:
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+            if not keep_centroids:
+                self.centroids = None
+                centroids_path = os.path.join(self.path, "centroids.npy")
+                if os.path.exists(centroids_path):
+                    os.remove(centroids_path)
+            self.count = 0
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+def get_vector_index():
+    global _INDEX
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            _INDEX = VectorIndex()
+        return _INDEX
+
+def rebuild_from_collection(batch_size=5000):
+    """Re-creates the index from the embeddings stored in the Chroma collection."""
+    import resources
+    index = get_vector_index()
+    index.clear()
+    collection = resources.get_metadata_collection()
+    if collection is None:
+        return 0
+    total = collection.count()
+    for offset in range(0, total, batch_size):
+        result = collection.get(include=["embeddings", "metadatas"], limit=batch_size, offset=offset)
+        index.add(result["ids"], [(m or {}).get("source", "Unknown") for m in result["metadatas"]], result["embeddings"])
+    return index.live_count()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the int8 vector index (VECTOR_INDEX=int8).")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild from the Chroma collection")
+    parser.add_argument("--train", type=int, metavar="NLIST", help="cluster into NLIST IVF lists")
+    parser.add_argument("--compact", action="store_true", help="drop deleted rows")
+    args = parser.parse_args()
+    if args.rebuild:
+        print(f"Indexed {rebuild_from_collection()} vectors")
+    if args.compact:
+        get_vector_index().compact()
+    if args.train:
+        get_vector_index().train(args.train)
+        print(f"Trained {args.train} lists")
@@ -1,18 +1,25 @@
 import streamlit as st
+import hashlib
 import os
 import sys
+import time
 from pathlib import Path
 
 # Add the Document RAG System directory to the path
 sys.path.insert(0, str(Path(__file__).parent / "Document RAG System"))
 
 try:
-    from rag import query_rag
-    from ingest import ingest_file, get_collection_stats
+    from rag import query_rag_stream
+    from ingest import get_collection_stats
+    from jobs import get_job_queue
+    from uploads import MAX_UPLOAD_BYTES
 except ImportError as e:
     st.error(f"Error importing RAG modules: {e}")
     st.stop()
 
+# Ingestion runs on the shared job queue's workers; starting them again is a no-op
+get_job_queue().start()
+
 st.set_page_config(
     page_title="Document RAG System",
     page_icon="📚",
@@ -35,22 +42,42 @@ with st.sidebar:
     )
     
     if uploaded_file is not None:
-        with st.spinner(f"Processing {uploaded_file.name}..."):
-            try:
-                # Save uploaded file temporarily
-                temp_path = f"/tmp/{uploaded_file.name}"
-                with open(temp_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                
-                # Ingest the document
-                result = ingest_file(temp_path)
-                st.success(f"✅ Successfully processed: {uploaded_file.name}")
-                st.info(f"Document stats: {result}")
-                
-                # Clean up temp file
-                os.remove(temp_path)
-            except Exception as e:
-                st.error(f"Error processing file: {str(e)}")
+        try:
+            # Streamlit reruns this script on every interaction while the file stays selected;
+            # only the first run stages and enqueues it, later ones look up its job
+            staged_uploads = st.session_state.setdefault("staged_uploads", {})
+            upload = staged_uploads.get(uploaded_file.file_id)
+            job = get_job_queue().get(upload["job_id"]) if upload else None
+            if job is None:
+                if uploaded_file.size > MAX_UPLOAD_BYTES:
+                    raise ValueError(f"File exceeds the {MAX_UPLOAD_BYTES} byte limit")
+                # Streamlit already holds the upload in memory: hash that buffer and write it out once,
+                # without copying it
+                buffer = uploaded_file.getbuffer()
+                name = os.path.basename(uploaded_file.name)
+                os.makedirs(os.path.join("data", ".staging"), exist_ok=True)
+                staged = os.path.join("data", ".staging", f"{os.getpid()}-{time.time_ns()}-{name}")
+                with open(staged, "wb") as f:
+                    f.write(buffer)
+                job, duplicate = get_job_queue().enqueue(os.path.join("data", name),
+                                                         hashlib.sha256(buffer).hexdigest(), staged=staged)
+                upload = staged_uploads[uploaded_file.file_id] = {"job_id": job["id"], "duplicate": duplicate}
+            duplicate = upload["duplicate"]
+
+            progress = st.empty()
+            while job["state"] not in ("done", "failed"):
+                chunks = f" ({job['chunks']} chunks)" if job["chunks"] else ""
+                progress.info(f"Indexing {uploaded_file.name}: {job['state']}{chunks}...")
+                time.sleep(0.5)
+                job = get_job_queue().get(job["id"])
+            if job["state"] == "failed":
+                progress.error(f"Error processing file: {job['error']}")
+            elif duplicate:
+                progress.success(f"✅ Already indexed as {job['filename']}")
+            else:
+                progress.success(f"✅ Successfully processed: {uploaded_file.name} ({job['chunks']} chunks)")
+        except Exception as e:
+            st.error(f"Error processing file: {str(e)}")
     
     st.markdown("---")
     st.subheader("📄 Collection Info")
@@ -85,33 +112,46 @@ if user_input := st.chat_input("Ask a question about your documents..."):
     
     # Get RAG response
     with st.chat_message("assistant"):
-        with st.spinner("Searching documents and generating answer..."):
-            try:
-                response = query_rag(user_input)
-                
-                # Display answer
-                if isinstance(response, dict):
-                    answer = response.get('answer', 'No answer found.')
-                    citations = response.get('citations', [])
-                    
-                    st.markdown(answer)
-                    
-                    if citations:
-                        with st.expander("📁 View Sources"):
-                            for i, citation in enumerate(citations, 1):
-                                st.write(f"**Source {i}:** {citation}")
-                else:
-                    answer = str(response)
-                    st.markdown(answer)
-                
-                # Add assistant message to chat history
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": answer if isinstance(response, dict) else answer
-                })
-                
-            except Exception as e:
-                error_msg = f"Error generating response: {str(e)}"
-                st.error(error_msg)
-                st.session_state.messages.append({"role": "assistant", "content": error_msg})
+        try:
+            sources = []
+            errors = []
+
+            def answer_tokens():
+                # Sources arrive before the first token; tokens are rendered as they stream in
+                for event in query_rag_stream(user_input):
+                    if event["type"] == "sources":
+                        sources.extend(event["sources"])
+                    elif event["type"] == "token":
+                        yield event["text"]
+                    elif event["type"] == "error":
+                        errors.append(event["message"])
+
+            with st.spinner("Searching documents..."):
+                tokens = answer_tokens()
+                first_token = next(tokens, "")
+
+            def remaining_tokens():
+                yield first_token
+                yield from tokens
+
+            answer = st.write_stream(remaining_tokens())
+            if errors:
+                st.error(errors[0])
+                answer = errors[0]
+            elif not answer:
+                answer = "No answer found."
+                st.markdown(answer)
+
+            if sources:
+                with st.expander("📁 View Sources"):
+                    for i, source in enumerate(sources, 1):
+                        page = f"Page {source['page_start']}, " if source.get("page_start") else ""
+                        st.write(f"**Source {i}:** {source['source']}: {page}Chunk {source['chunk_id']}")
+
+            # Add assistant message to chat history
+            st.session_state.messages.append({"role": "assistant", "content": answer})
 
+        except Exception as e:
+            error_msg = f"Error generating response: {str(e)}"
+            st.error(error_msg)
+            st.session_state.messages.append({"role": "assistant", "content": error_msg})